@@ -0,0 +1,120 @@
+"""Auto-pipelining: 5k concurrent clients' single commands, one by one vs per tick.
+
+Every socket's coroutine awaits Redis commands of its own, one at a time. This
+runs --clients of them at once, each looping for --seconds over what a
+connected client costs between frames: get_partner() (GET), is_connected()
+(EVALSHA) and trigger_wakeup() (PUBLISH). Run once with REDIS_AUTOPIPELINE off,
+each command on its own pooled connection, and once with it on, every command of
+a loop iteration in one pipeline (store._AutoPipeline). Reports
+
+  cmds/s      commands completed per second, all clients together
+  p50/p99 ms  latency of one command as its caller sees it
+  conns       Redis connections the pool opened
+  per flush   commands per pipeline (the "on" run only)
+
+    redis-server --port 6390 --daemonize yes --save "" --appendonly no
+    python bench/bench_autopipeline.py --clients 5000
+    python bench/bench_autopipeline.py --rtt-ms 5      # through latency_proxy.py
+
+With no --rtt-ms it talks to the local server directly: the per-command cost
+is then all syscalls and parsing, which is what pipelining removes.
+
+Env overrides: none; see --help.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ["REDIS_URL"] = "redis://127.0.0.1:6390"    # real one set from --redis-port
+os.environ.setdefault("FLY_MACHINE_ID", "bench-a")
+
+import logging  # noqa: E402
+import redis.asyncio as aioredis  # noqa: E402
+
+import store  # noqa: E402
+from latency_proxy import LatencyProxy  # noqa: E402
+
+logging.disable(logging.INFO)
+
+
+async def seed(r, n: int):
+    """n connected clients on this instance, paired two by two."""
+    pipe = r.pipeline(transaction=False)
+    pipe.set(store.lease_key(store.instance_id()), 1)
+    for i in range(n):
+        pipe.set(store.conn_key(f"c{i}"), store.instance_id())
+        pipe.set(store.partner_key(f"c{i}"), f"c{i ^ 1}")
+    await pipe.execute()
+
+
+async def drop(r):
+    keys = [k async for k in r.scan_iter(match=f"{store.PREFIX}:*", count=1000)]
+    for i in range(0, len(keys), 500):
+        await r.delete(*keys[i:i + 500])
+
+
+async def client(ws_id: str, end: float, latencies: list):
+    while time.monotonic() < end:
+        for call in (store.get_partner, store.is_connected):
+            start = time.perf_counter()
+            await call(ws_id)
+            latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        await store.trigger_wakeup()
+        latencies.append(time.perf_counter() - start)
+
+
+async def measure(args, url: str, pipelined: bool):
+    store.REDIS_AUTOPIPELINE = pipelined
+    os.environ["REDIS_URL"] = url
+    await store.connect()
+    flushes = store._FLUSH_COMMANDS
+    count, total = flushes.count, flushes.sum
+    latencies = []
+    end = time.monotonic() + args.seconds
+    start = time.perf_counter()
+    await asyncio.gather(*(client(f"c{i}", end, latencies) for i in range(args.clients)))
+    elapsed = time.perf_counter() - start
+    pool = store._client.connection_pool
+    conns = len(pool._available_connections) + len(pool._in_use_connections)
+    await store.close()
+
+    latencies.sort()
+    p50, p99 = (latencies[int(q * (len(latencies) - 1))] * 1000 for q in (0.5, 0.99))
+    per_flush = f"{(flushes.sum - total) / (flushes.count - count):.0f}" if pipelined else "-"
+    print(f"{'on' if pipelined else 'off':>5} {len(latencies) / elapsed:>9.0f} {p50:>7.1f}"
+          f" {p99:>7.1f} {conns:>6} {per_flush:>9}")
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--redis-port", type=int, default=6390)
+    ap.add_argument("--rtt-ms", type=float, default=0.0,
+                    help="simulated Redis RTT via latency_proxy.py (0: direct)")
+    ap.add_argument("--clients", type=int, default=5000)
+    ap.add_argument("--seconds", type=float, default=10.0)
+    args = ap.parse_args()
+
+    local = aioredis.from_url(f"redis://127.0.0.1:{args.redis_port}", decode_responses=True)
+    await drop(local)
+    await seed(local, args.clients)
+    async with contextlib.AsyncExitStack() as stack:
+        url = f"redis://127.0.0.1:{args.redis_port}"
+        if args.rtt_ms:
+            proxy = await stack.enter_async_context(LatencyProxy(args.redis_port, args.rtt_ms))
+            url = f"redis://127.0.0.1:{proxy.port}"
+        print(f"{args.clients} clients, {args.seconds:.0f}s each, RTT {args.rtt_ms}ms")
+        print(f"{'auto':>5} {'cmds/s':>9} {'p50 ms':>7} {'p99 ms':>7} {'conns':>6} {'per flush':>9}")
+        for pipelined in (False, True):
+            await measure(args, url, pipelined)
+    await drop(local)
+    await local.aclose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
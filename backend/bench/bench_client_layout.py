@@ -0,0 +1,155 @@
+"""Redis bytes per connected client, and heartbeat cost, for each CLIENT_LAYOUT.
+
+Fills an empty Redis with --clients connected clients through store itself, once
+per layout, each in a fresh process (the layout is read at import): every client
+registered, half of them queued with two topics, the other half paired. Then
+one heartbeat, and one sweep of all of them once their instance is dead, as
+another instance's heartbeat. Reports
+
+  used B/cl   growth of INFO used_memory over the empty server, per client
+  keys B/cl   MEMORY USAGE of the per-client keys alone, per client
+  keys/cl     per-client keys (conn/partner/topics, or the one c: hash)
+  beat        commands one heartbeat costs (store's ledger)
+  sweep       commands to sweep every client of the dead instance
+  sweep ms    wall time of that sweep
+
+    redis-server --port 6390 --daemonize yes --save "" --appendonly no
+    python bench/bench_client_layout.py --clients 10000
+
+The used_memory figure includes the shared structures (the waiting ZSET, topic
+indexes, the instance's client set), where the id length is most of the cost.
+
+Env overrides: none; see --help.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["REDIS_URL"] = "redis://127.0.0.1:6390"    # real one set from --redis-port
+os.environ["FLY_MACHINE_ID"] = "bench-a"
+
+import logging  # noqa: E402
+import redis.asyncio as aioredis  # noqa: E402
+from redis.exceptions import RedisError  # noqa: E402
+
+import store  # noqa: E402  (reads CLIENT_LAYOUT at import: one process per layout)
+
+logging.disable(logging.INFO)
+
+
+async def drop(r):
+    keys = [k async for k in r.scan_iter(match=f"{store.PREFIX}:*", count=1000)]
+    for i in range(0, len(keys), 500):
+        await r.delete(*keys[i:i + 500])
+
+
+async def used_memory(r):
+    """INFO used_memory, or None where the server does not support it."""
+    try:
+        return int((await r.info("memory"))["used_memory"])
+    except (RedisError, KeyError):
+        return None
+
+
+async def client_keys(r) -> list:
+    keys = []
+    for kind in ("c", "conn", "partner", "topics"):
+        keys += [k async for k in r.scan_iter(match=f"{store.PREFIX}:{kind}:*", count=1000)]
+    return keys
+
+
+async def key_bytes(r, keys: list):
+    try:
+        pipe = r.pipeline(transaction=False)
+        for k in keys:
+            pipe.memory_usage(k, samples=0)
+        return sum(await pipe.execute())
+    except RedisError:
+        return None
+
+
+async def child(args):
+    """One layout's figures, as a JSON line on stdout."""
+    os.environ["REDIS_URL"] = f"redis://127.0.0.1:{args.redis_port}"
+    r = aioredis.from_url(os.environ["REDIS_URL"], decode_responses=True)
+    await drop(r)
+    before = await used_memory(r)
+    await store.connect()
+    ids = [store.new_client_id() for _ in range(args.clients)]
+    for i in range(0, len(ids), 500):
+        await store._register(ids[i:i + 500])
+    half = len(ids) // 2
+    for i in range(0, half, 500):
+        await asyncio.gather(*(store.enqueue_waiting(w, [f"t{j % 50}", f"t{(j + 1) % 50}"])
+                               for j, w in enumerate(ids[i:min(i + 500, half)], i)))
+    for i in range(half, len(ids) - 1, 1000):
+        await asyncio.gather(*(store.set_partners(ids[j], ids[j + 1])
+                               for j in range(i, min(i + 1000, len(ids) - 1), 2)))
+    after = await used_memory(r)
+    keys = await client_keys(r)
+    sized = await key_bytes(r, keys)
+
+    beats = store.command_counts()["heartbeat"]
+    await store.renew_lease(ids)
+    beat = store.command_counts()["heartbeat"] - beats
+
+    # The sweep: bench-a is gone, and bench-b's heartbeat finds it.
+    await r.delete(store.lease_key("bench-a"))
+    store._instance_id = "bench-b"
+    beats = store.command_counts()["heartbeat"]
+    start = time.perf_counter()
+    await store.renew_lease([])
+    sweep_ms = (time.perf_counter() - start) * 1000
+    sweep = store.command_counts()["heartbeat"] - beats
+    left = len(await client_keys(r))
+
+    await store.close()
+    await drop(r)
+    await r.aclose()
+    n = args.clients
+    print(json.dumps({
+        "used": (after - before) / n if None not in (before, after) else None,
+        "keys_bytes": sized / n if sized is not None else None,
+        "keys": len(keys) / n, "beat": beat, "sweep": sweep, "sweep_ms": sweep_ms,
+        "left": left, "id_len": len(ids[0]),
+    }))
+
+
+def row(layout: str, res: dict):
+    def b(v):
+        return f"{v:.0f}" if v is not None else "-"
+    note = f"  ({res['left']} keys left unswept)" if res["left"] else ""
+    print(f"{layout:>6} {res['id_len']:>6} {b(res['used']):>10} {b(res['keys_bytes']):>10}"
+          f" {res['keys']:>7.2f} {res['beat']:>5} {res['sweep']:>6} {res['sweep_ms']:>9.1f}{note}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--redis-port", type=int, default=6390)
+    ap.add_argument("--clients", type=int, default=10000)
+    ap.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.child:
+        asyncio.run(child(args))
+        return
+    print(f"{args.clients} clients: half queued with two topics, half paired")
+    print(f"{'layout':>6} {'id len':>6} {'used B/cl':>10} {'keys B/cl':>10} {'keys/cl':>7}"
+          f" {'beat':>5} {'sweep':>6} {'sweep ms':>9}")
+    for layout in ("keys", "hash"):
+        env = dict(os.environ, CLIENT_LAYOUT=layout)
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child",
+             "--redis-port", str(args.redis_port), "--clients", str(args.clients)],
+            env=env, check=True, capture_output=True, text=True,
+        ).stdout
+        row(layout, json.loads(out.strip().splitlines()[-1]))
+
+
+if __name__ == "__main__":
+    main()
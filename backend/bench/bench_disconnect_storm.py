@@ -0,0 +1,135 @@
+"""Mass disconnect: 10k sockets closing at once, per-client cleanup vs batched.
+
+What a machine suspend or a mobile network blip looks like from the server: every
+socket on the instance closes within a few milliseconds and each runs cleanup().
+That used to be three commands per client (clear_partner EVAL, remove_waiting
+EVAL, DEL of the presence key) plus a PUBLISH of PARTNER_LEFT for the paired
+ones, all issued concurrently. Now it is store.disconnect(), which batches every
+disconnect in a DISCONNECT_BATCH_MS window into _DISCONNECT_LUA calls.
+
+    redis-server --port 6390 --daemonize yes --save "" --appendonly no
+    python bench/bench_disconnect_storm.py --sockets 10000
+
+Reports the wall time until every cleanup has returned, and the commands sent
+(counted at the proxy, i.e. what Upstash bills: script-internal calls excluded).
+
+The old path is run with at most --concurrency cleanups in flight. Unbounded, it
+opens one Redis connection per closing socket: 10k exceeds Redis's default
+maxclients and any Upstash plan's connection cap, and it does not finish at all.
+The batched path needs no such limit: it holds one connection per batch.
+
+Env overrides: none; see --help.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ["REDIS_URL"] = "redis://127.0.0.1:6390"    # real one set once the proxy is up
+os.environ.setdefault("FLY_MACHINE_ID", "bench-a")
+
+import logging  # noqa: E402
+import redis.asyncio as aioredis  # noqa: E402
+
+import store  # noqa: E402
+from latency_proxy import LatencyProxy  # noqa: E402
+
+logging.disable(logging.INFO)
+
+
+async def seed(r, n: int):
+    """n clients on this instance: 40% paired (partner elsewhere), 30% queued, 30% idle."""
+    keys = [k async for k in r.scan_iter(match=f"{store.PREFIX}:*", count=1000)]
+    for i in range(0, len(keys), 500):
+        await r.delete(*keys[i:i + 500])
+    rng = random.Random(5)
+    pipe = r.pipeline(transaction=False)
+    ids = [f"s{i:05d}" for i in range(n)]
+    pipe.set(store.lease_key(store.instance_id()), 1)
+    pipe.set(store.lease_key("bench-b"), 1)
+    for i, ws_id in enumerate(ids):
+        pipe.set(store.conn_key(ws_id), store.instance_id())
+        pipe.sadd(store.clients_key(store.instance_id()), ws_id)
+        kind = i % 10
+        if kind < 4:
+            partner = f"p{i:05d}"
+            pipe.set(store.conn_key(partner), "bench-b")
+            pipe.set(store.partner_key(ws_id), partner)
+            pipe.set(store.partner_key(partner), ws_id)
+        elif kind < 7:
+            topics = rng.sample([f"t{k}" for k in range(50)], rng.randrange(3))
+            shard = store.shard_for(ws_id, topics)
+            pipe.zadd(store.waiting_key(shard), {ws_id: i})
+            if topics:
+                pipe.sadd(store.topics_key(ws_id), *topics)
+                for t in topics:
+                    pipe.zadd(store.topic_index_key(shard, t), {ws_id: i})
+    await pipe.execute()
+    return ids
+
+
+async def old_cleanup(ws_id: str):
+    """The pre-batching cleanup(): soft_unpair, remove_waiting, unregister_connection."""
+    r = store._redis
+    partner = await r.eval(store._CLEAR_PARTNER_LUA, 1, store.partner_key(ws_id),
+                           f"{store.PREFIX}:", ws_id)
+    if partner:
+        await r.publish(store.inst_chan("bench-b"), store._PARTNER_LEFT_FRAME)
+    keys = [store.topics_key(ws_id)] + [store.waiting_key(s) for s in range(store.MATCH_SHARDS)]
+    await r.eval(store._REMOVE_WAITING_LUA, len(keys), *keys, ws_id, f"{store.PREFIX}:")
+    await r.delete(store.conn_key(ws_id))
+
+
+async def leftovers(r) -> int:
+    return len([k async for k in r.scan_iter(match=f"{store.PREFIX}:*", count=1000)
+                if not k.startswith((f"{store.PREFIX}:conn:p", f"{store.PREFIX}:partner:p",
+                                     f"{store.PREFIX}:lease:", f"{store.PREFIX}:clients:"))])
+
+
+async def measure(args, label, cleanup):
+    local = aioredis.from_url(f"redis://127.0.0.1:{args.redis_port}", decode_responses=True)
+    ids = await seed(local, args.sockets)
+    async with LatencyProxy(args.redis_port, args.rtt_ms) as proxy:
+        os.environ["REDIS_URL"] = f"redis://127.0.0.1:{proxy.port}"
+        await store.connect()
+        await store._redis.ping()
+        proxy.commands.clear()
+        gate = asyncio.Semaphore(args.concurrency)
+
+        async def one(ws_id):
+            async with gate:
+                await cleanup(ws_id)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[one(ws_id) for ws_id in ids])
+        await store.flush()
+        elapsed = time.perf_counter() - start
+        sent = sum(n for cmd, n in proxy.commands.items() if cmd not in ("client", "hello"))
+        await store.close()
+    left = await leftovers(local)
+    await local.aclose()
+    print(f"{label:>10} {elapsed:>9.2f} {sent:>10} {left:>10}")
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--redis-port", type=int, default=6390)
+    ap.add_argument("--rtt-ms", type=float, default=5.0, help="simulated Redis RTT")
+    ap.add_argument("--sockets", type=int, default=10000)
+    ap.add_argument("--concurrency", type=int, default=200,
+                    help="old path: cleanups in flight at once (see above)")
+    args = ap.parse_args()
+
+    print(f"{args.sockets} sockets disconnecting at once, RTT {args.rtt_ms}ms")
+    print(f"{'cleanup':>10} {'seconds':>9} {'commands':>10} {'leftover':>10}")
+    await measure(args, "old", old_cleanup)
+    args.concurrency = args.sockets
+    await measure(args, "batched", store.disconnect)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
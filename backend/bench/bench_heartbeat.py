@@ -0,0 +1,96 @@
+"""Heartbeat cost versus connected clients: per-client TTL refresh vs instance lease.
+
+The heartbeat used to be store.refresh(): one EVAL carrying every local ws_id,
+running three EXPIREs per client. Now it is store.renew_lease(): one SET of the
+instance's lease (plus a sweep of dead instances, none here) whatever the
+client count. This times one heartbeat of each, against Redis directly so the
+figure is the time Redis is busy (a script blocks every other client for that
+long), and reports its request size.
+
+    redis-server --port 6390 --daemonize yes --save "" --appendonly no
+    python bench/bench_heartbeat.py --clients 1000,5000,20000
+
+Env overrides: none; see --help.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["REDIS_URL"] = "redis://127.0.0.1:6390"    # real one set from --redis-port
+os.environ.setdefault("FLY_MACHINE_ID", "bench-a")
+
+import logging  # noqa: E402
+
+import store  # noqa: E402
+
+logging.disable(logging.INFO)
+
+# The pre-lease heartbeat script, verbatim.
+OLD_REFRESH_LUA = """
+local prefix = ARGV[1]
+local conn_ttl = tonumber(ARGV[2])
+local partner_ttl = tonumber(ARGV[3])
+local topics_ttl = tonumber(ARGV[4])
+for i = 5, #ARGV do
+  local id = ARGV[i]
+  redis.call('EXPIRE', prefix .. 'conn:' .. id, conn_ttl)
+  redis.call('EXPIRE', prefix .. 'partner:' .. id, partner_ttl)
+  redis.call('EXPIRE', prefix .. 'topics:' .. id, topics_ttl)
+end
+return #ARGV - 4
+"""
+
+
+async def best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--redis-port", type=int, default=6390)
+    ap.add_argument("--clients", default="1000,5000,20000")
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    os.environ["REDIS_URL"] = f"redis://127.0.0.1:{args.redis_port}"
+    await store.connect()
+    r = store._redis
+    print(f"{'clients':>8} {'refresh ms':>11} {'bytes':>9} {'lease ms':>9} {'bytes':>6}")
+    for n in [int(x) for x in args.clients.split(",")]:
+        keys = [k async for k in r.scan_iter(match=f"{store.PREFIX}:*", count=1000)]
+        for i in range(0, len(keys), 500):
+            await r.delete(*keys[i:i + 500])
+        store._lease_held = False       # a fresh start, not a lapse
+        ids = [f"c{i:06d}" for i in range(n)]
+        for i in range(0, n, store.DISCONNECT_BATCH_MAX):
+            await store._register(ids[i:i + store.DISCONNECT_BATCH_MAX])
+        old_args = (f"{store.PREFIX}:", 90, 300, 1800, *ids)
+
+        async def old():
+            await r.eval(OLD_REFRESH_LUA, 0, *old_args)
+
+        async def new():
+            await store.renew_lease(ids)
+
+        old_ms = await best_of(old, args.repeat)
+        new_ms = await best_of(new, args.repeat)
+        keys = [store.waiting_key(s) for s in range(store.MATCH_SHARDS)]
+        new_bytes = store._request_bytes("EVALSHA", "0" * 40, len(keys), *keys, f"{store.PREFIX}:",
+                                         store.instance_id(), store.LEASE_TTL,
+                                         store.DISCONNECT_BATCH_MAX,
+                                         store.budget_key("20260101"), 100)
+        print(f"{n:>8} {old_ms:>11.2f} {store._request_bytes('EVAL', OLD_REFRESH_LUA, 0, *old_args):>9}"
+              f" {new_ms:>9.2f} {new_bytes:>6}")
+    await store.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
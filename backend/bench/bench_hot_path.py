@@ -0,0 +1,344 @@
+"""Per-frame hot path: each stage of websocket_endpoint's loop, and the whole loop.
+
+Every client frame goes through the same few steps in websocket_endpoint(): the
+size check, ManagedWebSocket.take(), _relay_name() (signaling is forwarded
+untouched), else _loads() and the name dispatch, _normalize_topics() for a
+PAIRING_START, the ALLOWED_RELAY check, and store.route() to the partner. This
+times each one alone, then the whole loop: two websocket_endpoint() coroutines
+on stub sockets, paired in in-memory mode, one relaying to the other until the
+frames have left the recipient's writer task. No Redis, no network, no server.
+
+  ns/op     per call (per frame for the full loop), the best of several timings;
+            compared in units of a fixed reference workload timed alongside
+  alloc B   bytes allocated while one call runs, beyond what was live before
+            it (tracemalloc's peak, median of many calls): CPython keeps no
+            allocation count, and this is what grows when a stage starts
+            copying or building objects per frame
+
+Then each figure is compared with a stored baseline (bench/hot_path_baseline.json
+by default). Anything slower or allocating more by more than --threshold is
+flagged REGRESSED, and the exit status is 1, so a pre-release run can gate on
+it. A stage over the threshold is timed again, up to --runs runs, and flagged
+only if its best time stays over both in ns and relative to the reference
+workload's best. The reference absorbs a machine that is slower across the
+board, the ns check a quick reference run; timings still only compare on the
+CPU, Python and orjson the baseline came from, and a mismatch is reported.
+--save replaces the baseline with this run.
+
+    python bench/bench_hot_path.py
+    python bench/bench_hot_path.py --save
+
+Env overrides: none; see --help.
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import asyncio
+import argparse
+import platform
+import statistics
+import tracemalloc
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["REDIS_URL"] = ""            # in-memory: no Redis on this path
+os.environ["MSG_RATE"] = "1e9"          # the bucket is timed, never exhausted
+os.environ["MSG_BURST"] = "1e9"
+
+import logging  # noqa: E402
+from starlette.websockets import WebSocketDisconnect  # noqa: E402
+
+import main  # noqa: E402
+import store  # noqa: E402
+
+logging.disable(logging.WARNING)
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hot_path_baseline.json")
+
+# Frames as peer.js sends them: JSON.stringify of {name, data}, data a JSON text.
+ICE = json.dumps({"name": "SDP_ICE_CANDIDATE", "data": json.dumps({
+    "candidate": "candidate:842163049 1 udp 1677729535 203.0.113.7 54321 typ srflx "
+                 "raddr 192.168.1.20 rport 54321 generation 0 ufrag EsAw network-cost 999",
+    "sdpMid": "0", "sdpMLineIndex": 0}, separators=(",", ":"))}, separators=(",", ":"))
+ICE_SPACED = json.dumps(json.loads(ICE))      # not the fast path's shape: parsed
+OFFER = json.dumps({"name": "SDP_OFFER", "data": json.dumps({"type": "offer", "sdp": "".join(
+    f"a=candidate:{i} 1 udp 2122260223 192.0.2.{i} 5{i:04d} typ host generation 0\r\n"
+    for i in range(40))})}, separators=(",", ":"))
+PAIRING = json.dumps({"name": "PAIRING_START", "topics": [" Chess ", "GO", "", "music"]})
+
+
+class StubSocket:
+    """What websocket_endpoint uses of a Starlette WebSocket. Frames come in from
+    `inbox` (None disconnects); sent frames are counted."""
+
+    def __init__(self, ip: str):
+        self.headers = {"fly-client-ip": ip}
+        self.client = None
+        self.inbox: deque = deque()
+        self.more = asyncio.Event()
+        self.sent = 0
+        self.want = 0
+        self.reached = asyncio.Event()
+
+    async def accept(self):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+    async def send_text(self, text: str):
+        self.sent += 1
+        if self.sent >= self.want:
+            self.reached.set()
+
+    async def receive_text(self) -> str:
+        await asyncio.sleep(0)          # a socket read yields to the loop once
+        while not self.inbox:
+            self.more.clear()
+            await self.more.wait()
+        item = self.inbox.popleft()
+        if item is None:
+            raise WebSocketDisconnect()
+        return item
+
+    async def expect(self, frames: int):
+        """Wait until `frames` more have been sent to this socket."""
+        self.want = self.sent + frames
+        self.reached.clear()
+        if self.sent < self.want:
+            await self.reached.wait()
+
+
+def feed(sock: StubSocket, frames: list):
+    sock.inbox.extend(frames)
+    sock.more.set()
+
+
+def _peak(fn, calls: int) -> float:
+    peaks = []
+    for _ in range(calls):
+        tracemalloc.reset_peak()
+        live = tracemalloc.get_traced_memory()[0]
+        fn()
+        peaks.append(tracemalloc.get_traced_memory()[1] - live)
+    return statistics.median(peaks)
+
+
+def alloc_bytes(fn, calls: int = 301) -> int:
+    """Median over `calls` of the peak bytes allocated while fn() runs, less
+    what calling a function that does nothing shows."""
+    return max(0, int(_peak(fn, calls) - _peak(lambda: None, calls)))
+
+
+async def _peak_async(fn, calls: int) -> float:
+    peaks = []
+    for _ in range(calls):
+        tracemalloc.reset_peak()
+        live = tracemalloc.get_traced_memory()[0]
+        await fn()
+        peaks.append(tracemalloc.get_traced_memory()[1] - live)
+    return statistics.median(peaks)
+
+
+async def alloc_bytes_async(fn, calls: int = 301) -> int:
+    async def nothing():
+        pass
+    return max(0, int(await _peak_async(fn, calls) - await _peak_async(nothing, calls)))
+
+
+def ns_per_op(fn) -> float:
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=5, number=number)) / number * 1e9
+
+
+async def ns_per_op_async(run, number: int) -> float:
+    """run(n) performs n ops and returns the seconds they took."""
+    await run(number // 10)             # warm up
+    return min([await run(number) for _ in range(5)]) / number * 1e9
+
+
+def reference():
+    """Fixed pure-Python work of the hot path's kind, the yardstick for how fast
+    the machine is running right now."""
+    data = {"name": "PAIRING_START", "topics": ["Chess", "go", "music"]}
+    return sorted(t.lower() for t in data["topics"]) + [len(data)]
+
+
+async def measure(args) -> tuple:
+    """({stage: {ns, alloc_b}}, ns of reference() around the run)."""
+    store.set_local_delivery(main.deliver_local)
+    results = {}
+    before = ns_per_op(reference)
+
+    # --- each stage alone ---
+    ws = main.ManagedWebSocket(StubSocket("192.0.2.1"), "stage")
+    pairing = json.loads(PAIRING)
+    stages = {
+        "size check": lambda: len(ICE) > main.MAX_MESSAGE_BYTES,
+        "take()": ws.take,
+        "_relay_name, ICE": lambda: main._relay_name(ICE),
+        "_relay_name, SDP offer": lambda: main._relay_name(OFFER),
+        "_relay_name, not relay": lambda: main._relay_name(PAIRING),
+        "_loads, PAIRING_START": lambda: main._loads(PAIRING),
+        "_loads, spaced ICE": lambda: main._loads(ICE_SPACED),
+        "_normalize_topics": lambda: main._normalize_topics(pairing),
+        "ALLOWED_RELAY check": lambda: "SDP_ICE_CANDIDATE" in main.ALLOWED_RELAY,
+    }
+    tracemalloc.start()
+    allocs = {name: alloc_bytes(fn) for name, fn in stages.items()}
+    tracemalloc.stop()
+    for name, fn in stages.items():
+        results[name] = {"ns": ns_per_op(fn), "alloc_b": allocs[name]}
+
+    # store.route() to a local partner: deliver_local queues it on the socket.
+    target = main.ManagedWebSocket(StubSocket("192.0.2.2"), "target")
+    target.partner = "sender"
+    main.local_websockets["target"] = target
+    await store.register_connection("target")
+    owner = store.instance_id()
+
+    async def route(n: int) -> float:
+        start = time.perf_counter()
+        for i in range(n):
+            await store.route("target", ICE, sender="sender", owner=owner)
+            if not i & 127:
+                target._data.clear()    # stand in for its writer, without yielding
+        return time.perf_counter() - start
+
+    async def route_one():
+        await store.route("target", ICE, sender="sender", owner=owner)
+        target._data.clear()
+
+    tracemalloc.start()
+    alloc = await alloc_bytes_async(route_one)
+    tracemalloc.stop()
+    results["store.route, local"] = {"ns": await ns_per_op_async(route, args.number),
+                                     "alloc_b": alloc}
+    await target.safe_close()
+    main.local_websockets.pop("target", None)
+
+    # --- the whole loop: A relays to B through two websocket_endpoint()s ---
+    a, b = StubSocket("192.0.2.10"), StubSocket("192.0.2.11")
+    endpoints = [asyncio.create_task(main.websocket_endpoint(s)) for s in (a, b)]
+    feed(a, [PAIRING])
+    feed(b, [PAIRING])
+    while len(store._mem_waiting) < 2:
+        await asyncio.sleep(0)
+    found = asyncio.gather(a.expect(1), b.expect(1))
+    await store.run_matcher_rounds()
+    await found
+
+    for name, frame in (("full loop, ICE", ICE), ("full loop, spaced ICE", ICE_SPACED)):
+        async def relay(n: int, frame=frame) -> float:
+            start = time.perf_counter()
+            delivered = b.expect(n)
+            feed(a, [frame] * n)
+            await delivered
+            return time.perf_counter() - start
+
+        async def relay_one(frame=frame):
+            delivered = b.expect(1)
+            feed(a, [frame])
+            await delivered
+
+        tracemalloc.start()
+        alloc = await alloc_bytes_async(relay_one)
+        tracemalloc.stop()
+        results[name] = {"ns": await ns_per_op_async(relay, args.number // 10), "alloc_b": alloc}
+
+    feed(a, [None])
+    feed(b, [None])
+    await asyncio.gather(*endpoints)
+    return results, (before + ns_per_op(reference)) / 2
+
+
+def meta() -> dict:
+    return {"python": platform.python_version(), "machine": platform.machine(),
+            "processor": platform.processor() or platform.node(),
+            "orjson": main.orjson is not None}
+
+
+def main_():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--number", type=int, default=20000, help="ops per async timing run")
+    ap.add_argument("--baseline", default=BASELINE)
+    ap.add_argument("--threshold", type=float, default=0.35,
+                    help="flag a stage this much slower, or allocating this much more")
+    ap.add_argument("--runs", type=int, default=5, help="timing runs at most, best kept")
+    ap.add_argument("--save", action="store_true", help="write this run as the baseline")
+    args = ap.parse_args()
+
+    base, base_ref = {}, None
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        base, base_ref = stored["stages"], stored["reference_ns"]
+        if stored["meta"] != meta():
+            print(f"baseline from {stored['meta']}, this is {meta()}: timings may not compare")
+
+    def relate(results, ref):
+        for res in results.values():
+            res["rel"] = res["ns"] / ref        # in units of reference()
+
+    def slower(name, res):
+        # Plus a fixed 50ns: a stage that takes tens of ns moves that much on timer
+        # and scheduling noise alone. Over in ns as well as relative to the
+        # reference: a reference run that happens to be quick inflates every
+        # ratio, and the full loop moves by a third on that alone.
+        if name not in base:
+            return False
+        old = base[name]
+        return (res["rel"] > old["rel"] * (1 + args.threshold) + 50 / base_ref
+                and res["ns"] > old["ns"] * (1 + args.threshold) + 50)
+
+    # Timings are compared relative to reference(), so a machine that is slower
+    # across the board (a busy neighbour, a throttled CPU) does not read as a
+    # regression. Each stage and the reference keep their best over up to
+    # --runs runs, and a stage is compared as its best over the reference's
+    # best, so one run's noise in either moves the ratio less. A baseline
+    # takes every run; a check stops as soon as nothing is over the threshold.
+    results, ref = asyncio.run(measure(args))
+    relate(results, ref)
+    for _ in range(args.runs - 1):
+        if not args.save and not any(slower(n, r) for n, r in results.items()):
+            break
+        more, again = asyncio.run(measure(args))
+        ref = min(ref, again)
+        for name, res in more.items():
+            results[name]["ns"] = min(results[name]["ns"], res["ns"])
+        relate(results, ref)
+
+    if base_ref:
+        print(f"reference(): {ref:.0f} ns now, {base_ref:.0f} ns in the baseline;"
+              f" changes below allow for that")
+    regressed = []
+    print(f"{'stage':<24} {'ns/op':>9} {'base':>9} {'change':>7} {'alloc B':>8} {'base':>6}")
+    for name, res in results.items():
+        old = base.get(name)
+        flag = ""
+        if old:
+            # A few bytes either way is tracemalloc's own noise.
+            if (slower(name, res)
+                    or res["alloc_b"] > old["alloc_b"] * (1 + args.threshold) + 32):
+                flag = "  REGRESSED"
+                regressed.append(name)
+        change = f"{(res['rel'] / old['rel'] - 1) * 100:+.0f}%" if old else "-"
+        was = f"{old['ns']:.0f}" if old else "-"
+        print(f"{name:<24} {res['ns']:>9.0f} {was:>9}"
+              f" {change:>7} {res['alloc_b']:>8} {old['alloc_b'] if old else '-':>6}{flag}")
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump({"meta": meta(), "reference_ns": ref, "stages": results}, f, indent=2)
+            f.write("\n")
+        print(f"wrote {args.baseline}")
+    elif regressed:
+        print(f"\n{len(regressed)} regressed beyond {args.threshold:.0%}: {', '.join(regressed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,315 @@
+"""Matcher under synthetic load: arrivals, Next churn, topic skew and ghosts.
+
+tests/test_matcher.py checks what one pairing does and costs; this runs the
+matcher the way a live instance does, for --seconds of simulated traffic, and
+reports how it behaves. Each workload runs against Redis and in in-memory mode,
+under each MATCH_MODE (--modes: greedy head-first, or window matching), each
+run in a fresh process (store reads REDIS_URL at import), with store in-process
+and main.match_pass() driven exactly as matcher_loop drives it:
+
+  arrivals    Poisson, --rate new clients a second; each registers and sends
+              PAIRING_START (store.requeue) with 0-3 topics
+  topics      drawn from a Zipf law over the workload's topic count
+  ghosts      that share of arrivals drops its connection right after queueing
+              and stays in the pool, as after a crash, for the matcher to evict
+  sessions    a pair talks for an exponential time; then one side presses Next
+              (requeue) with the workload's probability, or else disconnects.
+              The other side, told PARTNER_LEFT, searches again with the same
+              probability, or else leaves too
+
+Workloads (--workloads, default all):
+
+  steady      200 topics at Zipf s=1.1, 5s sessions, Next 0.5, 5% ghosts
+  churn       1s sessions, Next 0.9: most traffic is re-queueing
+  niche       2000 topics at Zipf s=0.6: few shared interests
+  ghosts      30% ghosts
+
+Reported per run (the table, and with --json every figure plus the workload
+and matcher settings, to compare releases or matching algorithms):
+
+  pairs/s     pairs formed per second of the run
+  cap/s       pairs per second spent inside match_pass(): the matcher's headroom
+  p50/95/99   time to match, PAIRING_START to PARTNER_FOUND, ms
+  topic hit   pairs sharing a topic, of the pairs where both sides had topics
+  cmd/pair    Redis commands the whole workload sent, per pair (store's ledger)
+  match/pair  ...of which the matcher's own (locks, counts, _MATCH_LUA)
+  ghost prs   pairs that included a ghost: must be 0
+
+    redis-server --port 6390 --daemonize yes --save "" --appendonly no
+    python bench/bench_matcher_sim.py --json sim.json
+    python bench/bench_matcher_sim.py --workloads churn --rate 500 --rtt-ms 5
+    MATCH_HOLD_MS=1000 python bench/bench_matcher_sim.py --modes window --backends memory
+
+Env overrides: none; see --help.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import contextlib
+import subprocess
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault("REDIS_URL", "")      # the parent never connects; children get theirs
+os.environ["FLY_MACHINE_ID"] = "bench-sim"
+
+import logging  # noqa: E402
+import redis.asyncio as aioredis  # noqa: E402
+
+import store  # noqa: E402  (reads REDIS_URL at import: one process per backend)
+import matching  # noqa: E402
+import main as server  # noqa: E402  (match_pass, exactly as matcher_loop runs it)
+from latency_proxy import LatencyProxy  # noqa: E402
+
+logging.disable(logging.WARNING)
+
+WORKLOADS = {
+    "steady": {"topics": 200, "zipf": 1.1, "session_s": 5.0, "next": 0.5, "ghosts": 0.05},
+    "churn": {"topics": 200, "zipf": 1.1, "session_s": 1.0, "next": 0.9, "ghosts": 0.05},
+    "niche": {"topics": 2000, "zipf": 0.6, "session_s": 5.0, "next": 0.5, "ghosts": 0.05},
+    "ghosts": {"topics": 200, "zipf": 1.1, "session_s": 5.0, "next": 0.5, "ghosts": 0.3},
+}
+
+
+def percentile(sorted_values: list, q: float):
+    if not sorted_values:
+        return None
+    return sorted_values[int(q * (len(sorted_values) - 1))]
+
+
+class Sim:
+    """One run's clients, sessions and tallies."""
+
+    def __init__(self, params: dict, rng: random.Random):
+        self.p = params
+        self.rng = rng
+        weights = [1 / k ** params["zipf"] for k in range(1, params["topics"] + 1)]
+        self.cum = list(itertools.accumulate(weights))
+        self.topics: dict = {}          # ws_id -> its topics
+        self.queued_at: dict = {}       # ws_id -> when it last sent PAIRING_START
+        self.partner: dict = {}         # ws_id -> partner, as the client was told
+        self.ghosts: set = set()
+        self.ttm: list = []
+        self.arrivals = self.pairs = self.both_topics = self.hits = self.ghost_pairs = 0
+        self.tasks: set = set()
+        self.running = True
+
+    def pick_topics(self) -> list:
+        out = set()
+        for _ in range(self.rng.randrange(4)):
+            out.add(f"t{self.rng.choices(range(len(self.cum)), cum_weights=self.cum)[0]}")
+        return sorted(out)
+
+    def spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def search(self, ws_id: str):
+        self.partner.pop(ws_id, None)
+        self.queued_at[ws_id] = time.perf_counter()
+        await store.requeue(ws_id, self.topics[ws_id])
+
+    async def arrive(self):
+        ws_id = store.new_client_id()
+        self.arrivals += 1
+        self.topics[ws_id] = self.pick_topics()
+        await store.register_connection(ws_id)
+        await self.search(ws_id)
+        if self.rng.random() < self.p["ghosts"]:
+            # A ghost from here on: paired before this returns, it was still live.
+            await store.unregister_connection(ws_id)
+            self.ghosts.add(ws_id)
+
+    async def leave_or_next(self, ws_id: str):
+        if not self.running:
+            return
+        if self.rng.random() < self.p["next"]:
+            await self.search(ws_id)
+        else:
+            self.partner.pop(ws_id, None)
+            await store.disconnect(ws_id)
+
+    async def session(self, a: str, b: str):
+        await asyncio.sleep(self.rng.expovariate(1 / self.p["session_s"]))
+        if self.partner.get(a) == b:
+            await self.leave_or_next(self.rng.choice((a, b)))
+
+    async def deliver(self, ws_id, text, sender=None, news=None, stamp=None):
+        frame = json.loads(text)
+        if frame["name"] == "PARTNER_FOUND":
+            now = time.perf_counter()
+            self.partner[ws_id] = sender
+            if ws_id in self.queued_at:
+                self.ttm.append(now - self.queued_at.pop(ws_id))
+            if frame["data"] == "GO_FIRST":      # once per pair, to its older side
+                self.pairs += 1
+                if ws_id in self.ghosts or sender in self.ghosts:
+                    self.ghost_pairs += 1
+                if self.topics[ws_id] and self.topics[sender]:
+                    self.both_topics += 1
+                    self.hits += bool(set(self.topics[ws_id]) & set(self.topics[sender]))
+                self.spawn(self.session(ws_id, sender))
+        elif frame["name"] == "PARTNER_LEFT" and self.partner.pop(ws_id, None) == sender:
+            self.spawn(self.leave_or_next(ws_id))
+        return True
+
+
+async def drop(r):
+    keys = [k async for k in r.scan_iter(match=f"{store.PREFIX}:*", count=1000)]
+    for i in range(0, len(keys), 500):
+        await r.delete(*keys[i:i + 500])
+
+
+async def child(args):
+    """One workload against one backend; its figures as a JSON line on stdout."""
+    params = dict(WORKLOADS[args.workload], rate=args.rate, seconds=args.seconds)
+    sim = Sim(params, random.Random(args.seed))
+    backend = "memory" if store._inmemory_mode else "redis"
+    mode = store.MATCH_MODE
+    async with contextlib.AsyncExitStack() as stack:
+        if backend == "redis":
+            local = aioredis.from_url(f"redis://127.0.0.1:{args.redis_port}", decode_responses=True)
+            stack.push_async_callback(local.aclose)
+            await drop(local)
+            if args.rtt_ms:
+                proxy = await stack.enter_async_context(LatencyProxy(args.redis_port, args.rtt_ms))
+                os.environ["REDIS_URL"] = f"redis://127.0.0.1:{proxy.port}"
+            await store.connect()
+            stack.push_async_callback(drop, local)
+            stack.push_async_callback(store.close)
+        store.set_local_delivery(sim.deliver)
+        wake = asyncio.Event()
+        store.set_wakeup_callback(wake.set)
+        busy = [0.0]
+
+        async def matcher():
+            # matcher_loop, minus its idle check: woken by every PAIRING_START.
+            while True:
+                timeout = server.MATCH_POLL_SECONDS
+                if (due := store.match_due()) is not None:
+                    timeout = min(timeout, due)     # a window pass's held clients ripen
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(wake.wait(), timeout=timeout)
+                wake.clear()
+                start = time.perf_counter()
+                if await server.match_pass():
+                    wake.set()
+                busy[0] += time.perf_counter() - start
+
+        async def heartbeat():
+            while True:
+                await asyncio.sleep(store.LEASE_TTL / 3)
+                await store.renew_lease(list(sim.topics))
+
+        background = [asyncio.create_task(matcher()), asyncio.create_task(heartbeat())]
+        counts = store.command_counts()
+        start = time.perf_counter()
+        due = start
+        while (now := time.perf_counter()) < start + args.seconds:
+            while due <= now:
+                sim.spawn(sim.arrive())
+                due += sim.rng.expovariate(args.rate)
+            await asyncio.sleep(min(due, start + args.seconds) - now)
+        elapsed = time.perf_counter() - start
+        sim.running = False
+        for task in background + list(sim.tasks):
+            task.cancel()
+        await asyncio.gather(*background, *sim.tasks, return_exceptions=True)
+        after = store.command_counts()
+        left = sum(await store.waiting_counts())
+
+    sent = {op: after[op] - counts[op] for op in after}
+    ttm = sorted(sim.ttm)
+    pairs = max(sim.pairs, 1)
+    print(json.dumps({
+        "workload": args.workload, "backend": backend, "mode": mode, "params": params,
+        "arrivals": sim.arrivals, "pairs": sim.pairs, "seconds": round(elapsed, 3),
+        "pairs_per_s": sim.pairs / elapsed,
+        "capacity_pairs_per_s": sim.pairs / busy[0] if busy[0] else None,
+        "ttm_ms": {f"p{round(q * 100)}": percentile(ttm, q) * 1000 if ttm else None
+                   for q in (0.5, 0.95, 0.99)},
+        "topic_hit_rate": sim.hits / sim.both_topics if sim.both_topics else None,
+        "commands_per_pair": sum(sent.values()) / pairs,
+        "match_commands_per_pair": sent["match"] / pairs,
+        "commands": sent, "ghost_pairs": sim.ghost_pairs, "left_waiting": left,
+    }))
+
+
+def row(res: dict):
+    def f(v, spec):
+        return format(v, spec) if v is not None else "-"
+    ttm = res["ttm_ms"]
+    print(f"{res['workload']:>7} {res['backend']:>7} {res['mode']:>6} {res['pairs_per_s']:>8.1f}"
+          f" {f(res['capacity_pairs_per_s'], '.0f'):>8} {f(ttm['p50'], '.1f'):>7}"
+          f" {f(ttm['p95'], '.1f'):>7} {f(ttm['p99'], '.1f'):>7}"
+          f" {f(res['topic_hit_rate'], '.1%'):>9} {res['commands_per_pair']:>8.1f}"
+          f" {res['match_commands_per_pair']:>10.2f} {res['ghost_pairs']:>9}")
+
+
+def version() -> str:
+    out = subprocess.run(["git", "-C", BACKEND, "describe", "--always", "--dirty"],
+                         capture_output=True, text=True)
+    return out.stdout.strip() or None
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--redis-port", type=int, default=6390)
+    ap.add_argument("--rtt-ms", type=float, default=0.0,
+                    help="simulated Redis RTT via latency_proxy.py (0: direct)")
+    ap.add_argument("--workloads", default=",".join(WORKLOADS))
+    ap.add_argument("--backends", default="redis,memory")
+    ap.add_argument("--modes", default="greedy,window", help="MATCH_MODEs to compare")
+    ap.add_argument("--rate", type=float, default=100.0, help="arrivals per second")
+    ap.add_argument("--seconds", type=float, default=20.0)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", metavar="FILE", help="also write every figure here")
+    ap.add_argument("--workload", help=argparse.SUPPRESS)      # set in a child run
+    args = ap.parse_args()
+
+    if args.workload:
+        asyncio.run(child(args))
+        return
+    print(f"{args.rate:.0f} arrivals/s for {args.seconds:.0f}s, RTT {args.rtt_ms}ms")
+    print(f"{'load':>7} {'backend':>7} {'mode':>6} {'pairs/s':>8} {'cap/s':>8} {'p50 ms':>7} {'p95 ms':>7}"
+          f" {'p99 ms':>7} {'topic hit':>9} {'cmd/pair':>8} {'match/pair':>10} {'ghost prs':>9}")
+    results = []
+    for workload in args.workloads.split(","):
+        for backend in args.backends.split(","):
+            url = f"redis://127.0.0.1:{args.redis_port}" if backend == "redis" else ""
+            for mode in args.modes.split(","):
+                out = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--workload", workload,
+                     "--redis-port", str(args.redis_port), "--rtt-ms", str(args.rtt_ms),
+                     "--rate", str(args.rate), "--seconds", str(args.seconds),
+                     "--seed", str(args.seed)],
+                    env=dict(os.environ, REDIS_URL=url, MATCH_MODE=mode),
+                    check=True, capture_output=True, text=True,
+                ).stdout
+                results.append(json.loads(out.strip().splitlines()[-1]))
+                row(results[-1])
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({
+                "version": version(), "at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "rtt_ms": args.rtt_ms, "seed": args.seed,
+                "matcher": {"MATCH_WINDOW": store.MATCH_WINDOW, "MATCH_BATCH": store.MATCH_BATCH,
+                            "MATCH_SHARDS": store.MATCH_SHARDS,
+                            "CLIENT_LAYOUT": store.CLIENT_LAYOUT,
+                            "MATCH_HOLD_MS": matching.MATCH_HOLD_MS,
+                            "MATCH_MAX_WAIT_MS": matching.MATCH_MAX_WAIT_MS,
+                            "MATCH_SOLVE_MS": matching.MATCH_SOLVE_MS},
+                "results": results,
+            }, f, indent=2)
+        print(f"wrote {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Connection limiter engines: Redis memory per 100k IPs and sync script latency.
+
+Every RATE_LIMIT_ENGINE keeps the fleet-wide count per IP in a different shape
+(see store._RATE_SYNC_LUA): "zset" one member per admission, "gcra" one integer,
+"buckets" a three-field hash. This replays what a flood from many IPs leaves
+behind: each IP admitted --per-ip times, pushed in the 500-IP batches the sync
+uses, and reports
+
+  bytes/IP   used_memory growth divided by IPs ("n/a" if INFO memory is missing)
+  us/IP      Redis time per IP in a sync call (best of --repeat), against Redis
+             directly: no proxy, since this is work Redis does, not a round-trip
+
+    redis-server --port 6390 --daemonize yes --save "" --appendonly no
+    python bench/bench_rate_engines.py --ips 100000
+
+Env overrides: none; see --help.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["REDIS_URL"] = "redis://127.0.0.1:6390"    # real one set from --redis-port
+
+import logging  # noqa: E402
+
+import redis.asyncio as redis  # noqa: E402
+
+import store  # noqa: E402
+
+logging.disable(logging.INFO)
+
+BATCH = store.DISCONNECT_BATCH_MAX      # IPs per sync call, as _sync_rate_limits
+
+
+async def used_memory():
+    # Own connection: a server without INFO memory may drop it on the way out.
+    r = redis.from_url(os.environ["REDIS_URL"])
+    try:
+        return (await r.info("memory"))["used_memory"]
+    except Exception:
+        return None
+    finally:
+        await r.aclose()
+
+
+async def drop_rate_keys(r):
+    for tag in store._RATE_KEY_TAG.values():
+        keys = [k async for k in r.scan_iter(match=f"{store.PREFIX}:{tag}:*", count=1000)]
+        for i in range(0, len(keys), 500):
+            await r.delete(*keys[i:i + 500])
+
+
+async def measure(r, engine: str, args):
+    store.RATE_LIMIT_ENGINE = engine
+    script = store._RATE_SYNC_LUA[engine]
+    await drop_rate_keys(r)
+    before = await used_memory()
+    now = int(time.time() * 1000)
+    window = store.RATE_LIMIT_WINDOW * 1000
+    ips = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(args.ips)]
+    for i in range(0, len(ips), BATCH):
+        keys = [store.rate_key(ip) for ip in ips[i:i + BATCH]]
+        for k in range(args.per_ip):     # one sync per admission, as a flood arrives
+            await store._eval(script, len(keys), *keys, now + k, window,
+                              store.RATE_LIMIT_MAX, "bench", *[1] * len(keys))
+    after = await used_memory()
+
+    # Latency: one more admission for a batch of already-hot IPs.
+    keys = [store.rate_key(ip) for ip in ips[:BATCH]]
+    best = float("inf")
+    for k in range(args.repeat):
+        start = time.perf_counter()
+        await store._eval(script, len(keys), *keys, now + args.per_ip + k, window,
+                          store.RATE_LIMIT_MAX, "bench", *[1] * len(keys))
+        best = min(best, time.perf_counter() - start)
+    per_ip = "n/a" if before is None or after is None else f"{(after - before) / args.ips:.0f}"
+    print(f"{engine:>8} {per_ip:>9} {best / BATCH * 1e6:>7.2f}")
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--redis-port", type=int, default=6390)
+    ap.add_argument("--ips", type=int, default=100_000)
+    ap.add_argument("--per-ip", type=int, default=store.RATE_LIMIT_MAX,
+                    help="admissions per IP (default RATE_LIMIT_MAX: a full window)")
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    os.environ["REDIS_URL"] = f"redis://127.0.0.1:{args.redis_port}"
+    await store.connect()
+    r = store._redis
+    print(f"{args.ips} IPs, {args.per_ip} admissions each")
+    print(f"{'engine':>8} {'bytes/IP':>9} {'us/IP':>7}")
+    for engine in ("zset", "buckets", "gcra"):
+        await measure(r, engine, args)
+    await drop_rate_keys(r)
+    await store.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
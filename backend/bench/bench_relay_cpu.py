@@ -0,0 +1,95 @@
+"""CPU per relayed signaling frame: the parse/re-encode path versus the raw path.
+
+Relay used to json.loads every SDP/ICE frame to read its name and json.dumps
+it again in store.route(). It now reads the name with main._relay_name() and
+forwards the text untouched. This times just that step, per frame, both ways
+_relay_name can work (orjson if installed, else a scan), on frames shaped
+exactly as peer.js sends them (JSON.stringify of {name, data}, where data is
+itself a JSON string):
+
+    python bench/bench_relay_cpu.py
+
+No Redis or server needed: everything around this step is unchanged.
+
+Env overrides: none; see --help.
+"""
+import os
+import sys
+import json
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["REDIS_URL"] = ""    # in-memory: importing main must not need Redis
+
+import main  # noqa: E402
+
+
+def frame(name: str, data: dict) -> str:
+    # JSON.stringify: no whitespace, keys in insertion order.
+    return json.dumps({"name": name, "data": json.dumps(data, separators=(",", ":"))},
+                      separators=(",", ":"))
+
+
+def sdp(media_sections: int) -> str:
+    lines = ["v=0", "o=- 4611731400430051336 2 IN IP4 127.0.0.1", "s=-", "t=0 0",
+             "a=group:BUNDLE " + " ".join(str(i) for i in range(media_sections))]
+    for i in range(media_sections):
+        lines += [f"m=video 9 UDP/TLS/RTP/SAVPF {' '.join(str(96 + k) for k in range(16))}",
+                  "c=IN IP4 0.0.0.0", "a=rtcp:9 IN IP4 0.0.0.0",
+                  "a=ice-ufrag:EsAw", "a=ice-pwd:bP+XJMM09aR8AiX1jdukzR6Y",
+                  "a=fingerprint:sha-256 " + ":".join(["D2"] * 32),
+                  "a=setup:actpass", f"a=mid:{i}", "a=sendrecv", "a=rtcp-mux"]
+        lines += [f"a=rtpmap:{96 + k} VP8/90000" for k in range(16)]
+        lines += [f"a=rtcp-fb:{96 + k} nack pli" for k in range(16)]
+    return "\r\n".join(lines) + "\r\n"
+
+
+FRAMES = {
+    "ICE candidate": frame("SDP_ICE_CANDIDATE", {
+        "candidate": "candidate:842163049 1 udp 1677729535 203.0.113.7 54321 typ srflx "
+                     "raddr 192.168.1.20 rport 54321 generation 0 ufrag EsAw network-cost 999",
+        "sdpMid": "0", "sdpMLineIndex": 0, "usernameFragment": "EsAw"}),
+    "SDP offer": frame("SDP_OFFER", {"type": "offer", "sdp": sdp(3)}),
+}
+
+
+def main_():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--number", type=int, default=2000)
+    args = ap.parse_args()
+
+    # The largest frame the server accepts (MAX_MESSAGE_BYTES).
+    big = sdp(3)
+    while len(frame("SDP_OFFER", {"type": "offer", "sdp": big + big})) < main.MAX_MESSAGE_BYTES:
+        big += big
+    FRAMES["64KB SDP"] = frame("SDP_OFFER", {"type": "offer", "sdp": big})
+
+    def before(text):
+        data = json.loads(text)
+        if data.get("name") in main.ALLOWED_RELAY:
+            return json.dumps(data)
+
+    def after(text):
+        if main._relay_name(text)[0] is not None:
+            return text
+
+    def per_frame(fn, text):
+        best = min(timeit.repeat(lambda: fn(text), number=args.number, repeat=5))
+        return best / args.number * 1e6
+
+    installed = main.orjson
+    print(f"per frame, microseconds (orjson {'installed' if installed else 'not installed'})")
+    print(f"{'frame':>14} {'bytes':>7} {'before':>8} {'scan':>8} {'orjson':>8}")
+    for label, text in FRAMES.items():
+        assert main._relay_name(text)[0] is not None, label
+        main.orjson = None
+        scan = per_frame(after, text)
+        main.orjson = installed
+        fast = per_frame(after, text) if installed else float("nan")
+        print(f"{label:>14} {len(text):>7} {per_frame(before, text):>8.2f} {scan:>8.2f} "
+              f"{fast:>8.2f}")
+
+
+if __name__ == "__main__":
+    main_()
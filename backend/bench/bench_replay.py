@@ -0,0 +1,288 @@
+"""Signaling trace replay: recorded production traffic, played against local instances.
+
+Reads one or more TRACE_FILEs (see tracelog.py), merges them on their recorded
+wall-clock times, and plays every client in them back at --speed (1, 10, 100,
+...) against --instances copies of serve.py sharing one local Redis, or running
+ones given with --urls. Each recorded client becomes one socket, connecting at
+its recorded time:
+
+  P   PAIRING_START with the recorded topic hashes as its topics
+  F   waits for the real PARTNER_FOUND (as long as the recorded client waited,
+      and at least --timeout); what the client did after it is timed from that,
+      not from the recorded match
+  R   a relay of the recorded kind, padded to the recorded size
+  L   LEAVE     A  PAIRING_ABORT     D  disconnect
+      (X, the partner leaving, comes from the partner's own timeline)
+
+A step never runs before the one it followed, so when the server is slower than
+production the timeline stretches rather than reorders. --skip and --length
+pick a window of the trace, in trace seconds: a whole day at 100x is 14.4
+minutes, with the daily peak where it was. Clients already connected when the
+window opens are left out.
+
+Every --report-every seconds it prints the trace's clock (UTC), the clients
+connected, pairs and relays per (real) second, errors so far and each started
+instance's RSS. At the end, connect, match and relay latency percentiles as
+bench_ws_load.py reports them, the recorded pairings that found no partner in
+the replay, errors and close codes.
+
+The started instances get MSG_RATE and MSG_BURST scaled by --speed (unless
+set), so a compressed timeline is not throttled by the per-socket budget; the
+matcher, heartbeat and lease intervals run at their real rates.
+
+    redis-server --port 6390 --daemonize yes --save "" --appendonly no
+    python bench/bench_replay.py trace-a.log trace-b.log --speed 100 --instances 2
+    python bench/bench_replay.py trace.log --speed 10 --skip 64800 --length 3600
+
+Env overrides: none; see --help.
+"""
+import os
+import json
+import time
+import queue
+import asyncio
+import argparse
+import multiprocessing as mp
+from datetime import datetime, timezone
+
+from bench_ws_load import Tally, frame, percentiles, raise_nofile, rss_mb, start_instances
+
+CONNECTED, PAIRS, RELAYS, ERRORS = range(4)
+RELAY_NAMES = {"O": "SDP_OFFER", "A": "SDP_ANSWER", "I": "SDP_ICE_CANDIDATE"}
+SENT = {"L": json.dumps({"name": "LEAVE"}), "A": json.dumps({"name": "PAIRING_ABORT"})}
+
+
+def load(paths: list, skip: float, length: float) -> tuple:
+    """Every client whose C falls in the window, as (start, [(t, event, arg)]),
+    t in seconds from the window's start; and the window's start (epoch s)."""
+    timelines = {}
+    for fi, path in enumerate(paths):
+        run, start = -1, None
+        with open(path, encoding="ascii") as f:
+            for line in f:
+                if line.startswith("#"):
+                    run += 1
+                    fields = dict(kv.split("=", 1) for kv in line.split()[2:] if "=" in kv)
+                    start = int(fields["start"]) / 1000
+                    continue
+                parts = line.split()
+                if start is None or len(parts) < 3 or not parts[0].isdigit():
+                    continue    # a torn last line
+                timelines.setdefault((fi, run, parts[1]), []).append(
+                    (start + int(parts[0]) / 1000, parts[2], parts[3] if len(parts) > 3 else ""))
+    if not timelines:
+        return [], 0.0
+    opens = min(events[0][0] for events in timelines.values()) + skip
+    closes = opens + length
+    clients = []
+    for events in timelines.values():
+        if events[0][1] != "C" or not opens <= events[0][0] < closes:
+            continue
+        clients.append([(t - opens, e, arg) for t, e, arg in events if t < closes])
+    clients.sort(key=lambda events: events[0][0])
+    return clients, opens
+
+
+def relay(kind: str, size: int) -> str:
+    """A relayable frame of the recorded kind and length, carrying its send time."""
+    data = {"t": time.time(), "pad": ""}
+    data["pad"] = "x" * max(0, size - len(frame(RELAY_NAMES[kind], data)))
+    return frame(RELAY_NAMES[kind], data)
+
+
+async def until(when: float) -> None:
+    delay = when - time.time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+async def replay(idx: int, url: str, events: list, origin: float, end: float, args,
+                 stats, tally: Tally) -> None:
+    """One recorded client's timeline, on its own socket."""
+    from websockets.asyncio.client import connect
+    from websockets.exceptions import ConnectionClosed
+
+    ip = f"10.{idx >> 16 & 255}.{idx >> 8 & 255}.{idx & 255}"
+    started = time.time()
+    try:
+        ws = await connect(url, additional_headers={"Fly-Client-IP": ip},
+                           max_size=None, open_timeout=args.timeout)
+    except Exception as e:
+        tally.errors[f"connect {type(e).__name__}"] += 1
+        stats[ERRORS] += 1
+        return
+    tally.connect.append(time.time() - started)
+    stats[CONNECTED] += 1
+    found = asyncio.Event()
+    pairing_at, found_at = [None], [0.0]
+
+    async def read():
+        async for text in ws:
+            msg = json.loads(text)
+            if msg["name"] == "PARTNER_FOUND":
+                found_at[0] = time.time()
+                if pairing_at[0] is not None:
+                    tally.match.append(found_at[0] - pairing_at[0])
+                    pairing_at[0] = None
+                if msg["data"] == "GO_FIRST":
+                    stats[PAIRS] += 1
+                found.set()
+            elif msg["name"] in ("SDP_OFFER", "SDP_ANSWER", "SDP_ICE_CANDIDATE"):
+                tally.relay.append(time.time() - json.loads(msg["data"])["t"])
+                stats[RELAYS] += 1
+            elif msg["name"] in ("RATE_LIMITED", "SERVER_UNAVAILABLE"):
+                tally.errors[msg["name"]] += 1
+
+    reader = asyncio.create_task(read())
+    # Recorded time t runs at real time at_real + (t - at_trace) / speed.
+    at_real, at_trace = time.time(), events[0][0]
+    try:
+        for i, (t, event, arg) in enumerate(events):
+            if event in "CX":
+                continue
+            if event == "F":
+                # As long as the recorded client waited, and at least --timeout.
+                nxt = next((e[0] for e in events[i + 1:] if e[1] in "PD"), end)
+                wait = max(at_real + (nxt - at_trace) / args.speed, at_real + args.timeout)
+                try:
+                    await asyncio.wait_for(found.wait(), wait - time.time())
+                    at_real, at_trace = found_at[0], t
+                except asyncio.TimeoutError:
+                    tally.unmatched += 1
+                continue
+            await until(at_real + (t - at_trace) / args.speed)
+            if event == "P":
+                found.clear()
+                pairing_at[0] = at_real = time.time()
+                at_trace = t
+                await ws.send(json.dumps({"name": "PAIRING_START",
+                                          "topics": arg.split(",") if arg else []}))
+            elif event == "R":
+                await ws.send(relay(arg[0], int(arg[1:])))
+            elif event in SENT:
+                await ws.send(SENT[event])
+            elif event == "D":
+                break
+        else:
+            await until(at_real + (end - at_trace) / args.speed)
+    except ConnectionClosed as e:
+        tally.closes[e.rcvd.code if e.rcvd else "none"] += 1
+        stats[ERRORS] += 1
+    finally:
+        stats[CONNECTED] -= 1
+        reader.cancel()
+        await asyncio.gather(reader, return_exceptions=True)
+        await ws.close()
+
+
+def client_proc(clients: list, urls: list, origin: float, end: float, args, stats, results):
+    raise_nofile()
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    tally = Tally()
+    tally.unmatched = 0
+
+    async def run():
+        # Started as their time comes, not all up front: a day's trace is
+        # millions of clients, and only the connected ones need a task.
+        tasks = set()
+        for idx, events in clients:
+            await until(origin + events[0][0] / args.speed)
+            task = asyncio.create_task(replay(idx, urls[idx % len(urls)], events, origin, end,
+                                              args, stats, tally))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    results.put(tally)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("traces", nargs="+", help="TRACE_FILEs, merged on their recorded times")
+    ap.add_argument("--speed", type=float, default=10.0, help="1: real time; 10, 100: faster")
+    ap.add_argument("--skip", type=float, default=0.0, help="trace seconds to skip")
+    ap.add_argument("--length", type=float, default=float("inf"), help="trace seconds to play")
+    ap.add_argument("--urls", help="comma-separated ws:// URLs of running instances")
+    ap.add_argument("--instances", type=int, default=1, help="serve.py instances to start")
+    ap.add_argument("--port", type=int, default=8200, help="first started instance's port")
+    ap.add_argument("--redis-port", type=int, default=6390, help="0: in-memory, one instance")
+    ap.add_argument("--client-procs", type=int, default=4)
+    ap.add_argument("--timeout", type=float, default=10.0,
+                    help="connect timeout, and the least wait for a recorded match")
+    ap.add_argument("--report-every", type=float, default=5.0)
+    args = ap.parse_args()
+
+    clients, opens = load(args.traces, args.skip, args.length)
+    if not clients:
+        ap.error("no client connects in that window of the trace")
+    end = min(args.length, max(events[-1][0] for events in clients) + 1)
+    print(f"{len(clients)} clients, {end:.0f} trace seconds from"
+          f" {datetime.fromtimestamp(opens, timezone.utc):%Y-%m-%d %H:%M:%S} UTC,"
+          f" at {args.speed:g}x: {end / args.speed:.0f}s")
+
+    raise_nofile()
+    os.environ.setdefault("MSG_RATE", f"{20 * args.speed:g}")
+    os.environ.setdefault("MSG_BURST", f"{40 * args.speed:g}")
+    servers = [] if args.urls else start_instances(args)
+    urls = args.urls.split(",") if args.urls else [
+        f"ws://127.0.0.1:{args.port + i}/api/matchmaking" for i in range(args.instances)]
+    try:
+        procs = min(args.client_procs, len(clients))
+        stats = [mp.Array("q", 4, lock=False) for _ in range(procs)]
+        results = mp.Queue()
+        origin = time.time() + 1.0
+        workers = [mp.Process(target=client_proc,
+                              args=(list(enumerate(clients))[p::procs], urls, origin, end, args,
+                                    stats[p], results))
+                   for p in range(procs)]
+        for w in workers:
+            w.start()
+
+        print(f"{'t s':>5} {'trace UTC':>9} {'connected':>9} {'pairs/s':>8} {'relays/s':>9}"
+              f" {'errors':>7} {'RSS MB':>12}")
+        tallies, last, reported = [], [0] * 4, origin
+        while len(tallies) < len(workers):
+            try:
+                tallies.append(results.get(timeout=max(0.0, reported + args.report_every
+                                                       - time.time())))
+                continue
+            except queue.Empty:
+                pass
+            now, reported = [sum(s[k] for s in stats) for k in range(4)], time.time()
+            clock = datetime.fromtimestamp(opens + (reported - origin) * args.speed, timezone.utc)
+            rss = "+".join(f"{rss_mb(s.pid):.0f}" for s in servers) or "-"
+            print(f"{reported - origin:>5.0f} {clock:%H:%M:%S} {now[CONNECTED]:>9}"
+                  f" {(now[PAIRS] - last[PAIRS]) / args.report_every:>8.1f}"
+                  f" {(now[RELAYS] - last[RELAYS]) / args.report_every:>9.1f}"
+                  f" {now[ERRORS]:>7} {rss:>12}")
+            last = now
+        for w in workers:
+            w.join()
+    finally:
+        for s in servers:
+            s.terminate()
+            s.wait()
+
+    total = Tally()
+    for t in tallies:
+        total.connect += t.connect
+        total.match += t.match
+        total.relay += t.relay
+        total.errors.update(t.errors)
+        total.closes.update(t.closes)
+    print(f"\n{'':>8} {'n':>8}  p50 / p95 / p99 ms")
+    for name in ("connect", "match", "relay"):
+        values = getattr(total, name)
+        print(f"{name:>8} {len(values):>8}  {percentiles(values)}")
+    print(f"unmatched: {sum(t.unmatched for t in tallies)} recorded pairings found no partner")
+    print(f"errors: {dict(total.errors) or 'none'}")
+    print(f"closes: {dict(total.closes) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
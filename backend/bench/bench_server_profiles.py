@@ -0,0 +1,184 @@
+"""Relay throughput and event-loop lag per server profile (loop / http / ws).
+
+Starts serve.py once per profile, in-memory mode (no Redis), pinned to one CPU
+like the shared-cpu-1x VM in fly.toml. Pairs --pairs couples of clients on it
+and has them trade ICE-sized frames for --seconds. Each socket keeps --window
+frames in flight by answering every frame it receives with one of its own, so
+the server is saturated but no outbound queue ever fills. Reports
+
+  msgs/s     frames relayed per second, server-wide
+  per cpu-s  the same per second of CPU the server process used (/proc): what
+             one dedicated vCPU would sustain, however busy the machine is
+  lag p50/p99/max   the loop's scheduling delay during the run, from the
+             server's own yawnfox_loop_lag_seconds (bucket bounds, so "<= x")
+
+The clients run in --client-procs processes kept off the server's CPU when the
+machine has more than one. On a single-CPU machine they share it: msgs/s and lag
+then depend on the scheduler, and "per cpu-s" is the figure to compare.
+
+    python bench/bench_server_profiles.py
+    python bench/bench_server_profiles.py --profiles asyncio/h11/wsproto,uvloop/httptools/websockets
+
+Env overrides: none; see --help.
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import asyncio
+import argparse
+import subprocess
+import urllib.request
+import multiprocessing as mp
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROFILES = ("asyncio/h11/wsproto", "asyncio/h11/websockets",
+            "uvloop/httptools/wsproto", "uvloop/httptools/websockets")
+
+ICE = json.dumps({"name": "SDP_ICE_CANDIDATE", "data": {
+    "candidate": "candidate:842163049 1 udp 1677729535 203.0.113.7 54321 typ srflx "
+                 "raddr 10.0.0.2 rport 54321 generation 0 ufrag abcd network-cost 999",
+    "sdpMid": "0", "sdpMLineIndex": 0}})
+
+
+def start_server(profile: str, port: int, cpu: int) -> subprocess.Popen:
+    loop, http, ws = profile.split("/")
+    env = dict(os.environ, REDIS_URL="", PORT=str(port), SERVER_LOOP=loop,
+               SERVER_HTTP=http, SERVER_WS=ws,
+               # Nothing here is abuse: lift the per-socket and per-IP budgets.
+               MSG_RATE="1e9", MSG_BURST="1e9", RATE_LIMIT_MAX="1000000")
+    cmd = [sys.executable, "serve.py"]
+    if shutil.which("taskset"):
+        cmd = ["taskset", "-c", str(cpu)] + cmd
+    proc = subprocess.Popen(cmd, cwd=BACKEND, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/ping", timeout=1).read()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"{profile}: server did not come up on port {port}")
+
+
+def cpu_seconds(pid: int) -> float:
+    """User + system CPU time of a process so far (Linux)."""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def lag_buckets(port: int) -> dict:
+    """le -> cumulative count of yawnfox_loop_lag_seconds, from /metrics."""
+    text = urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5).read().decode()
+    out = {}
+    for line in text.splitlines():
+        if line.startswith("yawnfox_loop_lag_seconds_bucket"):
+            le = line.split('le="', 1)[1].split('"', 1)[0]
+            out[float(le)] = int(float(line.rsplit(" ", 1)[1]))
+    return out
+
+
+def quantile(before: dict, after: dict, q: float) -> float:
+    bounds = sorted(after)
+    total = after[bounds[-1]] - before.get(bounds[-1], 0)
+    for b in bounds:
+        if after[b] - before.get(b, 0) >= q * total and total:
+            return b
+    return 0.0
+
+
+async def drive(port: int, pairs: int, window: int, seconds: float, barrier) -> int:
+    from websockets.asyncio.client import connect
+
+    url = f"ws://127.0.0.1:{port}/api/matchmaking"
+    socks = [await connect(url, max_size=None) for _ in range(2 * pairs)]
+    for ws in socks:
+        await ws.send(json.dumps({"name": "PAIRING_START", "topics": []}))
+    for ws in socks:                    # everyone here is paired with someone
+        while json.loads(await ws.recv()).get("name") != "PARTNER_FOUND":
+            pass
+    await asyncio.to_thread(barrier.wait)
+    end = time.monotonic() + seconds
+    received = 0
+
+    async def echo(ws):
+        nonlocal received
+        for _ in range(window):
+            await ws.send(ICE)
+        while time.monotonic() < end:
+            try:
+                await asyncio.wait_for(ws.recv(), end - time.monotonic())
+            except asyncio.TimeoutError:
+                break
+            received += 1
+            await ws.send(ICE)
+
+    await asyncio.gather(*(echo(ws) for ws in socks))
+    for ws in socks:
+        await ws.close()
+    return received
+
+
+def client_proc(port, pairs, window, seconds, barrier, server_cpu, results):
+    cpus = os.sched_getaffinity(0) - {server_cpu}
+    if cpus:
+        os.sched_setaffinity(0, cpus)
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    results.put(asyncio.run(drive(port, pairs, window, seconds, barrier)))
+
+
+def run(profile: str, args, port: int) -> None:
+    server = start_server(profile, port, args.server_cpu)
+    try:
+        procs = args.client_procs
+        barrier = mp.Barrier(procs + 1)
+        results = mp.Queue()
+        workers = [mp.Process(target=client_proc,
+                              args=(port, args.pairs // procs, args.window, args.seconds,
+                                    barrier, args.server_cpu, results)) for _ in range(procs)]
+        for w in workers:
+            w.start()
+        barrier.wait()
+        before = lag_buckets(port)
+        start, cpu = time.monotonic(), cpu_seconds(server.pid)
+        received = sum(results.get() for _ in workers)
+        elapsed, cpu = time.monotonic() - start, cpu_seconds(server.pid) - cpu
+        after = lag_buckets(port)
+        for w in workers:
+            w.join()
+        p50, p99, top = (quantile(before, after, q) * 1000 for q in (0.5, 0.99, 1.0))
+        print(f"{profile:<30} {received / elapsed:>9.0f} {received / cpu:>10.0f}"
+              f" {p50:>8.1f} {p99:>8.1f} {top:>8.1f}")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--profiles", default=",".join(PROFILES),
+                    help="comma-separated loop/http/ws triples")
+    ap.add_argument("--pairs", type=int, default=50)
+    ap.add_argument("--window", type=int, default=8, help="frames in flight per socket")
+    ap.add_argument("--seconds", type=float, default=10.0)
+    ap.add_argument("--client-procs", type=int, default=2)
+    ap.add_argument("--server-cpu", type=int, default=0)
+    ap.add_argument("--port", type=int, default=8190)
+    args = ap.parse_args()
+
+    print(f"{args.pairs} pairs, {args.window} frames in flight per socket, {args.seconds:.0f}s each")
+    print(f"{'profile':<30} {'msgs/s':>9} {'per cpu-s':>10} {'lag p50':>8} {'p99 ms':>8}"
+          f" {'max ms':>8}")
+    for i, profile in enumerate(args.profiles.split(",")):
+        run(profile.strip(), args, args.port + i)
+
+
+if __name__ == "__main__":
+    main()
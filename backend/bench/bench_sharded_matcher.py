@@ -0,0 +1,128 @@
+"""Matching throughput versus instance count, for the sharded waiting pool.
+
+Seeds a pool of live waiters, then starts K matcher processes at once — each a
+stand-in for one Fly machine, running main.match_pass() exactly as matcher_loop
+does — and times how long the fleet takes to pair everyone. Redis is reached
+through bench/latency_proxy.py, because matching is round-trip bound: against a
+bare local server every configuration looks instant.
+
+    redis-server --port 6390 --daemonize yes --save "" --appendonly no
+    python bench/bench_sharded_matcher.py --shards 8 --instances 1,2,4,8
+
+With one shard the fleet is capped by the single lock and pairs/s stays flat as
+instances are added; with MATCH_SHARDS >= instances it should rise with them.
+
+Env overrides: none; see --help.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import multiprocessing as mp
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import redis.asyncio as aioredis  # noqa: E402
+
+import store  # noqa: E402  (key helpers only: this process never connects)
+from latency_proxy import LatencyProxy  # noqa: E402
+
+
+def worker(idx: int, go, done):
+    # REDIS_URL, FLY_MACHINE_ID and MATCH_SHARDS arrive in the environment the
+    # parent set before spawning: store reads them at import time, and a spawned
+    # child re-imports this module (and with it store) before running this.
+    import logging
+    logging.disable(logging.INFO)
+    import main
+    import store
+
+    async def run():
+        await store.connect()
+        go.wait()
+        idle = 0
+        # Keep passing until the pool has been empty for a while: another
+        # instance may still hand back work (a stopped pass, a lost lock).
+        while idle < 20:
+            if await main.match_pass() or sum(await store.waiting_counts()) >= 2:
+                idle = 0
+            else:
+                idle += 1
+                await asyncio.sleep(0.01)
+        await store.close()
+
+    asyncio.run(run())
+    done.put(idx)
+
+
+async def seed(url: str, waiters: int, topics: int):
+    r = aioredis.from_url(url, decode_responses=True)
+    keys = [k async for k in r.scan_iter(match=f"{store.PREFIX}:*", count=1000)]
+    for i in range(0, len(keys), 500):
+        await r.delete(*keys[i:i + 500])
+    rng = random.Random(1)
+    pipe = r.pipeline(transaction=False)
+    for i in range(waiters):
+        ws_id = f"w{i:06d}"
+        mine = [f"t{rng.randrange(topics)}"] if topics and rng.random() < 0.5 else []
+        pipe.zadd(store.waiting_key(store.shard_for(ws_id, mine)), {ws_id: i})
+        pipe.set(store.conn_key(ws_id), "bench")
+        if mine:
+            pipe.sadd(store.topics_key(ws_id), *mine)
+    pipe.set(store.lease_key("bench"), 1)     # what makes the "bench" clients live
+    await pipe.execute()
+    await r.aclose()
+
+
+async def measure(args, instances: int) -> float:
+    local = f"redis://127.0.0.1:{args.redis_port}"
+    await seed(local, args.waiters, args.topics)
+    async with LatencyProxy(args.redis_port, args.rtt_ms) as proxy:
+        ctx = mp.get_context("spawn")
+        go, done = ctx.Event(), ctx.Queue()
+        procs = []
+        for i in range(instances):
+            os.environ.update(REDIS_URL=f"redis://127.0.0.1:{proxy.port}",
+                              FLY_MACHINE_ID=f"bench-{i}", MATCH_SHARDS=str(args.shards))
+            procs.append(ctx.Process(target=worker, args=(i, go, done)))
+            procs[-1].start()
+        await asyncio.sleep(1.5)            # let every process import and connect
+        r = aioredis.from_url(local, decode_responses=True)
+        keys = [store.waiting_key(s) for s in range(args.shards)]
+        start = time.perf_counter()
+        go.set()
+        while sum([await r.zcard(k) for k in keys]) >= 2:
+            await asyncio.sleep(0.005)
+        elapsed = time.perf_counter() - start
+        await r.aclose()
+        for _ in procs:
+            await asyncio.to_thread(done.get)
+        for p in procs:
+            p.join()
+    return elapsed
+
+
+async def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--redis-port", type=int, default=6390)
+    ap.add_argument("--rtt-ms", type=float, default=5.0, help="simulated Redis RTT")
+    ap.add_argument("--waiters", type=int, default=2000)
+    ap.add_argument("--topics", type=int, default=40, help="distinct topics (0 = none)")
+    ap.add_argument("--shards", type=int, default=8)
+    ap.add_argument("--instances", default="1,2,4,8")
+    args = ap.parse_args()
+    store.MATCH_SHARDS = args.shards
+
+    print(f"{args.waiters} waiters, {args.shards} shard(s), RTT {args.rtt_ms}ms")
+    print(f"{'instances':>10} {'seconds':>9} {'pairs/s':>9}")
+    for k in [int(x) for x in args.instances.split(",")]:
+        elapsed = await measure(args, k)
+        print(f"{k:>10} {elapsed:>9.2f} {args.waiters / 2 / elapsed:>9.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,100 @@
+"""Pub/sub listener throughput while some clients have stopped reading.
+
+Drives main.deliver_local() exactly as store.pubsub_listener() does, one frame
+at a time and awaited, across a set of sockets of which a few never complete a
+write (a client whose TCP send buffer is full). It then reports how fast the
+listener gets through the frames and how long the healthy clients take to
+receive theirs.
+
+    python bench/bench_slow_consumer.py
+
+"inline" is the old delivery, which awaited each socket write from the listener
+itself. A single stalled client stops it dead, which is reported as "stalled".
+"queued" is the per-socket writer. Its rate should not move as stalled clients
+are added. With nothing stalled it trails "inline", by one task switch per frame.
+That gap only shows because these fake writes cost nothing; a real websocket
+write costs more than the switch does.
+
+No Redis or server needed.
+
+Env overrides: none; see --help.
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["REDIS_URL"] = ""    # in-memory: importing main must not need Redis
+
+import main  # noqa: E402
+
+
+class FakeSocket:
+    """Stands in for a Starlette WebSocket: a write costs one loop turn, or never ends."""
+
+    def __init__(self, stalled: bool):
+        self.stalled = stalled
+        self.received = 0
+
+    async def send_text(self, text):
+        if self.stalled:
+            await asyncio.Event().wait()
+        await asyncio.sleep(0)
+        self.received += 1
+
+    async def close(self):
+        pass
+
+
+async def run(clients: int, stalled: int, frames: int, inline: bool):
+    main.local_websockets.clear()
+    socks = {}
+    for i in range(clients):
+        ws_id = f"c{i}"
+        socks[ws_id] = FakeSocket(stalled=i < stalled)
+        main.local_websockets[ws_id] = main.ManagedWebSocket(socks[ws_id], ws_id)
+    ids = list(socks)
+    healthy = frames - sum(1 for n in range(frames) if n % clients < stalled)
+
+    async def listener():
+        for n in range(frames):
+            ws_id = ids[n % clients]
+            if inline:
+                await socks[ws_id].send_text("{}")
+            else:
+                await main.deliver_local(ws_id, "{}")
+
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(listener(), timeout=5)
+        while sum(s.received for s in socks.values()) < healthy:
+            await asyncio.sleep(0.001)
+        took = time.perf_counter() - start
+        result = f"{frames / took:>12,.0f}"
+    except asyncio.TimeoutError:
+        result = f"{'stalled':>12}"
+    for ws in main.local_websockets.values():
+        await ws.safe_close()
+    return result
+
+
+async def amain():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--clients", type=int, default=200)
+    ap.add_argument("--frames", type=int, default=50_000)
+    ap.add_argument("--stalled", default="0,1,5,20")
+    args = ap.parse_args()
+    # A stalled socket is evicted after OUTBOUND_MAX_FRAMES; with the defaults
+    # this run ends first, so the listener has to live with them throughout.
+    print(f"{args.clients} clients, {args.frames} frames; frames/s delivered")
+    print(f"{'stalled':>8} {'inline':>12} {'queued':>12}")
+    for k in [int(x) for x in args.stalled.split(",")]:
+        inline = await run(args.clients, k, args.frames, inline=True)
+        queued = await run(args.clients, k, args.frames, inline=False)
+        print(f"{k:>8} {inline} {queued}")
+
+
+if __name__ == "__main__":
+    asyncio.run(amain())
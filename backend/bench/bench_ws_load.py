@@ -0,0 +1,292 @@
+"""WebSocket load: many clients running whole signaling sessions against the server.
+
+Starts --instances copies of serve.py sharing one local Redis (or attaches to
+running ones with --urls) and opens --clients sockets over --ramp seconds,
+spread across --client-procs processes and the instances. Every client runs the
+real protocol, over and over, for --seconds:
+
+  PAIRING_START with 0-3 of 20 topics, then waits for PARTNER_FOUND
+  GO_FIRST sends an SDP_OFFER and --ice SDP_ICE_CANDIDATEs; WAIT answers the
+  offer with an SDP_ANSWER and --ice of its own
+  both talk for --talk seconds; GO_FIRST sends LEAVE, WAIT hears PARTNER_LEFT,
+  and both start over
+
+Each client connects as its own Fly-Client-IP, so the per-IP connection limit
+never applies; the per-socket message budget (MSG_RATE) is the server's own.
+Every --report-every seconds it prints the clients connected, pairs and relays
+per second, errors so far and each started instance's RSS. At the end:
+
+  connect     TCP + WebSocket handshake, ms
+  match       PAIRING_START sent to PARTNER_FOUND received, ms
+  relay       a signaling frame's send to its arrival at the partner, ms
+  errors      by exception type, plus RATE_LIMITED / SERVER_UNAVAILABLE frames
+  closes      server close codes
+
+To find fly.toml's soft_limit: one instance (the VM's size and CPU, e.g. under
+taskset), and --clients raised run by run until match or relay p99 or the
+error count turns. The limit belongs comfortably below that knee.
+
+    redis-server --port 6390 --daemonize yes --save "" --appendonly no
+    python bench/bench_ws_load.py --instances 2 --clients 5000
+    python bench/bench_ws_load.py --urls ws://127.0.0.1:8001/api/matchmaking --clients 20000
+
+Past ~28k sockets to one server port from 127.0.0.1 the ephemeral ports run out:
+widen net.ipv4.ip_local_port_range, or use more instances. The open-file limit
+is raised to its hard limit for the servers and the clients.
+
+Env overrides: none; see --help.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import subprocess
+import urllib.request
+import multiprocessing as mp
+from collections import Counter
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TOPICS = [f"topic{i}" for i in range(20)]
+CONNECTED, PAIRS, RELAYS, ERRORS = range(4)
+
+# A browser-sized SDP (~3 KB), and an ICE candidate as peer.js sends it: data is
+# the JSON text of the object, and "t" carries the send time for the latency.
+SDP = "v=0\r\no=- 4611731400430051336 2 IN IP4 127.0.0.1\r\ns=-\r\nt=0 0\r\n" + "".join(
+    f"a=candidate:{i} 1 udp 2122260223 192.0.2.{i} 5{i:04d} typ host generation 0\r\n"
+    for i in range(40))
+CANDIDATE = ("candidate:842163049 1 udp 1677729535 203.0.113.7 54321 typ srflx raddr 10.0.0.2 "
+             "rport 54321 generation 0 ufrag abcd network-cost 999")
+
+
+def frame(name: str, data=None) -> str:
+    # Compact, "name" first: the shape the server's relay fast path expects.
+    out = {"name": name} if data is None else {"name": name, "data": json.dumps(data)}
+    return json.dumps(out, separators=(",", ":"))
+
+
+def signal(name: str) -> str:
+    if name == "SDP_ICE_CANDIDATE":
+        return frame(name, {"candidate": CANDIDATE, "sdpMid": "0", "sdpMLineIndex": 0,
+                            "t": time.time()})
+    return frame(name, {"type": "offer" if name == "SDP_OFFER" else "answer", "sdp": SDP,
+                        "t": time.time()})
+
+
+def raise_nofile() -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def rss_mb(pid: int) -> float:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def start_instances(args) -> list:
+    procs = []
+    redis_url = f"redis://127.0.0.1:{args.redis_port}" if args.redis_port else ""
+    for i in range(args.instances):
+        port = args.port + i
+        env = dict(os.environ, REDIS_URL=redis_url, PORT=str(port), FLY_MACHINE_ID=f"load-{i}")
+        proc = subprocess.Popen([sys.executable, "serve.py"], cwd=BACKEND, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        procs.append(proc)
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/ping", timeout=1).read()
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            raise RuntimeError(f"instance {i} did not come up on port {port}")
+    return procs
+
+
+class Tally:
+    """One client process's latencies and failures."""
+
+    def __init__(self):
+        self.connect, self.match, self.relay = [], [], []
+        self.errors, self.closes = Counter(), Counter()
+
+
+async def session(ws, rng, args, stats, tally: Tally) -> None:
+    """One PAIRING_START to LEAVE round. Raises on a closed socket or a timeout."""
+    started = time.perf_counter()
+    await ws.send(json.dumps({"name": "PAIRING_START",
+                              "topics": rng.sample(TOPICS, rng.randrange(4))}))
+    while True:
+        msg = json.loads(await asyncio.wait_for(ws.recv(), args.timeout))
+        if msg["name"] == "PARTNER_FOUND":
+            break
+        if msg["name"] in ("RATE_LIMITED", "SERVER_UNAVAILABLE"):
+            tally.errors[msg["name"]] += 1
+    tally.match.append(time.perf_counter() - started)
+    go_first = msg["data"] == "GO_FIRST"
+    if go_first:
+        stats[PAIRS] += 1
+        for name in ["SDP_OFFER"] + ["SDP_ICE_CANDIDATE"] * args.ice:
+            await ws.send(signal(name))
+    expected = 1 + args.ice
+    while expected:
+        msg = json.loads(await asyncio.wait_for(ws.recv(), args.timeout))
+        if msg["name"] == "PARTNER_LEFT":
+            tally.errors["left mid-setup"] += 1
+            return
+        if msg["name"] not in ("SDP_OFFER", "SDP_ANSWER", "SDP_ICE_CANDIDATE"):
+            continue
+        tally.relay.append(time.time() - json.loads(msg["data"])["t"])
+        stats[RELAYS] += 1
+        expected -= 1
+        if msg["name"] == "SDP_OFFER":
+            for name in ["SDP_ANSWER"] + ["SDP_ICE_CANDIDATE"] * args.ice:
+                await ws.send(signal(name))
+    await asyncio.sleep(args.talk)
+    if go_first:
+        await ws.send(json.dumps({"name": "LEAVE"}))
+        return
+    while json.loads(await asyncio.wait_for(ws.recv(), args.timeout))["name"] != "PARTNER_LEFT":
+        pass
+
+
+async def client(idx: int, url: str, delay: float, end: float, args, stats, tally: Tally):
+    from websockets.asyncio.client import connect
+    from websockets.exceptions import ConnectionClosed
+
+    rng = random.Random(idx)
+    ip = f"10.{idx >> 16 & 255}.{idx >> 8 & 255}.{idx & 255}"
+    await asyncio.sleep(delay)
+    while time.monotonic() < end:
+        started = time.perf_counter()
+        try:
+            ws = await connect(url, additional_headers={"Fly-Client-IP": ip},
+                               max_size=None, open_timeout=args.timeout)
+        except Exception as e:
+            tally.errors[f"connect {type(e).__name__}"] += 1
+            stats[ERRORS] += 1
+            await asyncio.sleep(1)
+            continue
+        tally.connect.append(time.perf_counter() - started)
+        stats[CONNECTED] += 1
+        try:
+            while time.monotonic() < end:
+                await session(ws, rng, args, stats, tally)
+        except ConnectionClosed as e:
+            tally.closes[e.rcvd.code if e.rcvd else "none"] += 1
+            stats[ERRORS] += 1
+        except asyncio.TimeoutError:
+            if time.monotonic() < end:      # not a round begun as everyone stopped
+                tally.errors["timeout"] += 1
+                stats[ERRORS] += 1
+        finally:
+            stats[CONNECTED] -= 1
+            await ws.close()
+
+
+def client_proc(first: int, count: int, urls: list, args, stats, results):
+    raise_nofile()
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    tally = Tally()
+    start = time.monotonic()
+
+    async def run():
+        end = start + args.seconds
+        await asyncio.gather(*(
+            client(i, urls[i % len(urls)], args.ramp * (i - first) / max(count, 1), end,
+                   args, stats, tally)
+            for i in range(first, first + count)))
+
+    asyncio.run(run())
+    results.put(tally)
+
+
+def percentiles(values: list) -> str:
+    if not values:
+        return "-"
+    values.sort()
+    return " / ".join(f"{values[int(q * (len(values) - 1))] * 1000:.1f}"
+                      for q in (0.5, 0.95, 0.99))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--urls", help="comma-separated ws:// URLs of running instances")
+    ap.add_argument("--instances", type=int, default=1, help="serve.py instances to start")
+    ap.add_argument("--port", type=int, default=8200, help="first started instance's port")
+    ap.add_argument("--redis-port", type=int, default=6390, help="0: in-memory, one instance")
+    ap.add_argument("--clients", type=int, default=2000)
+    ap.add_argument("--client-procs", type=int, default=4)
+    ap.add_argument("--ramp", type=float, default=20.0, help="seconds to open every socket")
+    ap.add_argument("--seconds", type=float, default=60.0, help="whole run, ramp included")
+    ap.add_argument("--ice", type=int, default=8, help="ICE candidates each side sends")
+    ap.add_argument("--talk", type=float, default=5.0, help="seconds a pair stays together")
+    ap.add_argument("--timeout", type=float, default=30.0)
+    ap.add_argument("--report-every", type=float, default=5.0)
+    args = ap.parse_args()
+
+    raise_nofile()
+    servers = [] if args.urls else start_instances(args)
+    urls = args.urls.split(",") if args.urls else [
+        f"ws://127.0.0.1:{args.port + i}/api/matchmaking" for i in range(args.instances)]
+    try:
+        per = -(-args.clients // args.client_procs)
+        stats = [mp.Array("q", 4, lock=False) for _ in range(args.client_procs)]
+        results = mp.Queue()
+        workers = [mp.Process(target=client_proc,
+                              args=(p * per, min(per, args.clients - p * per), urls, args,
+                                    stats[p], results))
+                   for p in range(args.client_procs) if p * per < args.clients]
+        for w in workers:
+            w.start()
+
+        print(f"{args.clients} clients on {len(urls)} instance(s), {args.ramp:.0f}s ramp,"
+              f" {args.seconds:.0f}s run")
+        print(f"{'t s':>5} {'connected':>9} {'pairs/s':>8} {'relays/s':>9} {'errors':>7}"
+              f" {'RSS MB':>12}")
+        start, last = time.monotonic(), [0] * 4
+        while time.monotonic() < start + args.seconds:
+            time.sleep(args.report_every)
+            now = [sum(s[k] for s in stats) for k in range(4)]
+            rss = "+".join(f"{rss_mb(s.pid):.0f}" for s in servers) or "-"
+            print(f"{time.monotonic() - start:>5.0f} {now[CONNECTED]:>9}"
+                  f" {(now[PAIRS] - last[PAIRS]) / args.report_every:>8.1f}"
+                  f" {(now[RELAYS] - last[RELAYS]) / args.report_every:>9.1f}"
+                  f" {now[ERRORS]:>7} {rss:>12}")
+            last = now
+        # Sessions under way finish first: up to --talk plus a --timeout longer.
+        tallies = [results.get() for _ in workers]
+        for w in workers:
+            w.join()
+    finally:
+        for s in servers:
+            s.terminate()
+            s.wait()
+
+    total = Tally()
+    for t in tallies:
+        total.connect += t.connect
+        total.match += t.match
+        total.relay += t.relay
+        total.errors.update(t.errors)
+        total.closes.update(t.closes)
+    print(f"\n{'':>8} {'n':>8}  p50 / p95 / p99 ms")
+    for name in ("connect", "match", "relay"):
+        values = getattr(total, name)
+        print(f"{name:>8} {len(values):>8}  {percentiles(values)}")
+    print(f"errors: {dict(total.errors) or 'none'}")
+    print(f"closes: {dict(total.closes) or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""A TCP proxy that adds a fixed delay in each direction.
+
+A local redis-server answers in ~0.1ms, so anything whose cost is round-trips
+(the matcher, relay, cleanup) looks free against it. Upstash is ~5ms away. Put
+this in front of the local server to see the numbers production would:
+
+    async with LatencyProxy(upstream_port=6390, rtt_ms=5) as proxy:
+        url = f"redis://127.0.0.1:{proxy.port}"
+
+Ordering is preserved per direction, so Redis pipelining still behaves exactly
+as it would over a real link: a pipeline pays one RTT, not one per command.
+
+`proxy.commands` counts the commands clients sent through it, by name. Unlike
+INFO commandstats, it leaves out the calls a script makes inside Redis, so its
+total is what Upstash would bill.
+"""
+import asyncio
+from collections import Counter
+
+
+class _CommandCounter:
+    """Counts RESP commands (arrays of bulk strings) in a client->server stream."""
+
+    def __init__(self, counts: Counter):
+        self.counts = counts
+        self.buf = b""
+
+    def feed(self, chunk: bytes):
+        buf = self.buf + chunk
+        start = 0
+        while (pos := self._command(buf, start)) is not None:
+            start = pos
+        self.buf = buf[start:]
+
+    def _command(self, buf: bytes, start: int):
+        """Count the command at buf[start:] and return where it ends, or None if incomplete."""
+        head = buf.find(b"\r\n", start)
+        if head < 0 or buf[start:start + 1] != b"*":
+            return None
+        pos, name = head + 2, None
+        for i in range(int(buf[start + 1:head])):
+            end = buf.find(b"\r\n", pos)
+            if end < 0:
+                return None
+            size = int(buf[pos + 1:end])
+            if len(buf) < end + 2 + size + 2:
+                return None
+            if i == 0:
+                name = buf[end + 2:end + 2 + size].decode().lower()
+            pos = end + 2 + size + 2
+        self.counts[name] += 1
+        return pos
+
+
+class LatencyProxy:
+    def __init__(self, upstream_port: int, rtt_ms: float, upstream_host: str = "127.0.0.1",
+                 port: int = 0):
+        self.upstream = (upstream_host, upstream_port)
+        self.delay = rtt_ms / 2000          # one way, in seconds
+        self.port = port
+        self.commands: Counter = Counter()
+        self._server = None
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            up_reader, up_writer = await asyncio.open_connection(*self.upstream)
+        except OSError:
+            writer.close()
+            return
+        await asyncio.gather(
+            self._pipe(reader, up_writer, _CommandCounter(self.commands)),
+            self._pipe(up_reader, writer),
+            return_exceptions=True,
+        )
+
+    async def _pipe(self, reader, writer, counter=None):
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def release():
+            while True:
+                due, chunk = await queue.get()
+                if chunk is None:
+                    break
+                wait = due - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                writer.write(chunk)
+                await writer.drain()
+
+        sender = asyncio.create_task(release())
+        try:
+            while chunk := await reader.read(65536):
+                if counter is not None:
+                    counter.feed(chunk)
+                queue.put_nowait((loop.time() + self.delay, chunk))
+        finally:
+            queue.put_nowait((0, None))
+            try:
+                await sender
+            finally:
+                writer.close()
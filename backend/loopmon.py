@@ -0,0 +1,93 @@
+# app/loopmon.py
+"""
+Event-loop lag: how late the loop runs what is ready to run.
+
+Every socket's receive loop, the pub/sub listener, the matcher and the heartbeat
+share one asyncio loop, so a callback that blocks (a sync call, a large parse, a
+GC pause) delays all of them at once. Nothing else makes that visible: each
+task's own timings only show the part of the stall it happened to be waiting in.
+
+Two parts:
+
+- sample_lag(), a task that sleeps LOOP_LAG_SAMPLE_MS at a time and records how
+  much later than asked it woke, into yawnfox_loop_lag_seconds. The cost is one
+  timer per sample, not one per callback: asyncio's debug mode times every
+  callback, which is far too slow for production.
+- A watchdog thread, started when LOOP_SLOW_MS > 0. If the sampler has not
+  woken for LOOP_SLOW_MS past its due time, the loop is stuck inside one
+  callback. The watchdog logs that thread's stack once per stall, which names
+  the code that blocked it, while it is still blocking.
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from typing import Optional
+
+import metrics
+
+logger = logging.getLogger("yawnfox.loop")
+
+# Sampling period. Lag below it still shows (each sample measures the delay of
+# its own wake-up); it only bounds how many samples a second there are.
+LOOP_LAG_SAMPLE_MS = int(os.environ.get("LOOP_LAG_SAMPLE_MS", "100"))
+# A wake-up this late is a stall worth a stack trace. 0 disables the watchdog.
+LOOP_SLOW_MS = int(os.environ.get("LOOP_SLOW_MS", "250"))
+
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+LOOP_LAG = metrics.histogram("yawnfox_loop_lag_seconds",
+                             "How late the event loop woke a timer (scheduling delay).",
+                             LAG_BUCKETS)
+LOOP_STALLS = metrics.counter("yawnfox_loop_stalls_total",
+                              f"Stalls past LOOP_SLOW_MS ({LOOP_SLOW_MS} ms), each logged with a stack.")
+
+_due: float = 0.0           # when the sampler should next wake (monotonic)
+_stop = threading.Event()
+_watchdog: Optional[threading.Thread] = None
+
+
+async def sample_lag() -> None:
+    """Background task: record the loop's scheduling delay. Starts the watchdog."""
+    global _due
+    interval = LOOP_LAG_SAMPLE_MS / 1000
+    _due = time.monotonic() + interval
+    if LOOP_SLOW_MS > 0:
+        _start_watchdog(threading.get_ident())
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            LOOP_LAG.observe(max(0.0, now - _due))
+            _due = now + interval
+    finally:
+        _stop.set()
+
+
+def _start_watchdog(loop_thread: int) -> None:
+    global _watchdog
+    if _watchdog is not None and _watchdog.is_alive():
+        return
+    _stop.clear()
+    _watchdog = threading.Thread(target=_watch, args=(loop_thread,),
+                                 name="loop-watchdog", daemon=True)
+    _watchdog.start()
+
+
+def _watch(loop_thread: int) -> None:
+    slow = LOOP_SLOW_MS / 1000
+    reported = None             # the _due of the stall already logged
+    while not _stop.wait(slow / 2):
+        due = _due
+        late = time.monotonic() - due
+        if late < slow or due == reported:
+            continue
+        frame = sys._current_frames().get(loop_thread)
+        if frame is None:
+            return              # the loop's thread is gone
+        reported = due
+        LOOP_STALLS.inc()
+        stack = "".join(traceback.format_stack(frame))
+        logger.warning(f"event loop blocked for {late * 1000:.0f} ms so far, in:\n{stack}")
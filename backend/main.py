@@ -1,7 +1,7 @@
 # app/main.py
 
 # Must run before any other import: store.py resolves its configuration into
-# module-level constants at import time (CONN_TTL, RATE_LIMIT_MAX, _inmemory_mode,
+# module-level constants at import time (LEASE_TTL, RATE_LIMIT_MAX, _inmemory_mode,
 # ...), so loading the .env after `import store` would be too late for those.
 # With no .env present this is a no-op — which is the case on Fly.io, where the
 # values come from `fly secrets set`. See .env.example.
@@ -12,20 +12,32 @@ load_dotenv()
 import os
 import json
 import time
-import uuid
 import asyncio
 import logging
-from typing import Dict, Optional
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
 from contextlib import asynccontextmanager
 
 from starlette.applications import Starlette
 from starlette.routing import WebSocketRoute, Route
 from starlette.websockets import WebSocket, WebSocketDisconnect
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, PlainTextResponse
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
 
 import store
+import metrics
+import loopmon
+import tracelog
+
+# orjson parses several times faster than the stdlib. Optional: nothing depends
+# on it beyond speed. Its JSONDecodeError subclasses json.JSONDecodeError, so
+# one except clause serves either.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+_loads = orjson.loads if orjson else json.loads
 
 # Configure logging
 logging.basicConfig(
@@ -59,13 +71,31 @@ MAX_MESSAGE_BYTES = 65536
 # Message names that may be relayed verbatim to a partner (WebRTC signaling).
 ALLOWED_RELAY = {"SDP_OFFER", "SDP_ANSWER", "SDP_ICE_CANDIDATE"}
 
+# How a relayable frame begins. peer.js builds every signal as {name, data} and
+# JSON.stringify keeps key order without whitespace, so real traffic always
+# matches and _relay_name can find the name without parsing up to 64KB of SDP.
+_RELAY_PREFIX = '{"name":"'
+_RELAY_NAME_END = len(_RELAY_PREFIX) + max(map(len, ALLOWED_RELAY)) + 1
+_UNPARSED = object()   # _relay_name() read the name without parsing the frame
+
+# Server frames that never vary, encoded once.
+RATE_LIMITED_FRAME = json.dumps({
+    "name": "RATE_LIMITED",
+    "message": "Too many connection attempts. Please wait a minute and try again.",
+})
+SERVER_UNAVAILABLE_FRAME = json.dumps({
+    "name": "SERVER_UNAVAILABLE",
+    "message": "Server is temporarily unavailable. Please try again shortly.",
+})
+
 # How long the matcher waits before checking the pool without having been woken.
 # Matching itself is event driven: enqueue_waiting -> trigger_wakeup() sets
 # match_event on this instance (never lost) and publishes yf:wakeup for the others.
 # This timeout only recovers the rare cases that produce no event — a wakeup lost
 # while pub/sub was reconnecting, a pass that stopped at max_rounds with work left,
 # or losing the matcher lock race — so it can be long. It was 1s, which turned the
-# safety net into the single largest Redis cost in the system.
+# safety net into the single largest Redis cost in the system. Stretched further
+# as the day's command budget runs low (store.budget_stretch).
 MATCH_POLL_SECONDS = 15
 
 # Per-socket message budget (token bucket). check_rate_limit only runs once, at
@@ -91,6 +121,31 @@ MSG_BURST = max(float(os.environ.get("MSG_BURST", "40")), PAIRING_COST)  # capac
 # any allowed message, so this only ever fires on sustained abuse.
 VIOLATION_LIMIT = 50
 
+# Outbound budget per socket. Frames are queued and written by one task per
+# socket, so a client that stops reading (full TCP send buffer) only delays
+# itself; these bound how far behind it may fall before it is disconnected. A
+# call setup is ~20 frames in a second or two, so either limit means the client
+# is gone in all but name. Control frames (PARTNER_FOUND/LEFT) are few, jump the
+# queue and do not count against the frame cap.
+OUTBOUND_MAX_FRAMES = 256
+OUTBOUND_MAX_LAG_SECONDS = 10.0
+# A single write that takes this long is a stalled client, not a slow network.
+SEND_TIMEOUT_SECONDS = 10.0
+
+# Outbound queue counters, reported by /ping. Process-lifetime totals.
+outbound_stats = {"dropped": 0, "evicted": 0}
+
+# Hot-path metrics for /metrics (see metrics.py; store.py records its own).
+TIME_TO_MATCH = metrics.histogram("yawnfox_time_to_match_seconds",
+                                  "PAIRING_START to PARTNER_FOUND, at the client's instance.",
+                                  metrics.WAIT_BUCKETS)
+MATCH_PASS_SECONDS = metrics.histogram("yawnfox_match_pass_seconds",
+                                       "Duration of a matcher pass over every claimable shard.")
+PAIRS_PER_PASS = metrics.histogram("yawnfox_match_pass_pairs", "Pairs formed per matcher pass.",
+                                   metrics.COUNT_BUCKETS)
+MESSAGE_DROPS = metrics.counter("yawnfox_message_drops_total",
+                                "Client frames dropped by the per-socket token bucket.")
+
 # --- Helper Classes ---
 
 class ManagedWebSocket:
@@ -104,6 +159,20 @@ class ManagedWebSocket:
         self.tokens = MSG_BURST
         self.last_refill = time.monotonic()
         self.violations = 0
+        # When its pending PAIRING_START arrived, until PARTNER_FOUND is delivered.
+        self.pairing_at: Optional[float] = None
+        # Who this socket is paired with and which instance holds them, as last
+        # announced by PARTNER_FOUND. Relay routes on this instead of asking
+        # Redis per frame; it is safe to be stale because the receiving side
+        # drops frames from anyone who is no longer its partner (deliver_local).
+        self.partner: Optional[str] = None
+        self.partner_owner: Optional[str] = None
+        # Outbound queues, drained by _write_loop (started on the first send).
+        self._control: deque = deque()      # (queued_at, text, None), written first
+        self._data: deque = deque()         # (queued_at, text, stamp), relayed signaling
+        self._wake = asyncio.Event()
+        self._writer: Optional[asyncio.Task] = None
+        self._close_sent = False
 
     def take(self, cost: float = 1.0) -> bool:
         """Spend `cost` tokens. False if the socket is over its budget."""
@@ -117,40 +186,157 @@ class ManagedWebSocket:
         self.violations = 0
         return True
 
-    async def safe_close(self):
-        if not self.closed:
+    def send(self, message: str, control: bool = False, stamp: Optional[tuple] = None) -> None:
+        """Queue a frame for this socket's writer task. Never blocks.
+
+        control: a server frame about the pairing itself. It is written before
+        any queued relay traffic, and a pairing change makes that traffic stale
+        (it belongs to the previous partner), so it is dropped rather than let
+        an old ICE candidate reach the new call.
+
+        stamp: a relayed frame's, from store; the writer reports it to
+        store.relay_written() once the frame is written.
+        """
+        if self.closed:
+            outbound_stats["dropped"] += 1
+            return
+        now = time.monotonic()
+        if control:
+            outbound_stats["dropped"] += len(self._data)
+            self._data.clear()
+            self._control.append((now, message, None))
+        else:
+            if self._data and now - self._data[0][0] > OUTBOUND_MAX_LAG_SECONDS:
+                self._evict(f"oldest frame queued {now - self._data[0][0]:.1f}s")
+                return
+            if len(self._data) >= OUTBOUND_MAX_FRAMES:
+                self._evict(f"{len(self._data)} frames queued")
+                return
+            self._data.append((now, message, stamp))
+        if self._writer is None:
+            self._writer = asyncio.create_task(self._write_loop())
+        self._wake.set()
+
+    def queued(self) -> int:
+        return len(self._control) + len(self._data)
+
+    async def _write_loop(self):
+        while not self.closed:
+            if not self._control and not self._data:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            _, message, stamp = (self._control or self._data).popleft()
             try:
-                await self.websocket.close()
-            except Exception:
-                pass
-            self.closed = True
+                async with asyncio.timeout(SEND_TIMEOUT_SECONDS):   # no task per send
+                    await self.websocket.send_text(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"[{self.id}] Send failed: {e!r}")
+                self._fail()
+                continue
+            if stamp is not None:
+                store.relay_written(stamp)
+
+    def _evict(self, why: str):
+        logger.warning(f"[{self.id}] Slow consumer evicted: {why}.")
+        outbound_stats["evicted"] += 1
+        self._fail()
 
-    async def send_text(self, message: str):
+    def _fail(self):
         if self.closed:
             return
-        try:
-            await self.websocket.send_text(message)
-        except Exception as e:
-            logger.warning(f"[{self.id}] Send failed: {e}")
-            self.closed = True
-            # schedule cleanup (non-blocking)
-            if self.on_send_fail:
-                try:
-                    self.on_send_fail(self.id)
-                except Exception:
-                    pass
+        outbound_stats["dropped"] += self.queued()
+        self._control.clear()
+        self._data.clear()
+        self.closed = True
+        # schedule cleanup (non-blocking)
+        if self.on_send_fail:
+            try:
+                self.on_send_fail(self.id)
+            except Exception:
+                pass
+
+    async def safe_close(self):
+        self.closed = True
+        outbound_stats["dropped"] += self.queued()
+        self._control.clear()
+        self._data.clear()
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        if not self._close_sent:
+            # Sent even after a failed or evicted send: an evicted client is
+            # still connected, and this is what ends its receive loop. Bounded,
+            # because a client that stopped reading may not take the close frame.
+            self._close_sent = True
+            try:
+                await asyncio.wait_for(self.websocket.close(), SEND_TIMEOUT_SECONDS)
+            except Exception:
+                pass
 
 # --- Delivery / helpers ---
 
-async def deliver_local(ws_id: str, text: str) -> bool:
-    """Deliver a raw text frame to a locally-connected client. Returns success."""
+async def deliver_local(ws_id: str, text: str, sender: Optional[str] = None,
+                        news: Optional[str] = None, stamp: Optional[tuple] = None) -> bool:
+    """Deliver a raw text frame to a locally-connected client. Returns success.
+
+    Also keeps the socket's partner cache: PARTNER_FOUND fills it, PARTNER_LEFT
+    clears it, and a frame relayed by anyone but the cached partner is a
+    leftover from an earlier pairing and is dropped (still "delivered": the
+    client is here, there is nowhere else for it to go).
+    """
     ws = local_websockets.get(ws_id)
     if ws is None:
         return False
-    await ws.send_text(text)
+    if news:                                # PARTNER_FOUND
+        ws.partner, ws.partner_owner = sender, news
+        if ws.pairing_at is not None:
+            TIME_TO_MATCH.observe(time.monotonic() - ws.pairing_at)
+            ws.pairing_at = None
+        tracelog.record(ws_id, "F")
+    elif sender is not None:
+        if ws.partner != sender:
+            return True
+        if news is not None:                # PARTNER_LEFT
+            ws.partner = ws.partner_owner = None
+            tracelog.record(ws_id, "X")
+    # Queued, not written: the pub/sub listener calls this for every frame on
+    # the instance, and must never wait on one client's socket.
+    ws.send(text, control=sender is None or news is not None, stamp=stamp)
     return True
 
 
+def _relay_name(message: str) -> Tuple[Optional[str], Any]:
+    """The name of a signaling frame that can be relayed without re-encoding it,
+    and the frame parsed, if finding the name took parsing it (else _UNPARSED).
+
+    A None name means "not sure", never "invalid": the caller parses such frames
+    the normal way, unless they come back parsed already, so no frame is parsed
+    twice. The frame is forwarded as is, so the name must be the one the
+    recipient's JSON.parse will see, which keeps the *last* "name" key. orjson
+    gets that right by construction (and is the faster of the two); its
+    JSONDecodeError is the caller's, as _loads' would be. Without it, a scan
+    claims only frames where the name read here is the only one: the literal
+    "name" key occurs once, and there is no \\u escape that could spell another.
+    """
+    if not message.startswith(_RELAY_PREFIX):
+        return None, _UNPARSED
+    if orjson is not None:
+        data = orjson.loads(message)
+        name = data.get("name") if isinstance(data, dict) else None
+        return (name if isinstance(name, str) and name in ALLOWED_RELAY else None), data
+    if not message.endswith("}"):
+        return None, _UNPARSED
+    end = message.find('"', len(_RELAY_PREFIX), _RELAY_NAME_END)
+    if end < 0 or message[end + 1] not in ",}":
+        return None, _UNPARSED
+    name = message[len(_RELAY_PREFIX):end]
+    if name not in ALLOWED_RELAY or "\\u" in message or message.count('"name"') != 1:
+        return None, _UNPARSED
+    return name, _UNPARSED
+
+
 def _origin_allowed(origin: Optional[str]) -> bool:
     if not _cors_origins:
         return True  # not configured -> allow (dev)
@@ -171,6 +357,21 @@ def _client_ip(websocket: WebSocket) -> str:
     return websocket.client.host if websocket.client else "unknown"
 
 
+def _normalize_topics(data: dict) -> list:
+    """A PAIRING_START's topics: "topics" (or a lone legacy "topic"), stripped,
+    lowercased, empty ones dropped."""
+    raw_topics = data.get("topics", [])
+    if not isinstance(raw_topics, list):
+        raw_topics = []
+    if not raw_topics and data.get("topic"):
+        raw_topics = [data.get("topic")]
+    normalized_topics = [
+        str(t).strip().lower() for t in raw_topics if str(t).strip()
+    ]
+    # S2: cap each topic to 50 chars and the list to 3 (server side).
+    return [t[:50] for t in normalized_topics][:3]
+
+
 # --- Core Logic ---
 
 async def soft_unpair(ws_id: str):
@@ -178,20 +379,33 @@ async def soft_unpair(ws_id: str):
     Unpairs a user from their partner without closing the connection.
     Notifies the partner they have been left.
     """
+    ws = local_websockets.get(ws_id)
+    cached = (ws.partner, ws.partner_owner) if ws else (None, None)
+    if ws:
+        ws.partner = ws.partner_owner = None
     partner_id = await store.clear_partner(ws_id)
     if partner_id:
-        asyncio.create_task(store.route(partner_id, {"name": "PARTNER_LEFT"}))
+        owner = cached[1] if cached[0] == partner_id else None
+        # Awaited, not a fire-and-forget task per unpair: delivery only queues
+        # now, so at worst this waits on one owner lookup.
+        await store.partner_left(partner_id, ws_id, owner)
 
 
 async def matcher_loop():
     """Background task to match waiting clients (coordinated across instances
-    by a Redis lock; every instance runs this so the matcher is not a SPOF)."""
+    by one Redis lock per pool shard; every instance runs this so the matcher is
+    not a SPOF, and several instances can match different shards at once)."""
     logger.info("Matcher loop started.")
     while True:
         try:
             # Wake on a local/cross-instance signal, or poll as a fallback.
+            # MATCH_MODE=window also wakes when a client it held back ripens.
+            timeout = MATCH_POLL_SECONDS * store.budget_stretch()
+            due = store.match_due()
+            if due is not None:
+                timeout = min(timeout, due)
             try:
-                await asyncio.wait_for(match_event.wait(), timeout=MATCH_POLL_SECONDS)
+                await asyncio.wait_for(match_event.wait(), timeout=timeout)
             except asyncio.TimeoutError:
                 pass
             match_event.clear()
@@ -204,18 +418,11 @@ async def matcher_loop():
             if not local_websockets:
                 continue
 
-            if await store.waiting_count() < 2:
-                continue
-            if not await store.try_acquire_matcher_lock():
-                continue  # another instance is matching right now
-            try:
-                # True -> the pass stopped early (deadline / round cap / ghosts
-                # past the window) with work possibly left. Go again now instead
-                # of waiting out MATCH_POLL_SECONDS.
-                if await store.run_matcher_rounds():
-                    match_event.set()
-            finally:
-                await store.release_matcher_lock()
+            # True -> a pass stopped early (deadline / round cap / ghosts past
+            # the window) with work possibly left. Go again now instead of
+            # waiting out MATCH_POLL_SECONDS.
+            if await match_pass():
+                match_event.set()
         except asyncio.CancelledError:
             raise
         except Exception as e:
@@ -223,14 +430,45 @@ async def matcher_loop():
             await asyncio.sleep(0.5)
 
 
+async def match_pass() -> bool:
+    """One matcher pass over every shard this instance can claim, then the
+    cross-shard pass. Returns True if work may remain."""
+    counts = await store.waiting_counts()
+    if sum(counts) < 2:
+        return False
+    start, pairs = time.perf_counter(), store.pairs_total.value
+    more = False
+    for shard in store.claim_order(counts):
+        if not await store.try_acquire_matcher_lock(shard):
+            continue  # another instance is matching this shard right now
+        try:
+            more |= await store.run_matcher_rounds(shard=shard)
+        finally:
+            await store.release_matcher_lock(shard)
+    # Leftovers in different shards can only meet in the cross-shard pass.
+    # Skipped when everyone was queued in one shard to begin with.
+    if sum(1 for c in counts if c) >= 2 and await store.try_acquire_matcher_lock(None):
+        try:
+            more |= await store.run_cross_shard_rounds()
+        finally:
+            await store.release_matcher_lock(None)
+    MATCH_PASS_SECONDS.observe(time.perf_counter() - start)
+    PAIRS_PER_PASS.observe(store.pairs_total.value - pairs)
+    return more
+
+
 async def heartbeat_loop():
-    """Periodically extend TTLs for this instance's live clients so idle
-    waiting users are not garbage-collected, and dead instances self-heal."""
+    """Renew this instance's lease, which keeps every local client live, and
+    sweep up the clients of instances whose lease has expired. One command a
+    beat however many clients are connected (see store.renew_lease).
+
+    Every LEASE_TTL / 3, stretched near the command budget, but never past
+    LEASE_TTL / 2: one late or lost beat must still leave the lease standing."""
     while True:
         try:
-            await asyncio.sleep(30)
+            await asyncio.sleep(store.LEASE_TTL / 3 * min(store.budget_stretch(), 1.5))
             if local_websockets:
-                await store.refresh(list(local_websockets.keys()))
+                await store.renew_lease(local_websockets.keys())
         except asyncio.CancelledError:
             raise
         except Exception as e:
@@ -240,14 +478,15 @@ async def heartbeat_loop():
 async def cleanup(ws_id: str):
     """Robust cleanup for a disconnecting user. Called on any exit path."""
     ws = local_websockets.pop(ws_id, None)
+    if ws is None:
+        return  # the other exit path (send failure / receive loop) got here first
 
-    # Unpair and notify partner, drop from wait pool, drop presence.
-    await soft_unpair(ws_id)
-    await store.remove_waiting(ws_id)
-    await store.unregister_connection(ws_id)
+    # Unpair and notify partner, drop from wait pool, drop presence: one script,
+    # shared with every other socket closing at about the same time.
+    await store.disconnect(ws_id)
+    tracelog.disconnected(ws_id)
 
-    if ws:
-        await ws.safe_close()
+    await ws.safe_close()
     logger.info(f"[{ws_id}] Cleaned up.")
 
 
@@ -259,7 +498,7 @@ async def websocket_endpoint(websocket: WebSocket):
         await websocket.close(code=1008)
         return
 
-    # Rate limit per client IP (sliding window in Redis).
+    # Rate limit per client IP: decided in-process, synced to Redis in batches.
     ip = _client_ip(websocket)
     allowed = await store.check_rate_limit(ip)
 
@@ -268,10 +507,7 @@ async def websocket_endpoint(websocket: WebSocket):
     if not allowed:
         logger.info(f"Rate limited connection from {ip}")
         try:
-            await websocket.send_text(json.dumps({
-                "name": "RATE_LIMITED",
-                "message": "Too many connection attempts. Please wait a minute and try again.",
-            }))
+            await websocket.send_text(RATE_LIMITED_FRAME)
         except Exception as e:
             # Best effort: we close either way. Logged so a client that gets shut
             # out with no explanation is distinguishable from one that was told.
@@ -284,20 +520,18 @@ async def websocket_endpoint(websocket: WebSocket):
     # configured but the connection was lost at startup.
     if not store.is_ready():
         try:
-            await websocket.send_text(json.dumps({
-                "name": "SERVER_UNAVAILABLE",
-                "message": "Server is temporarily unavailable. Please try again shortly.",
-            }))
+            await websocket.send_text(SERVER_UNAVAILABLE_FRAME)
         except Exception as e:
             # Best effort, same as above: log rather than close in silence.
             logger.warning(f"Could not deliver SERVER_UNAVAILABLE to {ip}: {e}")
         await websocket.close(code=1011)
         return
 
-    ws_id = str(uuid.uuid4())
+    ws_id = store.new_client_id()
     ws = ManagedWebSocket(websocket, ws_id, on_send_fail=lambda _id: asyncio.create_task(cleanup(_id)))
     local_websockets[ws_id] = ws
     await store.register_connection(ws_id)
+    tracelog.connected(ws_id)
 
     logger.info(f"[{ws_id}] Connected from {ip}.")
 
@@ -319,17 +553,29 @@ async def websocket_endpoint(websocket: WebSocket):
 
             # Charge before parsing, so a flooder never buys JSON parsing off us.
             if not ws.take():
+                MESSAGE_DROPS.inc()
                 if ws.violations >= VIOLATION_LIMIT:
                     logger.warning(f"[{ws_id}] Sustained message flood; closing.")
                     await websocket.close(code=1008)  # 1008 = Policy Violation
                     break
                 continue
 
+            # Signaling is nearly all of the traffic and needs only its name
+            # read: forward the text untouched rather than parse and re-encode it.
+            # A frame _relay_name had to parse comes back parsed: never twice.
             try:
-                data = json.loads(message)
+                relay, data = _relay_name(message)
+                if relay is None and data is _UNPARSED:
+                    data = _loads(message)
             except json.JSONDecodeError:
                 logger.warning(f"[{ws_id}] Invalid JSON.")
                 continue
+            if relay is not None:
+                if ws.partner:
+                    await store.route(ws.partner, message, sender=ws_id, owner=ws.partner_owner)
+                    if tracelog.ENABLED:
+                        tracelog.relayed(ws_id, relay, len(message))
+                continue
 
             # R5: ignore valid-but-non-object JSON (arrays, strings, numbers)
             # instead of crashing the receive loop and dropping the connection.
@@ -341,33 +587,29 @@ async def websocket_endpoint(websocket: WebSocket):
             if msg_name == "PAIRING_START":
                 # Top up to the real cost of this message (1 was already charged).
                 if not ws.take(PAIRING_COST - 1):
+                    MESSAGE_DROPS.inc()
                     continue
-                # Ensure clean slate (soft_unpair so we don't close current socket).
-                await store.remove_waiting(ws_id)
-                await soft_unpair(ws_id)
 
-                # Parse topics
-                raw_topics = data.get("topics", [])
-                if not isinstance(raw_topics, list):
-                    raw_topics = []
-                if not raw_topics and data.get("topic"):
-                    raw_topics = [data.get("topic")]
-                normalized_topics = [
-                    str(t).strip().lower() for t in raw_topics if str(t).strip()
-                ]
-                # S2: cap each topic to 50 chars and the list to 3 (server side).
-                normalized_topics = [t[:50] for t in normalized_topics][:3]
-
-                await store.enqueue_waiting(ws_id, normalized_topics)
-                await store.trigger_wakeup()
+                normalized_topics = _normalize_topics(data)
+
+                # Clean slate and back in the pool in one round-trip: unpairs
+                # (telling the old partner), requeues and wakes the matchers.
+                ws.partner = ws.partner_owner = None
+                ws.pairing_at = time.monotonic()
+                await store.requeue(ws_id, normalized_topics)
+                tracelog.pairing(ws_id, normalized_topics)
 
             elif msg_name == "PAIRING_ABORT":
+                ws.pairing_at = None
                 await store.remove_waiting(ws_id)
+                tracelog.record(ws_id, "A")
 
             elif msg_name == "LEAVE":
                 # User manually signalling leave (next button)
+                ws.pairing_at = None
                 await store.remove_waiting(ws_id)
                 await soft_unpair(ws_id)
+                tracelog.record(ws_id, "L")
 
             # Generic signaling relay (SDP, ICE candidates, etc.)
             # NOTE: chat is now peer-to-peer over the WebRTC data channel and no
@@ -379,9 +621,12 @@ async def websocket_endpoint(websocket: WebSocket):
                 if msg_name not in ALLOWED_RELAY:
                     logger.debug(f"[{ws_id}] Ignoring non-relayable message: {msg_name}")
                     continue
-                partner_id = await store.get_partner(ws_id)
-                if partner_id:
-                    await store.route(partner_id, data)
+                # The cached partner, not a Redis GET: a call setup relays 10-20
+                # of these, and each GET was a round-trip and a billed command.
+                if ws.partner:
+                    await store.route(ws.partner, message, sender=ws_id, owner=ws.partner_owner)
+                    if tracelog.ENABLED:
+                        tracelog.relayed(ws_id, msg_name, len(message))
 
     except WebSocketDisconnect:
         logger.info(f"[{ws_id}] Disconnected.")
@@ -406,6 +651,8 @@ async def lifespan(app: Starlette):
         asyncio.create_task(store.pubsub_listener()),
         asyncio.create_task(matcher_loop()),
         asyncio.create_task(heartbeat_loop()),
+        asyncio.create_task(loopmon.sample_lag()),
+        asyncio.create_task(tracelog.writer(store.instance_id())),
     ]
     yield
     # Shutdown
@@ -420,6 +667,17 @@ async def lifespan(app: Starlette):
     await store.close()
 
 
+def _server_profile() -> dict:
+    """The loop as detected, http/ws as serve.py resolved them ("auto": started
+    by the uvicorn CLI, which picks for itself)."""
+    loop = type(asyncio.get_running_loop()).__module__.split(".")[0]
+    return {
+        "loop": loop,                                   # "uvloop" | "asyncio"
+        "http": os.environ.get("SERVER_HTTP", "auto"),
+        "ws": os.environ.get("SERVER_WS", "auto"),
+    }
+
+
 async def ping(request):
     # "mode" is the honest field: it separates in-memory from a live Redis, which
     # the old boolean did not — it reported true for both, so a REDIS_URL that was
@@ -430,9 +688,48 @@ async def ping(request):
         "mode": store.mode(),          # "in-memory" | "redis" | "redis-down"
         "ready": store.is_ready(),     # accepting clients?
         "connections": len(local_websockets),
+        "outbound": {
+            "queued": sum(ws.queued() for ws in local_websockets.values()),
+            "max_queued": max((ws.queued() for ws in local_websockets.values()), default=0),
+            **outbound_stats,
+        },
+        "scripts": store.script_stats,  # EVALSHA request bytes per script
+        "server": _server_profile(),
+        # Bucket bounds, not exact: the histogram is yawnfox_loop_lag_seconds.
+        "loop_lag_ms": {
+            "p50": loopmon.LOOP_LAG.quantile(0.5) * 1000,
+            "p99": loopmon.LOOP_LAG.quantile(0.99) * 1000,
+            "stalls": loopmon.LOOP_STALLS.value,
+        },
+        "commands": store.command_counts(),     # sent by this instance, per operation
+        "budget": {
+            "daily": store.REDIS_DAILY_BUDGET,  # 0 = no governor
+            "used": store.budget_used(),        # the fleet's, today (UTC)
+            "stretch": store.budget_stretch(),
+        },
     })
 
 
+metrics.gauge("yawnfox_connections", "WebSockets connected to this instance.",
+              lambda: len(local_websockets))
+metrics.gauge("yawnfox_outbound_queued", "Frames queued for writing to local sockets.",
+              lambda: sum(ws.queued() for ws in local_websockets.values()))
+metrics.gauge("yawnfox_redis_budget_used", "The fleet's Redis commands today (UTC), as known here.",
+              store.budget_used)
+metrics.gauge("yawnfox_redis_budget_stretch", "Stretch factor applied to optional polling.",
+              store.budget_stretch)
+for _shard in range(len(store.pool_counts)):
+    metrics.gauge("yawnfox_waiting_clients",
+                  "Waiting clients per pool shard, as of this instance's last matcher pass.",
+                  lambda s=_shard: store.pool_counts[s], shard=_shard)
+
+
+async def metrics_endpoint(request):
+    # Prometheus scrapes this. Gauges are read here and nothing queries Redis,
+    # so a scrape costs no commands.
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 middleware = [
     Middleware(
         CORSMiddleware,
@@ -447,6 +744,7 @@ app = Starlette(
     middleware=middleware,
     routes=[
         Route("/ping", ping),
+        Route("/metrics", metrics_endpoint),
         WebSocketRoute("/api/matchmaking", websocket_endpoint),
     ]
 )
@@ -0,0 +1,152 @@
+# app/matching.py
+"""
+Window matching: pair a window of waiting clients all at once, for the most
+shared topics, rather than one head at a time (MATCH_MODE=window).
+
+The greedy matcher (_MATCH_LUA, _run_matcher_rounds_inmemory) takes the oldest
+waiter and gives it the oldest peer sharing a topic, else the next-oldest. That
+is fair and cheap, but blind to everyone behind the head: with A {chess, go},
+B {chess}, C {go} and D {chess} queued in that order, A takes B and C is left
+with D, sharing nothing, where A with C and B with D share a topic each.
+
+Here every live client in the window is a vertex, every pair that may be
+matched is an edge, and the matching picked is the one of greatest total
+weight, an edge's weight being, from the heaviest tier down:
+
+  overdue  for each of the two waiting past MATCH_MAX_WAIT_MS: above any number
+           of topics, so that bound holds whatever the pool looks like
+  topic    for each topic the two share: the most shared topics comes first
+  aging    each one's wait in ms: of matchings with as many shared topics, the
+           one that serves the longest-waiting clients
+
+A pair sharing no topic is an edge only once both have waited
+MATCH_HOLD_MS, or either is overdue. That is the batching: a client with
+topics gets MATCH_HOLD_MS for a topic peer to arrive before it settles for
+anyone. A client with no topics has nothing to wait for and is ripe at once.
+
+An exact maximum-weight matching (Edmonds' blossoms) is O(n^3), with no
+useful bound on the time a pass may take. solve() instead builds the greedy
+matching by weight, which is never worse than half the optimum, then improves
+it with local moves until none helps or MATCH_SOLVE_MS is spent:
+
+  swap     two pairs (a, b), (c, d) become (a, c), (b, d) or (a, d), (b, c)
+  augment  a pair (a, b) and unpaired u: (u, a), and b to another unpaired v
+           or left over
+
+The second move is the chess/go case above. On a window of 64 it reaches a
+local optimum in a few ms (bench/bench_matcher_sim.py --mode window).
+"""
+import os
+import time
+from typing import List, Optional, Tuple
+
+MATCH_HOLD_MS = int(os.environ.get("MATCH_HOLD_MS", "3000"))
+MATCH_MAX_WAIT_MS = max(MATCH_HOLD_MS, int(os.environ.get("MATCH_MAX_WAIT_MS", "10000")))
+# CPU budget of one solve() beyond its greedy start, which always completes.
+MATCH_SOLVE_MS = float(os.environ.get("MATCH_SOLVE_MS", "5"))
+
+# A waiting client, oldest first: (ws_id, enqueued at in epoch ms, topics).
+Waiter = Tuple[str, float, frozenset]
+
+
+def solve(waiting: List[Waiter], now_ms: float, hold_ms: Optional[int] = None,
+          max_wait_ms: Optional[int] = None,
+          budget_ms: Optional[float] = None) -> Tuple[List[Tuple[str, str]], Optional[float]]:
+    """Pairs to form out of `waiting`, each (older, newer), and when (epoch ms)
+    the next of those left over becomes ripe or overdue: the time to look again
+    even if nobody arrives. None when that never comes. The settings default to
+    the module's, as they are at the call."""
+    hold_ms = MATCH_HOLD_MS if hold_ms is None else hold_ms
+    max_wait_ms = max(hold_ms, MATCH_MAX_WAIT_MS if max_wait_ms is None else max_wait_ms)
+    budget_ms = MATCH_SOLVE_MS if budget_ms is None else budget_ms
+    n = len(waiting)
+    age = [min(max(0.0, now_ms - since), max_wait_ms) for _, since, _ in waiting]
+    overdue = [now_ms - since >= max_wait_ms for _, since, _ in waiting]
+    ripe = [not topics or now_ms - since >= hold_ms for _, since, topics in waiting]
+    # Ages in a matching sum to at most n * max_wait_ms, and shared topics to 3
+    # per pair: each tier outweighs everything below it.
+    topic = n * max_wait_ms + 1
+    late = 2 * n * topic
+    w: List[List[Optional[float]]] = [[None] * n for _ in range(n)]
+    edges = []
+    for i in range(n):
+        ti = waiting[i][2]
+        for j in range(i + 1, n):
+            shared = len(ti & waiting[j][2])
+            if not (shared or ripe[i] and ripe[j] or overdue[i] or overdue[j]):
+                continue
+            w[i][j] = w[j][i] = (topic * shared + late * (overdue[i] + overdue[j])
+                                 + age[i] + age[j] + 1)
+            edges.append((w[i][j], i, j))
+
+    mate = [-1] * n
+    edges.sort(key=lambda e: (-e[0], e[1], e[2]))
+    for _, i, j in edges:
+        if mate[i] < 0 and mate[j] < 0:
+            mate[i], mate[j] = j, i
+    _improve(w, mate, time.perf_counter() + budget_ms / 1000)
+
+    pairs = [(waiting[i][0], waiting[mate[i]][0]) for i in range(n) if i < mate[i]]
+    due = [since + (max_wait_ms if ripe[i] else hold_ms)
+           for i, (_, since, _) in enumerate(waiting) if mate[i] < 0 and not overdue[i]]
+    return pairs, min(due, default=None)
+
+
+def _gain(w, pairs) -> float:
+    """Total weight of `pairs`, or -inf if any of them is not an edge."""
+    total = 0.0
+    for i, j in pairs:
+        if w[i][j] is None:
+            return float("-inf")
+        total += w[i][j]
+    return total
+
+
+def _improve(w, mate: list, deadline: float) -> None:
+    """Apply swap and augment moves (see the module docstring) while they gain."""
+    n = len(mate)
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for a in range(n):
+            b = mate[a]
+            if b < 0:
+                continue
+            if time.perf_counter() >= deadline:
+                return
+            here = w[a][b]
+            # swap with another pair (c, d)
+            for c in range(a + 1, n):
+                d = mate[c]
+                if d < 0 or d == a:
+                    continue
+                now = here + w[c][d]
+                if _gain(w, ((a, c), (b, d))) > now:
+                    mate[a], mate[c], mate[b], mate[d] = c, a, d, b
+                elif _gain(w, ((a, d), (b, c))) > now:
+                    mate[a], mate[d], mate[b], mate[c] = d, a, c, b
+                else:
+                    continue
+                improved = True
+                break
+            if mate[a] != b:
+                continue
+            # augment: a to an unpaired u, b to an unpaired v (or left over)
+            free = [u for u in range(n) if mate[u] < 0]
+            best, move = here, None
+            for x, y in ((a, b), (b, a)):
+                for u in free:
+                    if w[x][u] is None:
+                        continue
+                    if w[x][u] > best:
+                        best, move = w[x][u], (x, u, y, -1)
+                    for v in free:
+                        if v != u and w[y][v] is not None and w[x][u] + w[y][v] > best:
+                            best, move = w[x][u] + w[y][v], (x, u, y, v)
+            if move:
+                x, u, y, v = move
+                mate[x], mate[u] = u, x
+                mate[y] = v
+                if v >= 0:
+                    mate[v] = y
+                improved = True
@@ -0,0 +1,121 @@
+# app/metrics.py
+"""
+Process metrics in the Prometheus text format, served by main.py at /metrics.
+
+Deliberately not prometheus_client: that library takes a lock on every
+observation, for the threads this process does not have. Everything here runs on
+the one event loop, so an observation is a few plain integer and float updates.
+Recording allocates nothing a scrape would not, and all formatting happens at
+scrape time.
+
+Counters and histograms are created once, at import, by the modules that record
+them. A counter or histogram called twice with one name and different labels
+becomes two series of one metric. Gauges are callables read at scrape time, so
+recording them costs nothing at all.
+
+Per-second rates (drops, pairs) are counters: rate() them in PromQL.
+"""
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+# Bucket upper bounds, in seconds unless named otherwise.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+WAIT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+COUNT_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+# name -> (type, help, {label text: Counter | Histogram | callable})
+_families: dict = {}
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n: int = 1) -> None:
+        self.value += n
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Iterable[float]):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)  # per bucket, last is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile: 0.0 with no
+        observations, inf if it lies past the last bound."""
+        rank, total = q * self.count, 0
+        for bound, n in zip(self.bounds, self.counts):
+            total += n
+            if total >= rank and total:
+                return bound
+        return float("inf") if self.count else 0.0
+
+
+def _labels(labels: dict) -> str:
+    return ",".join(f'{k}="{v}"' for k, v in labels.items())
+
+
+def _series(name: str, kind: str, help: str, labels: dict, make: Callable):
+    family = _families.setdefault(name, (kind, help, {}))
+    series = family[2]
+    key = _labels(labels)
+    if key not in series:
+        series[key] = make()
+    return series[key]
+
+
+def counter(name: str, help: str, **labels) -> Counter:
+    return _series(name, "counter", help, labels, Counter)
+
+
+def histogram(name: str, help: str, buckets: Iterable[float] = LATENCY_BUCKETS,
+              **labels) -> Histogram:
+    return _series(name, "histogram", help, labels, lambda: Histogram(buckets))
+
+
+def gauge(name: str, help: str, read: Callable[[], float], **labels) -> None:
+    """Register a gauge whose value is read() at scrape time (replaces any earlier read)."""
+    _families.setdefault(name, ("gauge", help, {}))[2][_labels(labels)] = read
+
+
+def _braces(key: str, extra: str = "") -> str:
+    inner = ",".join(p for p in (key, extra) if p)
+    return f"{{{inner}}}" if inner else ""
+
+
+def render() -> str:
+    """Every metric, in the Prometheus text exposition format (version 0.0.4)."""
+    out = []
+    for name, (kind, help, series) in _families.items():
+        out.append(f"# HELP {name} {help}")
+        out.append(f"# TYPE {name} {kind}")
+        for key, m in series.items():
+            if kind == "counter":
+                out.append(f"{name}{_braces(key)} {m.value}")
+            elif kind == "gauge":
+                try:
+                    value = m()
+                except Exception:
+                    continue    # a broken reader costs its series, not the scrape
+                out.append(f"{name}{_braces(key)} {value}")
+            else:
+                total = 0
+                for bound, n in zip(m.bounds + ("+Inf",), m.counts):
+                    total += n
+                    le = _braces(key, f'le="{bound}"')
+                    out.append(f"{name}_bucket{le} {total}")
+                out.append(f"{name}_sum{_braces(key)} {m.sum}")
+                out.append(f"{name}_count{_braces(key)} {m.count}")
+    return "\n".join(out) + "\n"
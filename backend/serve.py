@@ -0,0 +1,70 @@
+# app/serve.py
+"""
+Production entry point: uvicorn with an explicit server profile.
+
+    python serve.py                       # SERVER_PROFILE=fast
+    SERVER_PROFILE=portable python serve.py
+
+uvicorn's "auto" already picks uvloop and httptools when they are installed,
+which uvicorn[standard] does, so "fast" only pins down what was implicit. It
+also means a missing wheel fails loudly here instead of quietly turning into a
+slower server. "portable" is pure Python end to end, for platforms without
+those wheels and for comparison (bench/bench_server_profiles.py).
+
+SERVER_LOOP, SERVER_HTTP and SERVER_WS override one part of a profile. The
+resolved choice goes back into the environment, where main.py reads it for
+/ping. Listens on PORT (default 8080) with the same flags as the Dockerfile
+used to pass: 64 KB frames, no proxy headers.
+"""
+import os
+import logging
+
+import uvicorn
+from dotenv import load_dotenv
+
+logger = logging.getLogger("yawnfox.serve")
+
+PROFILES = {
+    "fast": {"loop": "uvloop", "http": "httptools", "ws": "websockets"},
+    "portable": {"loop": "asyncio", "http": "h11", "ws": "wsproto"},
+}
+
+
+def resolve() -> dict:
+    """The profile to run: SERVER_PROFILE, then the per-part overrides."""
+    name = os.environ.get("SERVER_PROFILE", "fast").strip().lower()
+    if name not in PROFILES:
+        logger.warning(f"unknown SERVER_PROFILE {name!r}, using fast")
+        name = "fast"
+    profile = dict(PROFILES[name])
+    for part in profile:
+        override = os.environ.get(f"SERVER_{part.upper()}", "").strip().lower()
+        if override:
+            profile[part] = override
+    return profile
+
+
+def main():
+    load_dotenv()       # as main.py does, so SERVER_* can live in .env too
+    # Configured as main.py does it: whichever call comes first wins, and
+    # this one runs before uvicorn imports main.
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    profile = resolve()
+    for part, choice in profile.items():
+        os.environ[f"SERVER_{part.upper()}"] = choice
+    logger.info(f"server profile: {profile}")
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "8080")),
+        ws_max_size=65536,
+        proxy_headers=False,
+        **profile,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -22,36 +22,118 @@ Connection (Redis mode):
 import os
 import json
 import time
+import hashlib
 import uuid
+import secrets
+import zlib
 import asyncio
 import logging
+import itertools
+from collections import OrderedDict, deque
 from typing import Optional, Callable, Awaitable, Iterable
 
 import redis.asyncio as redis
-from redis.exceptions import RedisError
+from redis.commands.core import AsyncCoreCommands
+from redis.exceptions import RedisError, NoScriptError
+
+import metrics
+import matching
 
 logger = logging.getLogger("yawnfox.store")
 
 # --- Keys / config ---
 PREFIX = "yf"
-WAITING_KEY = f"{PREFIX}:waiting"           # ZSET: member=ws_id, score=enqueue_ms
+WAITING_KEY = f"{PREFIX}:waiting"           # ZSET: member=ws_id, score=enqueue_ms (shard 0)
 WAKEUP_CHANNEL = f"{PREFIX}:wakeup"         # matcher wakeup fan-out
-CHAN_PREFIX = f"{PREFIX}:chan:"             # per-client delivery channel prefix
-CHAN_PATTERN = f"{CHAN_PREFIX}*"
-MATCHER_LOCK_KEY = f"{PREFIX}:matcher:lock"
-# Long enough that a realistic worst-case pass finishes inside it: 200 pairings x
-# (1 EVAL + 1 set_partners + 2 publishes) ~= 800 round-trips ~= 4s at Upstash RTT,
-# which was a coin flip against the previous 5000. Not refreshed mid-pass — the
+INST_CHAN_PREFIX = f"{PREFIX}:inst:"        # per-instance delivery channel prefix
+MATCHER_LOCK_KEY = f"{PREFIX}:matcher:lock"  # cross-shard pass; shards append ":<n>"
+# Long enough that a realistic worst-case pass finishes inside it. Sized when a
+# pairing cost 4 round-trips (200 pairings ~= 800 RTTs ~= 4s at Upstash RTT, a
+# coin flip against the previous 5000); batching made that ~2 RTTs per batch of
+# up to MATCH_BATCH pairs, so it is now very generous. Not refreshed mid-pass — the
 # lock is only a throughput optimisation now that _MATCH_LUA is atomic, and
 # run_matcher_rounds stops itself at 80% of this rather than outlive it.
 MATCHER_LOCK_MS = 15000
 
 # Only the head of the waiting queue can ever be matched, so the matcher reads a
-# bounded window of it instead of the whole pool. This bounds *topic search
-# quality*, never liveness: the fallback always pairs the two oldest live clients,
-# so nobody starves behind a window they cannot see past.
+# bounded window of it instead of the whole pool. It bounds neither liveness (the
+# fallback always pairs the two oldest live clients, so nobody starves behind a
+# window they cannot see past) nor, since the topic index, topic search quality:
+# a topic peer is looked up in the index wherever it is queued.
 MATCH_WINDOW = 64
 
+# Most pairs one _MATCH_LUA call may form. A window can never yield more than
+# half its size, so this is the "whole window" setting; it exists to bound how
+# long a single script holds Redis when the window is deep in live clients.
+MATCH_BATCH = MATCH_WINDOW // 2
+
+# The waiting pool is split into this many shards, each its own ZSET with its own
+# matcher lock, so that N instances can run N matcher passes at once. One pool
+# behind one lock capped the fleet at one pass's worth of round-trips (~50
+# pairs/s at Upstash RTT) however many machines were added.
+#
+# A client is queued in the shard of its (alphabetically) first topic, so people
+# who share a topic still meet inside one shard's topic search; clients with no
+# topics are spread by ws_id. What a shard cannot see — its single leftover next
+# to another shard's — is picked up by a cross-shard pass over the shard heads,
+# which keeps the liveness guarantee: two live waiters are never left unpaired.
+#
+# Every instance must agree on this value. Changing it strands clients queued in
+# a shard that no longer exists until they press Next, so change it with a deploy.
+MATCH_SHARDS = max(1, int(os.environ.get("MATCH_SHARDS", "1")))
+
+# How a shard pass picks its pairs. "greedy", the default, is _MATCH_LUA: the
+# oldest waiter takes the oldest peer sharing a topic, head after head. "window"
+# reads the shard's MATCH_WINDOW oldest live clients (_WINDOW_LUA), finds the
+# pairing with the most shared topics among them here, in matching.solve(), and
+# claims it in one command (_CLAIM_LUA). A pass is two commands however many
+# pairs it forms, and the solve spends this instance's CPU, under a budget
+# (MATCH_SOLVE_MS), rather than Redis's, where a long script stalls every
+# client. A client with topics is held back up to MATCH_HOLD_MS for a topic peer,
+# so matcher_loop also wakes when the next one ripens (match_due()). The
+# cross-shard pass solves the shards' windows as one pool, under the same hold
+# (_cross_window_pass). Claims check each client is still queued as read, so
+# instances in different modes (a deploy switching) only disagree about which
+# pairs are best. See matching.py.
+MATCH_MODE = os.environ.get("MATCH_MODE", "greedy").strip().lower()
+if MATCH_MODE not in ("greedy", "window"):
+    logger.warning(f"unknown MATCH_MODE {MATCH_MODE!r}, using greedy")
+    MATCH_MODE = "greedy"
+
+# Redis Cluster. A script may only touch keys in one hash slot, and most of ours
+# reach well past what they declare: the match scripts read the conn key and
+# lease of every member they see, the heartbeat sweeps every instance's clients.
+# So with REDIS_CLUSTER=true the keyspace is cut into MATCH_SHARDS slot groups,
+# each with a hash tag of its own (yf:{3}:...), and each laid out exactly like a
+# single-node, single-shard deployment: yf:{3}:waiting is that group's shard, and
+# yf:{3}:conn:<id>, yf:{3}:lease:<instance> and the rest sit beside it. A
+# client's keys all live in its home group, picked by its ws_id, and it is
+# queued there whatever its topics, so every script still sees one slot and
+# runs unchanged. Groups spread over the nodes, and with them the pool and its
+# matcher passes, which one yf:waiting ZSET on one node's CPU could not.
+#
+# What no longer fits in one slot is split into one call per group: the
+# heartbeat (each group holds its own copy of every lease), disconnect batches,
+# rate-limit syncs, pool counts and the cross-shard pass, which reads each
+# group's head and then claims the two members of a pair one group at a time.
+# A pair formed across groups has its partner keys in two slots, so unpairing
+# it clears the other side with a second call (see _UNPAIR_LUA).
+#
+# The scripts do not name every key they touch in KEYS, as the Cluster docs ask:
+# most only learn theirs by reading (a member's topics, the owners in a lease
+# sweep), and the rest are built in Lua from the group prefix passed in ARGV.
+# Each call declares at least one key of its group, which routes it, and every
+# key it builds carries that key's hash tag, so it stays in the declared slot.
+# Redis allows that for scripts without shebang flags (none of ours has one);
+# a server that enforces declared keys (Dragonfly by default) does not.
+#
+# The cost: topics no longer choose the shard, so two clients sharing a topic
+# only meet by topic when they share a group or both reach its head. Use as few
+# groups as spread the load: a couple per node. Pub/sub and the health probe
+# use a plain connection to the node in REDIS_URL; classic pub/sub reaches the
+# whole cluster from any node.
+REDIS_CLUSTER = os.environ.get("REDIS_CLUSTER", "false").strip().lower() == "true"
+
 # How long the pub/sub link may stay silent before we make it prove it is alive.
 # Only a *hung* server needs this: one that drops the socket raises out of
 # get_message immediately and for free. That case is rare, so the probe is
@@ -62,76 +144,450 @@ MATCH_WINDOW = 64
 HEALTH_PING_SECONDS = int(os.environ.get("HEALTH_PING_SECONDS", "120"))
 HEALTH_PING_TIMEOUT = 5
 
-CONN_TTL = int(os.environ.get("CONN_TTL", "90"))            # presence key ttl (s)
-PARTNER_TTL = int(os.environ.get("PARTNER_TTL", "300"))     # partner mapping ttl (s)
-TOPICS_TTL = int(os.environ.get("TOPICS_TTL", "1800"))      # waiting topics ttl (s)
+# Presence is an instance lease, not a TTL per client. A client's conn key names
+# the instance that owns it and carries no TTL; it counts as connected only while
+# that instance's lease (yf:lease:<instance>) exists. The heartbeat renews the
+# lease every LEASE_TTL / 3, one O(1) command, where it used to EXPIRE three keys
+# per connected client in one script (20k sockets: a 60k-call EVAL holding Redis
+# for tens of ms, with every ws_id in the payload). When an instance dies its
+# clients all become ghosts at once, LEASE_TTL later, and the next heartbeat on
+# any instance sweeps their keys away. See _LEASE_LUA.
+LEASE_TTL = int(os.environ.get("LEASE_TTL", "90"))          # instance lease ttl (s)
+TOPICS_TTL = int(os.environ.get("TOPICS_TTL", "1800"))      # topic index ttl (s)
+
+# Daily Redis command budget for the whole fleet (UTC days; Upstash bills per
+# command). 0 turns the governor off; commands are counted either way. Every
+# command this instance sends is counted per operation (see _bill), and each
+# heartbeat adds what it sent since the last one to a shared counter for the day
+# inside _LEASE_LUA, so learning the fleet's total costs no extra command. From
+# REDIS_BUDGET_SOFT of the budget the optional intervals stretch, linearly up to
+# BUDGET_MAX_STRETCH times at the budget: the matcher's poll fallback, the
+# pub/sub health probe and the heartbeat (never past LEASE_TTL / 2, which keeps
+# the lease). At the budget, rate-limit syncs stop too and each instance limits
+# on its own admissions. Matching and relay are never held back: a bill over
+# budget is better than an app that stops pairing people.
+REDIS_DAILY_BUDGET = int(os.environ.get("REDIS_DAILY_BUDGET", "0"))
+REDIS_BUDGET_SOFT = 0.8
+BUDGET_MAX_STRETCH = 4.0
+
+# Send the commands issued in one event-loop iteration as one pipeline (see
+# _AutoPipeline). "false" sends each on its own, as redis-py does by default;
+# kept for comparison (bench/bench_autopipeline.py) and as an escape hatch.
+REDIS_AUTOPIPELINE = os.environ.get("REDIS_AUTOPIPELINE", "true").strip().lower() != "false"
+
+# How a client's state is laid out. "keys", the default, is up to three keys per
+# client: yf:conn:<id> (its instance), yf:partner:<id> and yf:topics:<id> (a
+# SET). "hash" is one hash per client, yf:c:<id>, with a field o (instance), p
+# (partner) and one "t:<topic>" per topic. Redis pays a dictionary entry and a
+# key object for every top-level key before storing anything in it, and the
+# topics SET a container of its own on top; a hash this small is one listpack
+# (far under hash-max-listpack-entries and -value), so a client costs one key's
+# overhead instead of three. Ids shrink to match: new_client_id() hands out 22
+# url-safe characters (128 random bits) where a uuid4 string takes 36, and each
+# key, field and set member naming a client carries one. Scripts reach client
+# state only through _CLIENT_LUA, so nothing else depends on the layout. Every
+# instance must use the same one, and a switch strands the state of whoever is
+# connected at the time, so change it with a full deploy.
+CLIENT_LAYOUT = os.environ.get("CLIENT_LAYOUT", "keys").strip().lower()
+if CLIENT_LAYOUT not in ("keys", "hash"):
+    logger.warning(f"unknown CLIENT_LAYOUT {CLIENT_LAYOUT!r}, using keys")
+    CLIENT_LAYOUT = "keys"
+
+# Which instance owns a client never changes while it is connected, so route()
+# remembers the answer instead of asking Redis per relayed frame. Bounded: an
+# entry costs ~150 bytes and a stale one (client since gone) only means a frame
+# is published to an instance that drops it, exactly as a lookup miss would.
+OWNER_CACHE_SIZE = int(os.environ.get("OWNER_CACHE_SIZE", "10000"))
+
+# Disconnects are undone in batches: the first one to arrive opens a window of
+# this long, and everyone who disconnects inside it shares one _DISCONNECT_LUA
+# call (split into calls of at most DISCONNECT_BATCH_MAX, so no single script
+# holds Redis for long). A lone disconnect pays the window in latency, which
+# nobody is waiting on; a storm of 10k pays ~20 commands instead of ~40k.
+DISCONNECT_BATCH_MS = 50
+DISCONNECT_BATCH_MAX = 500
 
 RATE_LIMIT_MAX = int(os.environ.get("RATE_LIMIT_MAX", "5"))
 RATE_LIMIT_WINDOW = int(os.environ.get("RATE_LIMIT_WINDOW", "60"))  # seconds
 
+# The connection limiter decides in-process. Admissions are pushed to Redis, and
+# the fleet-wide count per IP read back, in one _RATE_SYNC_LUA call per
+# RATE_LIMIT_SYNC_MS covering every IP seen in that interval. What the read-back
+# leaves of an IP's quota is a lease this instance may spend locally for the next
+# RATE_LIMIT_SYNC_MS. An IP's first connection in a window needs no lease, so the
+# usual visitor never waits on Redis before accept() (it used to be one EVAL on
+# the critical path per connection); a repeat visitor whose lease has gone stale
+# waits for one sync of its own, shared by its concurrent attempts. Across
+# instances an IP can exceed RATE_LIMIT_MAX by at most one connection per extra
+# instance per window. RATE_LIMIT_LOCAL_IPS bounds the per-IP state kept in
+# memory (least recently seen evicted first, ~300 bytes each).
+RATE_LIMIT_SYNC_MS = int(os.environ.get("RATE_LIMIT_SYNC_MS", "1000"))
+RATE_LIMIT_LOCAL_IPS = int(os.environ.get("RATE_LIMIT_LOCAL_IPS", "100000"))
+
+# How Redis keeps the fleet-wide count per IP (see _RATE_SYNC_LUA):
+#   "gcra"     one integer per IP (its theoretical arrival time). Constant memory;
+#              the count drains evenly over the window instead of sliding.
+#   "buckets"  a small hash per IP: this window's and last window's counts,
+#              weighted by how far into this window we are. Constant memory.
+#   "zset"     one ZSET member per admitted connection: an exact sliding window,
+#              but memory and work grow with the attempts it holds, which is
+#              what a flood from many IPs makes expensive.
+# Each engine has its own keys, so switching needs no cleanup: counts simply
+# start from zero.
+RATE_LIMIT_ENGINE = os.environ.get("RATE_LIMIT_ENGINE", "gcra").strip().lower()
+if RATE_LIMIT_ENGINE not in ("gcra", "buckets", "zset"):
+    logger.warning(f"unknown RATE_LIMIT_ENGINE {RATE_LIMIT_ENGINE!r}, using gcra")
+    RATE_LIMIT_ENGINE = "gcra"
+
+
+def group_of(key_id: str) -> int:
+    """Slot group of a client (by ws_id) or an IP: always 0 on a single node."""
+    if not REDIS_CLUSTER or MATCH_SHARDS == 1:
+        return 0
+    return zlib.crc32(key_id.encode()) % MATCH_SHARDS
+
+
+def _prefix(group: int) -> str:
+    """Key prefix of a slot group: "yf:" on a single node, "yf:{<group>}:" on a cluster."""
+    return f"{PREFIX}:{{{group}}}:" if REDIS_CLUSTER else f"{PREFIX}:"
+
+
+def _groups() -> range:
+    return range(MATCH_SHARDS if REDIS_CLUSTER else 1)
+
+
+def _group_shards(group: int) -> list:
+    """The waiting ZSETs of a slot group, in shard order: all of them on a single
+    node, where the one group is the whole keyspace; its own on a cluster."""
+    if REDIS_CLUSTER:
+        return [waiting_key(group)]
+    return [waiting_key(s) for s in range(MATCH_SHARDS)]
+
+
+def waiting_key(shard: int) -> str:
+    # Shard 0 keeps the historical key, so the default single-shard layout is
+    # exactly what it was before sharding existed.
+    if REDIS_CLUSTER:
+        return f"{_prefix(shard)}waiting"
+    return WAITING_KEY if shard == 0 else f"{WAITING_KEY}:{shard}"
+
+
+def matcher_lock_key(shard: Optional[int]) -> str:
+    """Lock for one shard's pass, or (shard=None) for the cross-shard pass."""
+    if shard is None:
+        return MATCHER_LOCK_KEY
+    return f"{_prefix(shard)}matcher:lock" if REDIS_CLUSTER else f"{MATCHER_LOCK_KEY}:{shard}"
+
+
+def shard_for(ws_id: str, topics: Iterable[str] = ()) -> int:
+    """The shard a client is queued in. See MATCH_SHARDS (and REDIS_CLUSTER)."""
+    if MATCH_SHARDS == 1:
+        return 0
+    if REDIS_CLUSTER:
+        return group_of(ws_id)
+    norm = [t for t in topics if t]
+    key = min(norm) if norm else ws_id
+    return zlib.crc32(key.encode()) % MATCH_SHARDS
+
+
+def topic_index_key(shard: int, topic: str) -> str:
+    """ZSET of the clients queued in `shard` with `topic` (score = enqueue_ms)."""
+    if REDIS_CLUSTER:
+        return f"{_prefix(shard)}topic:0:{topic}"   # its group's only shard
+    return f"{PREFIX}:topic:{shard}:{topic}"
+
+
+def lease_key(instance: str, group: int = 0) -> str:
+    return f"{_prefix(group)}lease:{instance}"
+
+
+def clients_key(instance: str, group: int = 0) -> str:
+    """SET of the clients an instance owns: what the sweeper clears if it dies."""
+    return f"{_prefix(group)}clients:{instance}"
 
+
+def client_key(ws_id: str) -> str:
+    """A client's hash under CLIENT_LAYOUT=hash."""
+    return f"{_prefix(group_of(ws_id))}c:{ws_id}"
+
+
+# Under CLIENT_LAYOUT=hash these three are all client_key(): what a script
+# call declares for a client, whichever part of it the script touches.
 def conn_key(ws_id: str) -> str:
-    return f"{PREFIX}:conn:{ws_id}"
+    if CLIENT_LAYOUT == "hash":
+        return client_key(ws_id)
+    return f"{_prefix(group_of(ws_id))}conn:{ws_id}"
 
 
 def partner_key(ws_id: str) -> str:
-    return f"{PREFIX}:partner:{ws_id}"
+    if CLIENT_LAYOUT == "hash":
+        return client_key(ws_id)
+    return f"{_prefix(group_of(ws_id))}partner:{ws_id}"
 
 
 def topics_key(ws_id: str) -> str:
-    return f"{PREFIX}:topics:{ws_id}"
+    if CLIENT_LAYOUT == "hash":
+        return client_key(ws_id)
+    return f"{_prefix(group_of(ws_id))}topics:{ws_id}"
+
+
+def new_client_id() -> str:
+    """A fresh ws_id: a uuid4 string, or under CLIENT_LAYOUT=hash 22 url-safe
+    characters of random. Never holds a space (see _frame_header)."""
+    if CLIENT_LAYOUT == "hash":
+        return secrets.token_urlsafe(16)
+    return str(uuid.uuid4())
+
 
+def inst_chan(instance: str) -> str:
+    return f"{INST_CHAN_PREFIX}{instance}"
 
-def chan_key(ws_id: str) -> str:
-    return f"{CHAN_PREFIX}{ws_id}"
+
+def budget_key(day: str) -> str:
+    return f"{_prefix(0)}cmds:{day}"
 
 
 def rate_key(ip: str) -> str:
-    return f"{PREFIX}:rl:{ip}"
+    return f"{_prefix(group_of(ip))}{_RATE_KEY_TAG[RATE_LIMIT_ENGINE]}:{ip}"
+
+
+_RATE_KEY_TAG = {"zset": "rl", "gcra": "rlg", "buckets": "rlb"}
 
 
 # --- Module state ---
 # Two variables, deliberately: _client is the redis-py client object, built once
-# and kept for the life of the process; _redis is that same object only while the
-# connection is known to work, and None otherwise. Everything else in this module
-# guards on `if not _redis`, so health is enforced in one place and an outage
+# and kept for the life of the process; _redis is that same client (behind its
+# _AutoPipeline, unless REDIS_AUTOPIPELINE is off) only while the connection is
+# known to work, and None otherwise. Everything else in this module guards on
+# `if not _redis`, so health is enforced in one place and an outage
 # short-circuits every operation instead of blocking on a dead socket. See
 # _set_redis_up() for who flips it.
 _client: Optional[redis.Redis] = None
-_redis: Optional[redis.Redis] = None
+_commands = None               # what _redis is when up: _client or its _AutoPipeline
+_redis = None
 _pubsub = None
+_pubsub_client: Optional[redis.Redis] = None  # _client, or under REDIS_CLUSTER a plain one
 _instance_id: str = os.environ.get("FLY_MACHINE_ID") or uuid.uuid4().hex
-_local_delivery: Optional[Callable[[str, str], Awaitable[bool]]] = None
+_local_delivery: Optional[Callable[..., Awaitable[bool]]] = None
 _on_wakeup: Optional[Callable[[], None]] = None
+_owner_cache: OrderedDict = OrderedDict()  # ws_id -> owning instance id, LRU
+_outbox: dict = {}             # instance id -> [(ws_id, text), ...] awaiting publish
+_outbox_since: dict = {}       # instance id -> time.time() its oldest outbox frame was queued
+_flusher: Optional[asyncio.Task] = None
+_disconnects: list = []        # [(ws_id, future)] waiting for the next batch
+_batches: set = set()          # batch flush tasks in flight (the loop holds them weakly)
+_orphans: list = []            # ws_ids whose disconnect never reached Redis
+_rate_local: OrderedDict = OrderedDict()  # ip -> _IpWindow, least recently seen first
+_rate_dirty: set = set()       # IPs seen since the last sync
+_rate_evicted: OrderedDict = OrderedDict()  # ip -> _IpWindow pushed out of _rate_local unsynced
+_rate_syncs: int = 0           # rate limit sync calls made, naming each one's admissions
+_lease_held: bool = False      # we have held a lease since starting
+_leased_groups: set = set()    # slot groups it was held in (just {0} unless REDIS_CLUSTER)
+_unreported: int = 0           # commands sent since a heartbeat last reported them
+_budget_day: str = ""          # UTC day (YYYYMMDD) of _fleet_used
+_fleet_used: int = 0           # the fleet's commands that day, as of the last heartbeat
+_lease_lost: bool = False      # ...and it lapsed since: our clients may have been swept
 
 # In-memory mode: active when REDIS_URL is not configured.
 # Redis code is kept intact for future horizontal scaling.
 _inmemory_mode: bool = not bool((os.environ.get("REDIS_URL") or "").strip())
 
+# Waiting clients per shard as of the last waiting_counts(), which every matcher
+# pass starts with. /metrics reports this rather than spend a command per scrape.
+pool_counts: list = [0] * (1 if _inmemory_mode else MATCH_SHARDS)
+
 # In-memory state (used only when _inmemory_mode is True)
-_mem_waiting: dict = {}        # ws_id -> enqueue_ms
+# The waiting pool is kept in queue order rather than sorted on demand: a
+# re-queue moves a client to the back, exactly as a newer ZADD score does, so the
+# head is always next(iter(...)) and a topic's oldest peer is the first entry of
+# its index. Matching is O(topics) per pair instead of a sort of the pool per round.
+_mem_waiting: OrderedDict = OrderedDict()  # ws_id -> queue position, oldest first
+_mem_topic_index: dict = {}    # topic -> OrderedDict[ws_id, None], oldest first
 _mem_partners: dict = {}       # ws_id -> partner_ws_id (stored both directions)
 _mem_topics: dict = {}         # ws_id -> set[str]
+_mem_since: dict = {}          # ws_id -> enqueued at, epoch ms (MATCH_MODE=window)
 _mem_connections: set = set()  # registered ws_ids
 _mem_matcher_locked: bool = False
+_mem_seq = itertools.count()   # queue positions: ties in enqueue_ms still order
 
 
 # --- Lua scripts (run atomically inside Redis) ---
-_RATE_LIMIT_LUA = """
+
+# A client's state, for every script below, in the layout CLIENT_LAYOUT picks:
+# its instance (owner_*), partner (partner_*) and topics (topics_*), each
+# addressed by key prefix and ws_id. client_del() drops all of it.
+_CLIENT_KEYS_LUA = """
+local function owner_get(prefix, id) return redis.call('GET', prefix .. 'conn:' .. id) end
+local function owner_set(prefix, id, o) redis.call('SET', prefix .. 'conn:' .. id, o) end
+local function partner_get(prefix, id) return redis.call('GET', prefix .. 'partner:' .. id) end
+local function partner_set(prefix, id, p) redis.call('SET', prefix .. 'partner:' .. id, p) end
+local function partner_del(prefix, id) redis.call('DEL', prefix .. 'partner:' .. id) end
+local function topics_get(prefix, id) return redis.call('SMEMBERS', prefix .. 'topics:' .. id) end
+local function topics_has(prefix, id, t)
+  return redis.call('SISMEMBER', prefix .. 'topics:' .. id, t) == 1
+end
+local function topics_add(prefix, id, t) redis.call('SADD', prefix .. 'topics:' .. id, t) end
+local function topics_del(prefix, id) redis.call('DEL', prefix .. 'topics:' .. id) end
+local function client_del(prefix, id)
+  redis.call('DEL', prefix .. 'conn:' .. id, prefix .. 'partner:' .. id, prefix .. 'topics:' .. id)
+end
+"""
+
+# CLIENT_LAYOUT=hash: yf:c:<id> {o = instance, p = partner, t:<topic> = ''}.
+# Redis deletes the hash with its last field, as the keys layout leaves no key.
+_CLIENT_HASH_LUA = """
+local function owner_get(prefix, id) return redis.call('HGET', prefix .. 'c:' .. id, 'o') end
+local function owner_set(prefix, id, o) redis.call('HSET', prefix .. 'c:' .. id, 'o', o) end
+local function partner_get(prefix, id) return redis.call('HGET', prefix .. 'c:' .. id, 'p') end
+local function partner_set(prefix, id, p) redis.call('HSET', prefix .. 'c:' .. id, 'p', p) end
+local function partner_del(prefix, id) redis.call('HDEL', prefix .. 'c:' .. id, 'p') end
+local function topics_get(prefix, id)
+  local f = redis.call('HKEYS', prefix .. 'c:' .. id)
+  local out = {}
+  for i = 1, #f do
+    if string.sub(f[i], 1, 2) == 't:' then out[#out + 1] = string.sub(f[i], 3) end
+  end
+  return out
+end
+local function topics_has(prefix, id, t)
+  return redis.call('HEXISTS', prefix .. 'c:' .. id, 't:' .. t) == 1
+end
+local function topics_add(prefix, id, t) redis.call('HSET', prefix .. 'c:' .. id, 't:' .. t, '') end
+local function topics_del(prefix, id)
+  local t = topics_get(prefix, id)
+  for i = 1, #t do t[i] = 't:' .. t[i] end
+  if #t > 0 then redis.call('HDEL', prefix .. 'c:' .. id, unpack(t)) end
+end
+local function client_del(prefix, id) redis.call('DEL', prefix .. 'c:' .. id) end
+"""
+
+_CLIENT_LUA = _CLIENT_HASH_LUA if CLIENT_LAYOUT == "hash" else _CLIENT_KEYS_LUA
+
+# Liveness under the lease model, shared by the match scripts: a client's owner
+# if it is connected, nil for a ghost (no conn key, or its instance's lease has
+# expired). Lease lookups are memoised per call: a window of 64 clients spans a
+# handful of instances. Expects `prefix` and _CLIENT_LUA to be defined.
+_LIVE_LUA = _CLIENT_LUA + """
+local leases = {}
+local function owner_of(id)
+  local o = owner_get(prefix, id)
+  if not o then return nil end
+  if leases[o] == nil then
+    leases[o] = redis.call('EXISTS', prefix .. 'lease:' .. o) == 1
+  end
+  if leases[o] then return o end
+  return nil
+end
+"""
+
+# Undo one client, for _DISCONNECT_LUA and the sweeper: unpair (both directions,
+# as _CLEAR_PARTNER_LUA), leave the pool and the topic index (as
+# _REMOVE_WAITING_LUA), drop presence and its entry in its instance's client set.
+# Every partner is appended to `out` as {id, partner, partner's instance} so
+# the caller can send PARTNER_LEFT straight there; the instance is '' for one
+# that is not connected (nobody would read it) or, under REDIS_CLUSTER, lives in
+# another slot group, out of this script's reach (see _partners_left).
+# KEYS = the shard ZSETs.
+_UNDO_LUA = _CLIENT_LUA + """
+local function undo(prefix, id, out)
+  local p = partner_get(prefix, id)
+  if p then
+    partner_del(prefix, id)
+    partner_del(prefix, p)
+    local po = owner_get(prefix, p)
+    if not po or redis.call('EXISTS', prefix .. 'lease:' .. po) == 0 then po = '' end
+    out[#out + 1] = id
+    out[#out + 1] = p
+    out[#out + 1] = po
+  end
+  local t = topics_get(prefix, id)
+  for i = 1, #KEYS do
+    if redis.call('ZREM', KEYS[i], id) == 1 then
+      for j = 1, #t do
+        redis.call('ZREM', prefix .. 'topic:' .. (i - 1) .. ':' .. t[j], id)
+      end
+    end
+  end
+  local o = owner_get(prefix, id)
+  if o then redis.call('SREM', prefix .. 'clients:' .. o, id) end
+  client_del(prefix, id)
+end
+"""
+
+# The Redis side of the connection limiter, one script per RATE_LIMIT_ENGINE.
+# Each takes, for every IP in KEYS, the admissions this instance made since its
+# last sync, and returns how many the IP's window now holds fleet-wide. ARGV =
+# now_ms, window_ms, RATE_LIMIT_MAX, the call's name (instance:sequence, unique
+# to this sync call), then one count per key.
+
+# "zset": one member per admission, an exact sliding window.
+_RATE_ZSET_LUA = """
 local now = tonumber(ARGV[1])
 local window = tonumber(ARGV[2])
-local maxc = tonumber(ARGV[3])
-redis.call('ZREMRANGEBYSCORE', KEYS[1], 0, now - window)
-local count = redis.call('ZCARD', KEYS[1])
-if count >= maxc then
-  return 0
-end
-redis.call('ZADD', KEYS[1], now, ARGV[4])
-redis.call('PEXPIRE', KEYS[1], window)
-return 1
+local out = {}
+for i = 1, #KEYS do
+  local n = tonumber(ARGV[i + 4])
+  redis.call('ZREMRANGEBYSCORE', KEYS[i], 0, now - window)
+  for j = 1, n do
+    redis.call('ZADD', KEYS[i], now, ARGV[4] .. ':' .. now .. ':' .. j)
+  end
+  if n > 0 then redis.call('PEXPIRE', KEYS[i], window) end
+  out[i] = redis.call('ZCARD', KEYS[i])
+end
+return out
+"""
+
+# "gcra": the key holds the IP's theoretical arrival time (ms). Each admission
+# pushes it window / max further into the future, and it is never behind now, so
+# how far ahead it is says how many admissions the window still holds. Expires
+# when it would read zero.
+_RATE_GCRA_LUA = """
+local now = tonumber(ARGV[1])
+local step = tonumber(ARGV[2]) / tonumber(ARGV[3])
+local out = {}
+for i = 1, #KEYS do
+  local n = tonumber(ARGV[i + 4])
+  local tat = math.max(tonumber(redis.call('GET', KEYS[i]) or 0), now)
+  if n > 0 then
+    tat = math.floor(tat + n * step)
+    redis.call('SET', KEYS[i], tat, 'PX', math.max(tat - now, 1))
+  end
+  out[i] = math.ceil((tat - now) / step)
+end
+return out
 """
 
-# Form ONE pair, atomically, in one command.
+# "buckets": a hash of the current window's number (b) and the counts of it (c)
+# and of the one before (p). The estimate weights p by the share of the sliding
+# window that still overlaps the previous fixed one.
+_RATE_BUCKETS_LUA = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local idx = math.floor(now / window)
+local weight = 1 - (now % window) / window
+local out = {}
+for i = 1, #KEYS do
+  local n = tonumber(ARGV[i + 4])
+  local h = redis.call('HMGET', KEYS[i], 'b', 'c', 'p')
+  local b, c, p = tonumber(h[1]) or idx, tonumber(h[2]) or 0, tonumber(h[3]) or 0
+  if b == idx - 1 then
+    p, c = c, 0
+  elseif b < idx - 1 then
+    p, c = 0, 0
+  end
+  if n > 0 or b ~= idx then
+    c = c + n
+    redis.call('HSET', KEYS[i], 'b', idx, 'c', c, 'p', p)
+    redis.call('PEXPIRE', KEYS[i], 2 * window)
+  end
+  out[i] = math.ceil(p * weight + c)
+end
+return out
+"""
+
+_RATE_SYNC_LUA = {"zset": _RATE_ZSET_LUA, "gcra": _RATE_GCRA_LUA, "buckets": _RATE_BUCKETS_LUA}
+
+# Form up to ARGV[3] pairs, atomically, in one command.
 #
 # This used to be a read-scan-pop dance in Python: ZRANGE the whole waiting pool,
 # then an EXISTS and (when the head client had topics) a SMEMBERS per candidate,
@@ -140,51 +596,290 @@ return 1
 # topic preference and the pop all happen inside Redis, so a pairing costs one
 # billed command whatever the pool depth.
 #
-# Selection semantics are unchanged from that Python version: the oldest live
-# waiter is the candidate (fairness), preferring the first peer sharing a topic,
-# otherwise falling back to the longest-waiting live peer.
+# It then went from one pair per call to a batch per window scan. One pair per
+# call cost an EVAL, a set_partners MULTI and two publishes, each awaited in
+# turn: ~4 RTTs a pair, ~800 for a 200-pair pass. Now the partner keys are
+# written here too, and each member's owning instance (the value of its conn
+# key, see _LIVE_LUA) is returned with it, so the caller can send every
+# PARTNER_FOUND of the batch in one pipeline: a batch costs two round-trips
+# however many pairs it holds.
+#
+# Topic peers come from the shard's topic index (yf:topic:<shard>:<topic>, see
+# _ENQUEUE_LUA) rather than a SMEMBERS of every window member: one ZRANGE per
+# topic of the candidate, and it sees the whole shard, where the window scan
+# could never find a peer queued more than MATCH_WINDOW places back. The index
+# is kept exact on enqueue, remove and pop; entries that still go stale (a ghost,
+# or a re-queue that skipped remove_waiting) are cleared as they are met.
+#
+# Selection: the oldest unpaired live waiter is the candidate (fairness),
+# paired with the oldest live waiter sharing one of its topics, otherwise the
+# longest-waiting unpaired peer. Repeated over the window until the batch fills.
 #
 # Popping both members here also makes the pop atomic by construction, which is
 # what _POP_PAIR_LUA used to buy separately — two instances racing can no longer
 # double-match or orphan a waiter, only duplicate work.
+#
+# ARGV: prefix, window, max pairs, shard number. Partner keys carry no TTL: a
+# call lasts as long as it lasts, and disconnect or the sweeper removes them.
+# Returns {'MORE' | 'DONE', a1, owner_a1, b1, owner_b1, a2, ...}. 'MORE' means
+# this call could not see everything: the batch filled up, or the window was full
+# (of ghosts, say — which were just evicted, so live members past them are now in
+# reach; without this a block of >= window dead entries at the head would wedge
+# matching permanently).
 _MATCH_LUA = """
 local prefix = ARGV[1]
 local window = tonumber(ARGV[2])
+local max_pairs = tonumber(ARGV[3])
+local idx = prefix .. 'topic:' .. ARGV[4] .. ':'
+""" + _LIVE_LUA + """
+local function drop(id)
+  local t = topics_get(prefix, id)
+  for i = 1, #t do redis.call('ZREM', idx .. t[i], id) end
+  topics_del(prefix, id)
+  redis.call('ZREM', KEYS[1], id)
+end
 local ids = redis.call('ZRANGE', KEYS[1], 0, window - 1)   -- oldest first
-local live = {}
+local live, owner = {}, {}
 for i = 1, #ids do
-  if redis.call('EXISTS', prefix .. 'conn:' .. ids[i]) == 1 then
+  local o = owner_of(ids[i])
+  if o then
     live[#live + 1] = ids[i]
+    owner[ids[i]] = o
   else
-    redis.call('ZREM', KEYS[1], ids[i])
-    redis.call('DEL', prefix .. 'topics:' .. ids[i])
+    drop(ids[i])
+  end
+end
+local function topic_peer(a, ta)
+  local best, best_score = nil, nil
+  for i = 1, #ta do
+    local key = idx .. ta[i]
+    local cands = redis.call('ZRANGE', key, 0, window - 1, 'WITHSCORES')
+    for j = 1, #cands, 2 do
+      local m = cands[j]
+      local score = tonumber(cands[j + 1])
+      if best_score and score >= best_score then break end
+      if m ~= a then
+        if not redis.call('ZSCORE', KEYS[1], m) or not topics_has(prefix, m, ta[i]) then
+          redis.call('ZREM', key, m)           -- stale: paired, left or re-queued
+        else
+          local o = owner[m] or owner_of(m)
+          if o then
+            owner[m] = o
+            best, best_score = m, score
+            break
+          end
+          drop(m)                              -- ghost
+        end
+      end
+    end
+  end
+  return best
+end
+local out = {}
+local taken = {}
+local formed = 0
+local i = 1
+while formed < max_pairs do
+  while i <= #live and taken[live[i]] do i = i + 1 end
+  if i > #live then break end
+  local a = live[i]
+  local ta = topics_get(prefix, a)
+  local best = nil
+  if #ta > 0 then best = topic_peer(a, ta) end
+  if not best then                           -- fallback: longest-waiting peer
+    for j = i + 1, #live do
+      if not taken[live[j]] then best = live[j] break end
+    end
+  end
+  if not best then break end
+  taken[a] = true
+  taken[best] = true
+  drop(a)
+  drop(best)
+  partner_set(prefix, a, best)
+  partner_set(prefix, best, a)
+  out[#out + 1] = a
+  out[#out + 1] = owner[a]
+  out[#out + 1] = best
+  out[#out + 1] = owner[best]
+  formed = formed + 1
+end
+table.insert(out, 1, (#ids == window or formed == max_pairs) and 'MORE' or 'DONE')
+return out
+"""
+
+# The cross-shard pass: pair across shards what no single shard can. KEYS are
+# every shard's waiting ZSET, in shard order. Only each shard's oldest live
+# member is considered — after the per-shard passes a shard holds at most one
+# live waiter anyway — and the selection is _MATCH_LUA's over those heads: the
+# oldest is the candidate, preferring the first head sharing a topic, else the
+# next-oldest head. A shard that gives up its head offers its next one. Ghosts in
+# front of a head are evicted on the way. Same ARGV (minus the shard) and return
+# shape as _MATCH_LUA; 'MORE' when the batch filled or a shard's whole window
+# was ghosts.
+_MATCH_CROSS_LUA = """
+local prefix = ARGV[1]
+local window = tonumber(ARGV[2])
+local max_pairs = tonumber(ARGV[3])
+""" + _LIVE_LUA + """
+local function drop(id, k)
+  local t = topics_get(prefix, id)
+  for i = 1, #t do redis.call('ZREM', prefix .. 'topic:' .. (k - 1) .. ':' .. t[i], id) end
+  topics_del(prefix, id)
+  redis.call('ZREM', KEYS[k], id)
+end
+local head = {}
+local blind = false
+local function load(k)
+  local ids = redis.call('ZRANGE', KEYS[k], 0, window - 1, 'WITHSCORES')
+  for i = 1, #ids, 2 do
+    local o = owner_of(ids[i])
+    if o then
+      head[k] = {id = ids[i], score = tonumber(ids[i + 1]), owner = o, k = k}
+      return
+    end
+    drop(ids[i], k)
+  end
+  head[k] = false
+  if #ids == 2 * window then blind = true end
+end
+for k = 1, #KEYS do load(k) end
+local out = {}
+local formed = 0
+while formed < max_pairs do
+  local hs = {}
+  for k = 1, #KEYS do
+    if head[k] then hs[#hs + 1] = head[k] end
   end
+  if #hs < 2 then break end
+  table.sort(hs, function(x, y) return x.score < y.score end)
+  local a = hs[1]
+  local best = hs[2]
+  local ta = topics_get(prefix, a.id)
+  if #ta > 0 then
+    local want = {}
+    for i = 1, #ta do want[ta[i]] = true end
+    for i = 2, #hs do
+      local t = topics_get(prefix, hs[i].id)
+      local hit = false
+      for j = 1, #t do
+        if want[t[j]] then hit = true break end
+      end
+      if hit then best = hs[i] break end
+    end
+  end
+  drop(a.id, a.k)
+  drop(best.id, best.k)
+  partner_set(prefix, a.id, best.id)
+  partner_set(prefix, best.id, a.id)
+  out[#out + 1] = a.id
+  out[#out + 1] = a.owner
+  out[#out + 1] = best.id
+  out[#out + 1] = best.owner
+  formed = formed + 1
+  load(a.k)
+  load(best.k)
+end
+table.insert(out, 1, (blind or formed == max_pairs) and 'MORE' or 'DONE')
+return out
+"""
+
+# Queue a client, in one command. KEYS: its shard's waiting ZSET, its topics
+# key. ARGV: ws_id, enqueue_ms, topics ttl, its shard's topic index prefix
+# (yf:topic:<shard>:), key prefix, then the topics. Each topic's index gets the same score
+# as the pool, so "oldest in the index" and "oldest in the queue" agree. The
+# TTL on an index key only ever matters for a topic nobody queues under any
+# more: it takes whatever stale entries it still holds with it. The topics key
+# itself has none (nothing refreshes it any more): pairing, remove_waiting,
+# disconnect and the sweeper delete it.
+_ENQUEUE_LUA = _CLIENT_LUA + """
+local prefix, id = ARGV[5], ARGV[1]
+topics_del(prefix, id)
+redis.call('ZADD', KEYS[1], ARGV[2], id)
+for i = 6, #ARGV do
+  topics_add(prefix, id, ARGV[i])
+  redis.call('ZADD', ARGV[4] .. ARGV[i], ARGV[2], id)
+  redis.call('EXPIRE', ARGV[4] .. ARGV[i], ARGV[3])
 end
-if #live < 2 then
-  -- Ghosts were just evicted, so live members may sit past the window. Say so
-  -- rather than reporting the pool exhausted, or a block of >= window dead
-  -- entries at the head would wedge matching permanently.
-  if #live < #ids then return {'RETRY'} end
-  return {}
-end
-local a = live[1]
-local best = live[2]                       -- fallback: longest-waiting live peer
-local ta = redis.call('SMEMBERS', prefix .. 'topics:' .. a)
-if #ta > 0 then
-  local want = {}
-  for i = 1, #ta do want[ta[i]] = true end
-  for i = 2, #live do
-    local t = redis.call('SMEMBERS', prefix .. 'topics:' .. live[i])
-    local hit = false
+return 1
+"""
+
+# Everything "Next" (PAIRING_START) does, in one command: leave the pool and the
+# topic index wherever the client was queued (as _REMOVE_WAITING_LUA), unpair
+# (as _CLEAR_PARTNER_LUA), queue again with the new topics (as _ENQUEUE_LUA) and
+# wake every instance's matcher. It was remove_waiting, clear_partner, enqueue
+# and a wakeup PUBLISH: four round-trips in a row on the most frequent action
+# there is. KEYS = the shard ZSETs; ARGV = prefix, ws_id, now_ms, TOPICS_TTL,
+# new shard (0-based), wakeup channel, topics... Returns {partner, partner's
+# instance} (false, '' when it was not paired) for the PARTNER_LEFT.
+_REQUEUE_LUA = _CLIENT_LUA + """
+local prefix, id, now, ttl = ARGV[1], ARGV[2], ARGV[3], ARGV[4]
+local shard = tonumber(ARGV[5])
+local old = topics_get(prefix, id)
+for i = 1, #KEYS do
+  if redis.call('ZREM', KEYS[i], id) == 1 then
+    for j = 1, #old do
+      redis.call('ZREM', prefix .. 'topic:' .. (i - 1) .. ':' .. old[j], id)
+    end
+  end
+end
+topics_del(prefix, id)
+local p = partner_get(prefix, id)
+local owner = ''
+if p then
+  partner_del(prefix, id)
+  partner_del(prefix, p)
+  owner = owner_get(prefix, p) or ''
+end
+redis.call('ZADD', KEYS[shard + 1], now, id)
+for i = 7, #ARGV do
+  local index = prefix .. 'topic:' .. shard .. ':' .. ARGV[i]
+  topics_add(prefix, id, ARGV[i])
+  redis.call('ZADD', index, now, id)
+  redis.call('EXPIRE', index, ttl)
+end
+redis.call('PUBLISH', ARGV[6], '1')
+return {p, owner}
+"""
+
+# Drop a client from the waiting pool. KEYS[1] is its topics key, the rest are
+# the shard ZSETs in shard order: a client's shard follows its topics, which may
+# have changed since it was queued, so it is removed from all of them — and from
+# the topic index of the one it was actually in. ARGV: ws_id, key prefix. One
+# billed command for any shard count, where the ZREM + DEL pipeline it replaces
+# was already two.
+_REMOVE_WAITING_LUA = _CLIENT_LUA + """
+local t = topics_get(ARGV[2], ARGV[1])
+for i = 2, #KEYS do
+  if redis.call('ZREM', KEYS[i], ARGV[1]) == 1 then
     for j = 1, #t do
-      if want[t[j]] then hit = true break end
+      redis.call('ZREM', ARGV[2] .. 'topic:' .. (i - 2) .. ':' .. t[j], ARGV[1])
     end
-    if hit then best = live[i] break end
   end
 end
-redis.call('ZREM', KEYS[1], a, best)
-redis.call('DEL', prefix .. 'topics:' .. a, prefix .. 'topics:' .. best)
-return {a, best}
+topics_del(ARGV[2], ARGV[1])
+return 1
+"""
+
+# Everything a disconnect has to undo, for a batch of clients, in one command
+# (see _UNDO_LUA). KEYS = the shard ZSETs; ARGV = prefix, ws_id... Returns
+# {ws_id, partner, partner's instance, ...} for the clients that were paired.
+# This was three commands per client plus the publish, issued concurrently by
+# every closing socket: a machine losing its network turned 10k sockets into
+# 30k commands racing for as many connections.
+_DISCONNECT_LUA = _UNDO_LUA + """
+local out = {}
+for a = 2, #ARGV do undo(ARGV[1], ARGV[a], out) end
+return out
+"""
+
+# Size of every shard, in one command (KEYS = the shard ZSETs).
+_POOL_COUNTS_LUA = """
+local out = {}
+for i = 1, #KEYS do
+  out[i] = redis.call('ZCARD', KEYS[i])
+end
+return out
 """
 
 # Release the matcher lock only if we still own it.
@@ -197,50 +892,485 @@ return 0
 
 # Atomically read + delete a pairing in BOTH directions. Returns the former
 # partner id (or false). Atomicity means simultaneous disconnects can't double
-# notify or leave a dangling reverse-mapping. ARGV[1] = partner key prefix.
-_CLEAR_PARTNER_LUA = """
-local p = redis.call('GET', KEYS[1])
+# notify or leave a dangling reverse-mapping. KEYS[1] = its partner key; ARGV =
+# key prefix, ws_id. Under REDIS_CLUSTER a partner in another slot group keeps
+# its half, which clear_partner() then drops with _UNPAIR_LUA.
+_CLEAR_PARTNER_LUA = _CLIENT_LUA + """
+local p = partner_get(ARGV[1], ARGV[2])
 if p then
-  redis.call('DEL', KEYS[1])
-  redis.call('DEL', ARGV[1] .. p)
+  partner_del(ARGV[1], ARGV[2])
+  partner_del(ARGV[1], p)
   return p
 end
 return false
 """
 
-# Extend every TTL this instance is responsible for, in ONE command.
-# The previous version pipelined three EXPIREs per client. Two of those usually
-# targeted keys that do not exist — a client that is neither paired nor queued has
-# no partner or topics key — so they were billed and did nothing. Calls made from
-# inside a script are not billed separately, so a single EVAL removes that waste
-# and makes the heartbeat cost independent of how many clients are connected.
-# Keys are built from the prefix rather than declared in KEYS, the same approach
-# _CLEAR_PARTNER_LUA already takes; effect replication makes that safe.
-_REFRESH_LUA = """
+# Register clients as connected to this instance, in one command: conn key,
+# client set, and the lease itself, so a client is never seen before the lease
+# that makes it live (an idle instance may have let it lapse). ARGV = prefix,
+# instance, lease ttl, ws_id... Returns 1 if the lease was already held, 0 if it
+# had lapsed (see _lease_lost). KEYS[1] = the lease: a cluster routes by it,
+# and every client of one call must be in that lease's slot group.
+_REGISTER_LUA = _CLIENT_LUA + """
+local prefix, me = ARGV[1], ARGV[2]
+local lease = KEYS[1]
+local had = redis.call('EXISTS', lease)
+redis.call('SET', lease, '1', 'EX', ARGV[3])
+redis.call('SADD', prefix .. 'instances', me)
+for i = 4, #ARGV do
+  owner_set(prefix, ARGV[i], me)
+  redis.call('SADD', prefix .. 'clients:' .. me, ARGV[i])
+end
+return had
+"""
+
+# The heartbeat: renew this instance's lease, then sweep up after dead ones, in
+# one command whose cost does not depend on how many clients are connected.
+# yf:instances lists every instance that has registered a client. One whose
+# lease is gone has its client set SPOPped, up to ARGV[4] clients per call, and
+# each is undone as on disconnect; an emptied instance leaves the list. Any
+# instance's heartbeat does this, so the fleet's ghosts are gone within a
+# heartbeat of their lease expiring, and two sweepers never undo one client
+# twice (SPOP hands each out once; effect replication makes it safe in a
+# script). It also adds this instance's commands since the last beat to the
+# day's counter (see REDIS_DAILY_BUDGET). KEYS = the shard ZSETs; ARGV = prefix,
+# instance, lease ttl, sweep budget, day counter key ('' to leave it alone, as
+# every slot group but the first does under REDIS_CLUSTER), commands to add.
+# Returns {lease was held (1/0), 'MORE' | 'DONE', the fleet's commands today,
+# ws_id, partner, partner's instance, ...}: 'MORE' when the sweep budget ran out
+# first.
+_LEASE_LUA = _UNDO_LUA + """
+local prefix, me = ARGV[1], ARGV[2]
+local lease = prefix .. 'lease:' .. me
+local used = 0
+if ARGV[5] ~= '' then
+  used = redis.call('INCRBY', ARGV[5], ARGV[6])
+  if used == tonumber(ARGV[6]) then redis.call('EXPIRE', ARGV[5], 172800) end
+end
+local out = {redis.call('EXISTS', lease), 'DONE', used}
+redis.call('SET', lease, '1', 'EX', ARGV[3])
+redis.call('SADD', prefix .. 'instances', me)
+local budget = tonumber(ARGV[4])
+local insts = redis.call('SMEMBERS', prefix .. 'instances')
+for n = 1, #insts do
+  local inst = insts[n]
+  if redis.call('EXISTS', prefix .. 'lease:' .. inst) == 0 then
+    local ids = redis.call('SPOP', prefix .. 'clients:' .. inst, budget)
+    for i = 1, #ids do undo(prefix, ids[i], out) end
+    budget = budget - #ids
+    if redis.call('EXISTS', prefix .. 'clients:' .. inst) == 0 then
+      redis.call('SREM', prefix .. 'instances', inst)
+    end
+    if budget <= 0 then
+      out[2] = 'MORE'
+      break
+    end
+  end
+end
+return out
+"""
+
+# Is a client connected: its conn key, resolved through its instance's lease.
+# KEYS[1] = the conn key; ARGV = key prefix, ws_id.
+_IS_CONNECTED_LUA = _CLIENT_LUA + """
+local o = owner_get(ARGV[1], ARGV[2])
+if o and redis.call('EXISTS', ARGV[1] .. 'lease:' .. o) == 1 then return 1 end
+return 0
+"""
+
+# The half of a pairing an undo, requeue or clear_partner could not reach: under
+# REDIS_CLUSTER a partner in another slot group. KEYS = the partner's partner
+# key and conn key; ARGV = the key prefix of the partner's group, the partner,
+# the client that left. Its partner is dropped only if it still names the
+# leaver, since the partner may have moved on since. Returns the partner's
+# instance if it is connected, else false.
+_UNPAIR_LUA = _CLIENT_LUA + """
+local prefix, id = ARGV[1], ARGV[2]
+if partner_get(prefix, id) == ARGV[3] then partner_del(prefix, id) end
+local o = owner_get(prefix, id)
+if o and redis.call('EXISTS', prefix .. 'lease:' .. o) == 1 then return o end
+return false
+"""
+
+# The cross-shard pass under REDIS_CLUSTER, where no one script can see two slot
+# groups (see _cross_group_rounds). _HEAD_LUA reads a group's oldest live
+# waiter, evicting ghosts in front of it as _MATCH_CROSS_LUA does. KEYS[1] =
+# the group's waiting ZSET; ARGV = prefix, window. Returns {'DONE', id, score,
+# owner, topics...}, or just {'MORE' | 'DONE'} when there is none: 'MORE' if the
+# whole window was ghosts.
+_HEAD_LUA = """
 local prefix = ARGV[1]
-local conn_ttl = tonumber(ARGV[2])
-local partner_ttl = tonumber(ARGV[3])
-local topics_ttl = tonumber(ARGV[4])
-for i = 5, #ARGV do
-  local id = ARGV[i]
-  redis.call('EXPIRE', prefix .. 'conn:' .. id, conn_ttl)
-  redis.call('EXPIRE', prefix .. 'partner:' .. id, partner_ttl)
-  redis.call('EXPIRE', prefix .. 'topics:' .. id, topics_ttl)
-end
-return #ARGV - 4
+local window = tonumber(ARGV[2])
+""" + _LIVE_LUA + """
+local ids = redis.call('ZRANGE', KEYS[1], 0, window - 1, 'WITHSCORES')
+for i = 1, #ids, 2 do
+  local id = ids[i]
+  local t = topics_get(prefix, id)
+  local o = owner_of(id)
+  if o then
+    local out = {'DONE', id, ids[i + 1], o}
+    for j = 1, #t do out[#out + 1] = t[j] end
+    return out
+  end
+  for j = 1, #t do redis.call('ZREM', prefix .. 'topic:0:' .. t[j], id) end
+  topics_del(prefix, id)
+  redis.call('ZREM', KEYS[1], id)
+end
+return {#ids == 2 * window and 'MORE' or 'DONE'}
+"""
+
+# Take one side of a cross-group pair: pop the client from its group's pool and
+# topic index and record its partner, but only if it is still queued with the
+# score _HEAD_LUA read (not paired, gone or re-queued since). KEYS = its group's
+# waiting ZSET, its topics key, its partner key; ARGV = ws_id, score, partner,
+# its group's topic index prefix, key prefix. Returns 1 if taken, else 0.
+_TAKE_LUA = _CLIENT_LUA + """
+local prefix, id = ARGV[5], ARGV[1]
+local s = redis.call('ZSCORE', KEYS[1], id)
+if not s or tonumber(s) ~= tonumber(ARGV[2]) then return 0 end
+local t = topics_get(prefix, id)
+for i = 1, #t do redis.call('ZREM', ARGV[4] .. t[i], id) end
+topics_del(prefix, id)
+redis.call('ZREM', KEYS[1], id)
+partner_set(prefix, id, ARGV[3])
+return 1
 """
 
+# MATCH_MODE=window, the read: a shard's oldest `window` live waiters, ghosts
+# in front of them evicted. KEYS[1] = the shard's waiting ZSET; ARGV = prefix,
+# window, shard number (of its topic index). Returns {'MORE' | 'DONE', id,
+# score, owner, topic count, topics..., id, ...}: 'MORE' if the window was full.
+_WINDOW_LUA = """
+local prefix = ARGV[1]
+local window = tonumber(ARGV[2])
+local idx = prefix .. 'topic:' .. ARGV[3] .. ':'
+""" + _LIVE_LUA + """
+local ids = redis.call('ZRANGE', KEYS[1], 0, window - 1, 'WITHSCORES')
+local out = {#ids == 2 * window and 'MORE' or 'DONE'}
+for i = 1, #ids, 2 do
+  local id = ids[i]
+  local t = topics_get(prefix, id)
+  local o = owner_of(id)
+  if o then
+    out[#out + 1] = id
+    out[#out + 1] = ids[i + 1]
+    out[#out + 1] = o
+    out[#out + 1] = #t
+    for j = 1, #t do out[#out + 1] = t[j] end
+  else
+    for j = 1, #t do redis.call('ZREM', idx .. t[j], id) end
+    topics_del(prefix, id)
+    redis.call('ZREM', KEYS[1], id)
+  end
+end
+return out
+"""
+
+# MATCH_MODE=window, the claim: form the pairs solved for, each only if both
+# are still queued with the score _WINDOW_LUA read and still live (not paired,
+# gone or re-queued since). A pair that no longer holds is skipped, whoever of
+# it is still queued stays queued. KEYS = waiting ZSETs of consecutive shards,
+# the first of them numbered ARGV[2]: the one shard of a shard pass, or every
+# shard for the cross-shard pass on a single node. ARGV = prefix, that number,
+# then per pair a, score of a, a's KEYS index, b, score of b, b's KEYS index.
+# Returns the pairs formed as _MATCH_LUA does, without the leading flag.
+_CLAIM_LUA = """
+local prefix = ARGV[1]
+local first = tonumber(ARGV[2])
+""" + _LIVE_LUA + """
+local function queued(id, score, k)
+  local s = redis.call('ZSCORE', KEYS[k], id)
+  return s and tonumber(s) == tonumber(score)
+end
+local function drop(id, k)
+  local idx = prefix .. 'topic:' .. (first + k - 1) .. ':'
+  local t = topics_get(prefix, id)
+  for i = 1, #t do redis.call('ZREM', idx .. t[i], id) end
+  topics_del(prefix, id)
+  redis.call('ZREM', KEYS[k], id)
+end
+local out = {}
+for i = 3, #ARGV, 6 do
+  local a, b = ARGV[i], ARGV[i + 3]
+  local ka, kb = tonumber(ARGV[i + 2]), tonumber(ARGV[i + 5])
+  if queued(a, ARGV[i + 1], ka) and queued(b, ARGV[i + 4], kb) then
+    local oa, ob = owner_of(a), owner_of(b)
+    if oa and ob then
+      drop(a, ka)
+      drop(b, kb)
+      partner_set(prefix, a, b)
+      partner_set(prefix, b, a)
+      out[#out + 1] = a
+      out[#out + 1] = oa
+      out[#out + 1] = b
+      out[#out + 1] = ob
+    end
+  end
+end
+return out
+"""
+
+
+# --- Script registry ---
+# EVAL ships the whole script on every call: _MATCH_LUA alone is over 1 KB, sent
+# on every match round, and Upstash bills bandwidth as well as commands. So every
+# script is SCRIPT LOADed up front, in one pipeline, and called by its SHA1 (40
+# bytes) through _eval(). Loading happens in connect() and on every pub/sub
+# resubscribe, because a Redis restart or failover, the usual reason for a
+# resubscribe, is what empties the server's script cache. Should a NOSCRIPT slip
+# in before we notice (a failover between two listener health checks), _eval()
+# loads that one script and retries once, so callers never see it.
+_SCRIPTS = {
+    "rate_zset": _RATE_ZSET_LUA,
+    "rate_gcra": _RATE_GCRA_LUA,
+    "rate_buckets": _RATE_BUCKETS_LUA,
+    "match": _MATCH_LUA,
+    "match_cross": _MATCH_CROSS_LUA,
+    "enqueue": _ENQUEUE_LUA,
+    "requeue": _REQUEUE_LUA,
+    "remove_waiting": _REMOVE_WAITING_LUA,
+    "disconnect": _DISCONNECT_LUA,
+    "pool_counts": _POOL_COUNTS_LUA,
+    "release_lock": _RELEASE_LOCK_LUA,
+    "clear_partner": _CLEAR_PARTNER_LUA,
+    "register": _REGISTER_LUA,
+    "lease": _LEASE_LUA,
+    "is_connected": _IS_CONNECTED_LUA,
+    "unpair": _UNPAIR_LUA,
+    "head": _HEAD_LUA,
+    "take": _TAKE_LUA,
+    "window": _WINDOW_LUA,
+    "claim": _CLAIM_LUA,
+}
+_SCRIPT_SHA = {text: hashlib.sha1(text.encode()).hexdigest() for text in _SCRIPTS.values()}
+_SCRIPT_NAME = {text: name for name, text in _SCRIPTS.items()}
+
+
+def _request_bytes(*args) -> int:
+    """Size of a command on the wire, as redis-py encodes it (a RESP array of bulk strings)."""
+    size = len(f"*{len(args)}\r\n")
+    for a in args:
+        n = len(str(a).encode())
+        size += len(f"${n}\r\n") + n + 2
+    return size
+
+
+# Per-script request bytes, reported by /ping: "bytes" is what EVALSHA actually
+# sent, "saved" what EVAL would have sent on top. "reloads" counts NOSCRIPT
+# recoveries, which should stay near zero.
+script_stats = {name: {"calls": 0, "bytes": 0, "saved": 0} for name in _SCRIPTS}
+script_stats["reloads"] = 0
+_SCRIPT_SAVING = {text: _request_bytes("EVAL", text) - _request_bytes("EVALSHA", sha)
+                  for text, sha in _SCRIPT_SHA.items()}
+# Round-trip time per script, as /metrics reports it. A match script that creeps
+# up here is the first sign of a pool outgrowing MATCH_WINDOW or MATCH_SHARDS.
+_SCRIPT_SECONDS = {text: metrics.histogram("yawnfox_redis_script_seconds",
+                                           "EVALSHA round-trip time per script.", script=name)
+                   for text, name in _SCRIPT_NAME.items()}
+
+
+# --- Command ledger ---
+# What each operation costs in Redis commands, counted as sent: per op for
+# /ping and /metrics, and in total for the budget governor. The numbers quoted
+# in the comments of this file ("86,400 commands a day") can be checked against
+# it in production. Not counted, because redis-py sends them on its own: the
+# CLIENT SETINFO handshake of each new pooled connection, the PING before a
+# command on one idle for over 30s (health_check_interval), and the same PING on
+# an idle pub/sub connection. Budget with a little headroom for those.
+_OPS = ("connect", "register", "disconnect", "heartbeat", "queue", "match", "partners",
+        "owner_lookup", "relay_publish", "wakeup", "rate_limit", "health_ping")
+_COMMANDS = {op: metrics.counter("yawnfox_redis_commands_total",
+                                 "Redis commands sent by this instance, per operation.", op=op)
+             for op in _OPS}
+_SCRIPT_OP = {
+    _RATE_ZSET_LUA: "rate_limit", _RATE_GCRA_LUA: "rate_limit", _RATE_BUCKETS_LUA: "rate_limit",
+    _MATCH_LUA: "match", _MATCH_CROSS_LUA: "match", _POOL_COUNTS_LUA: "match",
+    _RELEASE_LOCK_LUA: "match", _ENQUEUE_LUA: "queue", _REQUEUE_LUA: "queue",
+    _REMOVE_WAITING_LUA: "queue", _DISCONNECT_LUA: "disconnect", _CLEAR_PARTNER_LUA: "partners",
+    _REGISTER_LUA: "register", _LEASE_LUA: "heartbeat", _IS_CONNECTED_LUA: "register",
+    _UNPAIR_LUA: "partners", _HEAD_LUA: "match", _TAKE_LUA: "match",
+    _WINDOW_LUA: "match", _CLAIM_LUA: "match",
+}
+
+
+def _bill(op: str, n: int = 1) -> None:
+    global _unreported
+    _COMMANDS[op].inc(n)
+    _unreported += n
+
+
+def command_counts() -> dict:
+    """Commands sent by this instance since it started, per operation."""
+    return {op: c.value for op, c in _COMMANDS.items()}
+
+
+def budget_used() -> int:
+    """The fleet's commands today, as far as this instance knows: the total at
+    its last heartbeat plus what it has sent since."""
+    if _budget_day != time.strftime("%Y%m%d", time.gmtime()):
+        return _unreported
+    return _fleet_used + _unreported
+
+
+def budget_stretch() -> float:
+    """Factor for the optional intervals: 1.0 below REDIS_BUDGET_SOFT of the
+    budget, rising linearly to BUDGET_MAX_STRETCH at it."""
+    if not REDIS_DAILY_BUDGET:
+        return 1.0
+    used = budget_used() / REDIS_DAILY_BUDGET
+    if used <= REDIS_BUDGET_SOFT:
+        return 1.0
+    return min(BUDGET_MAX_STRETCH,
+               1 + (BUDGET_MAX_STRETCH - 1) * (used - REDIS_BUDGET_SOFT) / (1 - REDIS_BUDGET_SOFT))
+
+
+def over_budget() -> bool:
+    """At or past the day's budget: optional work (rate-limit syncs) is shed."""
+    return bool(REDIS_DAILY_BUDGET) and budget_used() >= REDIS_DAILY_BUDGET
+
+
+async def _load_scripts() -> None:
+    """SCRIPT LOAD every script in one round-trip. Never raises: _eval() recovers."""
+    if not _client:
+        return
+    try:
+        if REDIS_CLUSTER:
+            # SCRIPT LOAD goes to every primary, which a cluster pipeline refuses.
+            _bill("connect", len(_SCRIPTS) * len(_client.get_primaries()))
+            await asyncio.gather(*(_client.script_load(text) for text in _SCRIPTS.values()))
+            return
+        pipe = _client.pipeline(transaction=False)
+        for text in _SCRIPTS.values():
+            pipe.script_load(text)
+        _bill("connect", len(_SCRIPTS))
+        await pipe.execute()
+    except RedisError as e:
+        logger.warning(f"script preload failed (will load on demand): {e}")
+
+
+async def _eval(script: str, numkeys: int, *args):
+    """EVALSHA one of the scripts above. Raises RedisError like _redis.eval()."""
+    sha = _SCRIPT_SHA[script]
+    stats = script_stats[_SCRIPT_NAME[script]]
+    stats["calls"] += 1
+    stats["bytes"] += _request_bytes("EVALSHA", sha, numkeys, *args)
+    stats["saved"] += _SCRIPT_SAVING[script]
+    _bill(_SCRIPT_OP[script])
+    start = time.perf_counter()
+    try:
+        return await _redis.evalsha(sha, numkeys, *args)
+    except NoScriptError:
+        script_stats["reloads"] += 1
+        _bill("connect")
+        _bill(_SCRIPT_OP[script])
+        await _client.script_load(script)
+        return await _redis.evalsha(sha, numkeys, *args)
+    finally:
+        _SCRIPT_SECONDS[script].observe(time.perf_counter() - start)
+
+
+# --- Auto-pipelining ---
+# Hundreds of coroutines each await one command of their own: an owner lookup,
+# get_partner(), a register, a wakeup. Sent as redis-py sends them, each takes a
+# pooled connection, one write and one read, so under load the process spends
+# its time in syscalls and the pool grows a connection per concurrent caller.
+# _AutoPipeline stands in for the client as _redis: a command issued anywhere
+# during one pass of the event loop is queued, and at the start of the next the
+# whole queue goes out as one pipeline, one write and one read on one
+# connection. A flush does not wait for the previous one, so a slow reply never
+# holds up the commands behind it.
+#
+# Call sites see no difference. Each caller awaits its own reply, with redis-py's
+# own response parsing, or its own exception: a Lua error or NOSCRIPT reaches
+# only the coroutine that caused it, and a connection error fails the commands
+# of that one flush, as it would have failed each of them alone. Ordering is
+# what it was: a coroutine never has two commands in flight, and commands from
+# different coroutines already went out on different connections in no
+# guaranteed order. Explicit pipelines (MULTI included), pub/sub and the health
+# PING use the client directly.
+_FLUSH_COMMANDS = metrics.histogram("yawnfox_redis_pipeline_commands",
+                                    "Commands per auto-pipelined flush.", metrics.COUNT_BUCKETS)
+
+
+class _AutoPipeline(AsyncCoreCommands):
+    """A redis-py client whose commands are pipelined per event-loop iteration.
+
+    Every command method (get, set, evalsha, publish...) comes from redis-py's
+    own command mixin, which builds the arguments and calls execute_command();
+    anything else (pipeline(), pubsub(), aclose()) is the client's.
+    """
+
+    def __init__(self, client: redis.Redis):
+        self._client = client
+        self._queue: list = []        # [(args, options, future)] for the next flush
+        self._flushes: set = set()    # flush tasks in flight (the loop holds them weakly)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def execute_command(self, *args, **options) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.append((args, options, fut))
+        if len(self._queue) == 1:
+            # A task's first step runs on the loop's next iteration: after every
+            # callback already ready in this one has had the chance to queue.
+            task = asyncio.create_task(self._flush())
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+        return fut
+
+    async def _flush(self) -> None:
+        batch, self._queue = self._queue, []
+        _FLUSH_COMMANDS.observe(len(batch))
+        try:
+            if len(batch) == 1:
+                args, options, _ = batch[0]
+                replies = [await self._client.execute_command(*args, **options)]
+            else:
+                pipe = self._client.pipeline(transaction=False)
+                for args, options, _ in batch:
+                    pipe.execute_command(*args, **options)
+                replies = await pipe.execute(raise_on_error=False)
+        except asyncio.CancelledError:
+            for _, _, fut in batch:
+                fut.cancel()
+            raise
+        except Exception as e:
+            replies = [e] * len(batch)
+        for (_, _, fut), reply in zip(batch, replies):
+            if fut.done():
+                continue                # its caller gave up (cancelled, timed out)
+            if isinstance(reply, Exception):
+                fut.set_exception(reply)
+            else:
+                fut.set_result(reply)
+
 
 def instance_id() -> str:
     return _instance_id
 
 
-def set_local_delivery(cb: Callable[[str, str], Awaitable[bool]]) -> None:
-    """Register the per-process delivery callback (ws_id, text) -> delivered?."""
+def set_local_delivery(cb: Callable[..., Awaitable[bool]]) -> None:
+    """Register the per-process delivery callback -> delivered?.
+
+    Called as cb(ws_id, text, sender, news, stamp). sender is the client the
+    frame is from, or None for server frames; a relayed frame should be dropped
+    unless ws_id is still paired with sender. news is None except on pairing
+    changes: PARTNER_FOUND carries the partner's instance id (sender is the
+    partner), and PARTNER_LEFT carries "" (sender is the partner that left).
+    stamp is set on relayed frames only: hand it to relay_written() once the
+    frame is written to the socket.
+    """
     global _local_delivery
     _local_delivery = cb
 
 
+def relay_written(stamp: tuple) -> None:
+    """A relayed frame's `stamp` (see set_local_delivery): it has been written."""
+    path, since = stamp
+    _RELAY_SECONDS[path].observe(max(0.0, time.time() - since))
+
+
 def set_wakeup_callback(cb: Callable[[], None]) -> None:
     """Register a callback used to wake this instance's matcher loop."""
     global _on_wakeup
@@ -274,13 +1404,13 @@ async def connect() -> bool:
     When REDIS_URL is not set, skips Redis entirely and runs in
     in-memory mode; always returns True without logging any error.
     """
-    global _client
+    global _client, _commands, _pubsub_client
     if _inmemory_mode:
         logger.info(f"REDIS_URL not set — in-memory mode (instance {_instance_id})")
         return True
     url = _build_url()
     try:
-        _client = redis.from_url(
+        _client = _pubsub_client = redis.from_url(
             url,
             decode_responses=True,
             socket_connect_timeout=5,
@@ -288,12 +1418,24 @@ async def connect() -> bool:
             health_check_interval=30,
             retry_on_timeout=True,
         )
+        if REDIS_CLUSTER:
+            # The node in REDIS_URL seeds the slot map; the client follows it
+            # (and MOVED replies) from there. Pub/sub stays on that node.
+            _client = redis.RedisCluster.from_url(
+                url,
+                decode_responses=True,
+                socket_connect_timeout=5,
+                socket_timeout=5,
+                health_check_interval=30,
+            )
     except Exception as e:
         # A URL we cannot even parse will not fix itself, so leave _client unset
         # and let the pub/sub listener idle rather than retry forever.
         logger.error(f"Redis client could not be created: {e}")
         return False
+    _commands = _AutoPipeline(_client) if REDIS_AUTOPIPELINE else _client
     try:
+        _bill("connect")
         await _client.ping()
     except Exception as e:
         # Keep the client. from_url() does not connect, so this failure says
@@ -303,6 +1445,7 @@ async def connect() -> bool:
         # instance that booted during a blip stayed dead until someone restarted it.
         logger.error(f"Redis connection failed: {e} — starting in redis-down mode")
         return False
+    await _load_scripts()
     _set_redis_up(True)
     logger.info(f"Connected to Redis ({url.rsplit('@', 1)[-1]}) as instance {_instance_id}")
     return True
@@ -317,7 +1460,7 @@ def _set_redis_up(up: bool) -> None:
     """
     global _redis
     was_up = _redis is not None
-    _redis = _client if up else None
+    _redis = _commands if up else None
     if up and not was_up:
         logger.info("Redis connection restored — accepting clients again")
     elif was_up and not up:
@@ -358,10 +1501,13 @@ def mode() -> str:
 
 
 async def close() -> None:
-    global _client, _redis, _pubsub
+    global _client, _commands, _redis, _pubsub, _pubsub_client
     if _inmemory_mode:
         return
-    for obj in (_pubsub, _client):
+    if _disconnects:
+        await _flush_disconnects()
+    await flush()   # frames already handed to route() still go out
+    for obj in (_pubsub, _client, _pubsub_client if _pubsub_client is not _client else None):
         if obj is None:
             continue
         try:
@@ -374,8 +1520,10 @@ async def close() -> None:
         except Exception:
             pass
     _client = None
+    _commands = None
     _redis = None
     _pubsub = None
+    _pubsub_client = None
 
 
 # --- Presence -------------------------------------------------------------
@@ -386,10 +1534,38 @@ async def register_connection(ws_id: str) -> None:
         return
     if not _redis:
         return
-    try:
-        await _redis.set(conn_key(ws_id), _instance_id, ex=CONN_TTL)
-    except RedisError as e:
-        logger.warning(f"register_connection failed: {e}")
+    await _register([ws_id])
+
+
+def _chunks(items: list, key: Callable = lambda item: item) -> list:
+    """(group, chunk) pairs covering `items`: chunks of at most
+    DISCONNECT_BATCH_MAX, each within the slot group of key(item), so that one
+    script call can take it. One group, so plain chunks, unless REDIS_CLUSTER."""
+    by_group: dict = {}
+    for item in items:
+        by_group.setdefault(group_of(key(item)), []).append(item)
+    return [(group, part[i:i + DISCONNECT_BATCH_MAX])
+            for group, part in by_group.items()
+            for i in range(0, len(part), DISCONNECT_BATCH_MAX)]
+
+
+async def _register(ws_ids: list) -> None:
+    """Register clients on this instance (see _REGISTER_LUA), in chunks."""
+    global _lease_held, _lease_lost
+    for group, chunk in _chunks(ws_ids):
+        try:
+            had = await _eval(_REGISTER_LUA, 1, lease_key(_instance_id, group), _prefix(group),
+                              _instance_id, LEASE_TTL, *chunk)
+        except RedisError as e:
+            logger.warning(f"register_connection failed: {e}")
+            return
+        if not had and _lease_held and group in _leased_groups:
+            # The lease lapsed (an outage longer than LEASE_TTL, or simply an
+            # idle spell) and other clients of ours may have been swept. The
+            # next heartbeat registers every local client again to be sure.
+            _lease_lost = True
+        _lease_held = True
+        _leased_groups.add(group)
 
 
 async def unregister_connection(ws_id: str) -> None:
@@ -399,90 +1575,290 @@ async def unregister_connection(ws_id: str) -> None:
     if not _redis:
         return
     try:
-        await _redis.delete(conn_key(ws_id))
+        pipe = _redis.pipeline(transaction=False)
+        pipe.srem(clients_key(_instance_id, group_of(ws_id)), ws_id)
+        if CLIENT_LAYOUT == "hash":
+            pipe.hdel(client_key(ws_id), "o")
+        else:
+            pipe.delete(conn_key(ws_id))
+        _bill("disconnect", 2)
+        await pipe.execute()
     except RedisError as e:
         logger.warning(f"unregister_connection failed: {e}")
 
 
+async def disconnect(ws_id: str) -> None:
+    """Undo everything a departed client left behind and tell its partner.
+
+    Unpairs it, takes it out of the waiting pool and drops its presence, all in
+    one _DISCONNECT_LUA call shared with every disconnect in the same
+    DISCONNECT_BATCH_MS window. Returns once that call (and the PARTNER_LEFT it
+    produced) has been issued.
+    """
+    if _inmemory_mode:
+        partner = await clear_partner(ws_id)
+        _mem_unqueue(ws_id)
+        _mem_connections.discard(ws_id)
+        if partner:
+            await partner_left(partner, ws_id)
+        return
+    if not _redis:
+        # Its conn key would keep it live for as long as our lease holds: undo
+        # it once Redis is back (see renew_lease).
+        _orphans.append(ws_id)
+        return
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    _disconnects.append((ws_id, fut))
+    if len(_disconnects) == 1:
+        loop.call_later(DISCONNECT_BATCH_MS / 1000,
+                        lambda: _disconnects and _spawn(_flush_disconnects()))
+    await fut
+
+
+def _spawn(coro) -> asyncio.Task:
+    """Run a batch flush as a task that stays referenced until it is done."""
+    task = asyncio.get_running_loop().create_task(coro)
+    _batches.add(task)
+    task.add_done_callback(_batches.discard)
+    return task
+
+
+async def _flush_disconnects() -> None:
+    batch = _disconnects[:]
+    _disconnects.clear()
+    for group, chunk in _chunks(batch, key=lambda item: item[0]):
+        keys = _group_shards(group)
+        ids = [ws_id for ws_id, _ in chunk]
+        flat = []
+        try:
+            if not _redis:
+                raise RedisError("redis is down")
+            flat = await _eval(_DISCONNECT_LUA, len(keys), *keys, _prefix(group), *ids)
+        except RedisError as e:
+            # Nothing expires on its own any more, so keep them for the next
+            # heartbeat. Should this instance die first, its lease lapses and
+            # the sweeper undoes them anyway.
+            _orphans.extend(ids)
+            logger.warning(f"disconnect failed for {len(chunk)} clients: {e}")
+        await _partners_left(flat)
+        for _, fut in chunk:
+            if not fut.done():
+                fut.set_result(None)
+
+
+async def _partners_left(flat: list) -> None:
+    """PARTNER_LEFT for each {ws_id, partner, partner's instance} an undo returned.
+
+    No instance means the partner is not connected, or sits in another slot
+    group (REDIS_CLUSTER): that one's half of the pairing is dropped, and its
+    instance looked up, by a call of its own.
+    """
+    for j in range(0, len(flat), 3):
+        ws_id, partner, owner = flat[j:j + 3]
+        if not owner and group_of(partner) != group_of(ws_id):
+            owner = await _unpair(partner, ws_id)
+        if owner:
+            await _send(partner, _PARTNER_LEFT_FRAME, ws_id, owner, news="")
+
+
+async def _unpair(partner: str, leaver: str) -> Optional[str]:
+    """Drop partner's half of its pairing with leaver (see _UNPAIR_LUA).
+    Returns partner's instance if it is connected."""
+    try:
+        return await _eval(_UNPAIR_LUA, 2, partner_key(partner), conn_key(partner),
+                           _prefix(group_of(partner)), partner, leaver) or None
+    except RedisError as e:
+        logger.warning(f"unpair failed: {e}")
+        return None
+
+
 async def is_connected(ws_id: str) -> bool:
     if _inmemory_mode:
         return ws_id in _mem_connections
     if not _redis:
         return False
     try:
-        return bool(await _redis.exists(conn_key(ws_id)))
+        return bool(await _eval(_IS_CONNECTED_LUA, 1, conn_key(ws_id),
+                                _prefix(group_of(ws_id)), ws_id))
     except RedisError:
         return False
 
 
-async def refresh(ws_ids: Iterable[str]) -> None:
-    """Heartbeat: extend TTLs for this instance's live clients.
+async def renew_lease(ws_ids: Iterable[str]) -> None:
+    """Heartbeat: renew this instance's lease and sweep up after dead instances.
 
-    One EVAL for the whole batch, whatever the client count — see _REFRESH_LUA.
+    One command however many clients are connected (_LEASE_LUA), more only while
+    a dead instance's clients are still being swept. `ws_ids` (this instance's
+    live clients) are read only when the lease turns out to have lapsed, to
+    register them again, and disconnects that never reached Redis are retried.
+    Also reports this instance's commands to the day's budget counter and
+    learns the fleet's total (see REDIS_DAILY_BUDGET).
     """
-    if _inmemory_mode:
-        return  # no TTLs to refresh in in-memory mode
-    if not _redis:
-        return
-    ids = list(ws_ids)
-    if not ids:
-        return
-    try:
-        await _redis.eval(
-            _REFRESH_LUA, 0, f"{PREFIX}:", CONN_TTL, PARTNER_TTL, TOPICS_TTL, *ids
-        )
-    except RedisError as e:
-        logger.warning(f"refresh failed: {e}")
+    global _lease_held, _lease_lost, _unreported, _budget_day, _fleet_used
+    if _inmemory_mode or not _redis:
+        return  # in-memory: nothing expires; down: nothing to renew against
+    was_over = over_budget()
+    # One lease per slot group under REDIS_CLUSTER, each renewed and swept in
+    # its group; the first group's call also keeps the budget counter.
+    for group in _groups():
+        keys = _group_shards(group)
+        for _ in range(20):     # 10k swept clients a beat at most; the rest next time
+            day, sent = time.strftime("%Y%m%d", time.gmtime()), _unreported if group == 0 else 0
+            try:
+                res = await _eval(_LEASE_LUA, len(keys), *keys, _prefix(group), _instance_id,
+                                  LEASE_TTL, DISCONNECT_BATCH_MAX,
+                                  budget_key(day) if group == 0 else "", sent)
+            except RedisError as e:
+                logger.warning(f"lease renewal failed: {e}")
+                return
+            if group == 0:
+                _unreported -= sent
+                _budget_day, _fleet_used = day, int(res[2])
+            if not res[0] and _lease_held and group in _leased_groups:
+                _lease_lost = True
+            _lease_held = True
+            _leased_groups.add(group)
+            await _partners_left(res[3:])
+            if res[1] != "MORE":
+                break
+    if REDIS_DAILY_BUDGET and over_budget() != was_over:
+        if was_over:
+            logger.info("Redis command budget: back under, rate-limit syncs resume")
+        else:
+            logger.warning(f"Redis command budget of {REDIS_DAILY_BUDGET}/day reached: "
+                           "shedding rate-limit syncs, stretching polls")
+    if _lease_lost:
+        _lease_lost = False
+        ids = list(ws_ids)
+        if ids:
+            logger.warning(f"lease had lapsed: registering {len(ids)} clients again")
+            await _register(ids)
+    if _orphans:
+        loop = asyncio.get_running_loop()
+        _disconnects.extend((ws_id, loop.create_future()) for ws_id in _orphans)
+        _orphans.clear()
+        await _flush_disconnects()
 
 
 # --- Waiting pool ---------------------------------------------------------
 
 async def enqueue_waiting(ws_id: str, topics: Iterable[str]) -> None:
     if _inmemory_mode:
-        _mem_waiting[ws_id] = int(time.time() * 1000)
+        _mem_unqueue(ws_id)
+        _mem_waiting[ws_id] = next(_mem_seq)
+        _mem_since[ws_id] = time.time() * 1000
         _mem_topics[ws_id] = {t for t in topics if t}
+        for t in _mem_topics[ws_id]:
+            _mem_topic_index.setdefault(t, OrderedDict())[ws_id] = None
         return
     if not _redis:
         return
     now_ms = int(time.time() * 1000)
     norm = [t for t in topics if t]
+    shard = shard_for(ws_id, norm)
     try:
-        pipe = _redis.pipeline(transaction=True)
-        pipe.zadd(WAITING_KEY, {ws_id: now_ms})
-        pipe.delete(topics_key(ws_id))
-        if norm:
-            pipe.sadd(topics_key(ws_id), *norm)
-            pipe.expire(topics_key(ws_id), TOPICS_TTL)
-        await pipe.execute()
+        await _eval(
+            _ENQUEUE_LUA, 2, waiting_key(shard), topics_key(ws_id),
+            ws_id, now_ms, TOPICS_TTL, topic_index_key(shard, ""), _prefix(group_of(ws_id)), *norm,
+        )
     except RedisError as e:
         logger.warning(f"enqueue_waiting failed: {e}")
 
 
+async def requeue(ws_id: str, topics: Iterable[str]) -> Optional[str]:
+    """PAIRING_START: unpair, queue again with `topics`, wake the matchers.
+
+    One command (_REQUEUE_LUA). The former partner, if any, is sent
+    PARTNER_LEFT and returned.
+    """
+    norm = [t for t in topics if t]
+    if _inmemory_mode:
+        partner = await clear_partner(ws_id)
+        await enqueue_waiting(ws_id, norm)
+        if partner:
+            await partner_left(partner, ws_id)
+        if _on_wakeup:
+            _on_wakeup()
+        return partner
+    if not _redis:
+        return None
+    group = group_of(ws_id)
+    keys = _group_shards(group)
+    try:
+        partner, owner = await _eval(
+            _REQUEUE_LUA, len(keys), *keys, _prefix(group), ws_id, int(time.time() * 1000),
+            TOPICS_TTL, 0 if REDIS_CLUSTER else shard_for(ws_id, norm), WAKEUP_CHANNEL, *norm,
+        )
+    except RedisError as e:
+        logger.warning(f"requeue failed: {e}")
+        return None
+    if partner and group_of(partner) != group:
+        owner = await _unpair(partner, ws_id)
+    # The script's PUBLISH reaches the other instances; this one is woken
+    # directly, exactly as trigger_wakeup() does.
+    if _on_wakeup:
+        _on_wakeup()
+    if partner and owner:
+        await _send(partner, _PARTNER_LEFT_FRAME, ws_id, owner, news="")
+    return partner or None
+
+
+def _mem_unqueue(ws_id: str) -> None:
+    """In-memory: drop ws_id from the pool and its topic indexes."""
+    _mem_waiting.pop(ws_id, None)
+    _mem_since.pop(ws_id, None)
+    for t in _mem_topics.pop(ws_id, ()):
+        index = _mem_topic_index.get(t)
+        if index is not None:
+            index.pop(ws_id, None)
+            if not index:
+                del _mem_topic_index[t]
+
+
 async def remove_waiting(ws_id: str) -> None:
     if _inmemory_mode:
-        _mem_waiting.pop(ws_id, None)
-        _mem_topics.pop(ws_id, None)
+        _mem_unqueue(ws_id)
         return
     if not _redis:
         return
+    group = group_of(ws_id)
+    keys = [topics_key(ws_id)] + _group_shards(group)
     try:
-        pipe = _redis.pipeline(transaction=False)
-        pipe.zrem(WAITING_KEY, ws_id)
-        pipe.delete(topics_key(ws_id))
-        await pipe.execute()
+        await _eval(_REMOVE_WAITING_LUA, len(keys), *keys, ws_id, _prefix(group))
     except RedisError as e:
         logger.warning(f"remove_waiting failed: {e}")
 
 
-async def waiting_count() -> int:
+async def waiting_counts() -> list:
+    """Number of waiting clients per shard (index = shard). Also kept in pool_counts."""
     if _inmemory_mode:
-        return len(_mem_waiting)
-    if not _redis:
-        return 0
-    try:
-        return int(await _redis.zcard(WAITING_KEY))
-    except RedisError:
-        return 0
+        counts = [len(_mem_waiting)]
+    elif not _redis:
+        return [0]
+    else:
+        try:
+            # One call, or under REDIS_CLUSTER one per slot group (= shard).
+            replies = await asyncio.gather(*(
+                _eval(_POOL_COUNTS_LUA, len(keys), *keys)
+                for keys in map(_group_shards, _groups())))
+        except RedisError:
+            return [0]
+        counts = [int(c) for reply in replies for c in reply]
+    pool_counts[:] = counts
+    return counts
+
+
+def claim_order(counts: list) -> list:
+    """Shards worth a pass (two or more waiting), in this instance's claim order.
+
+    Every instance starts from a different shard (derived from its id) so that
+    several instances woken together fan out over the shards instead of queueing
+    on the same lock.
+    """
+    start = zlib.crc32(_instance_id.encode()) % len(counts)
+    order = [(start + i) % len(counts) for i in range(len(counts))]
+    return [s for s in order if counts[s] >= 2]
 
 
 # --- Partner mapping ------------------------------------------------------
@@ -495,9 +1871,15 @@ async def set_partners(a: str, b: str) -> None:
     if not _redis:
         return
     try:
-        pipe = _redis.pipeline(transaction=True)
-        pipe.set(partner_key(a), b, ex=PARTNER_TTL)
-        pipe.set(partner_key(b), a, ex=PARTNER_TTL)
+        # No MULTI across slot groups on a cluster: two plain SETs there.
+        pipe = _redis.pipeline(transaction=not REDIS_CLUSTER)
+        if CLIENT_LAYOUT == "hash":
+            pipe.hset(client_key(a), "p", b)
+            pipe.hset(client_key(b), "p", a)
+        else:
+            pipe.set(partner_key(a), b)
+            pipe.set(partner_key(b), a)
+        _bill("partners", 2 if REDIS_CLUSTER else 4)    # MULTI, SET, SET, EXEC
         await pipe.execute()
     except RedisError as e:
         logger.warning(f"set_partners failed: {e}")
@@ -509,6 +1891,9 @@ async def get_partner(ws_id: str) -> Optional[str]:
     if not _redis:
         return None
     try:
+        _bill("partners")
+        if CLIENT_LAYOUT == "hash":
+            return await _redis.hget(client_key(ws_id), "p")
         return await _redis.get(partner_key(ws_id))
     except RedisError:
         return None
@@ -524,9 +1909,11 @@ async def clear_partner(ws_id: str) -> Optional[str]:
     if not _redis:
         return None
     try:
-        partner = await _redis.eval(
-            _CLEAR_PARTNER_LUA, 1, partner_key(ws_id), f"{PREFIX}:partner:"
+        partner = await _eval(
+            _CLEAR_PARTNER_LUA, 1, partner_key(ws_id), _prefix(group_of(ws_id)), ws_id
         )
+        if partner and group_of(partner) != group_of(ws_id):
+            await _unpair(partner, ws_id)
         return partner or None
     except RedisError as e:
         logger.warning(f"clear_partner failed: {e}")
@@ -534,26 +1921,203 @@ async def clear_partner(ws_id: str) -> Optional[str]:
 
 
 # --- Delivery (local first, else cross-instance via pub/sub) --------------
-
-async def route(target_ws_id: str, message: dict) -> None:
-    """Deliver `message` to a client that may be on any instance."""
-    text = json.dumps(message)
-    if _local_delivery is not None:
+#
+# Every instance subscribes to one channel of its own, yf:inst:<instance_id>, and
+# a frame for a client on another instance is published to its owner's channel.
+# This replaced a pattern subscription to per-client channels (yf:chan:*), under
+# which Redis delivered every relayed frame to every instance and each dropped
+# the ones it did not own: ingress per instance grew with the size of the fleet.
+# Now it is only the frames that instance's own clients receive.
+#
+# Frames are not published one by one. route() files them in _outbox under the
+# owning instance and a single flusher task sends each instance's frames as one
+# PUBLISH (one pipeline for all instances) on the next loop iteration, so a burst
+# of ICE candidates costs one command per destination instead of one per frame.
+# There is only ever one flusher, and it takes the outbox whole, so the frames
+# for a client leave in the order route() was called, which SDP/ICE rely on.
+#
+# Each frame in an envelope has a header naming its target, and optionally its
+# sender and pairing news, exactly the arguments of the delivery callback:
+#
+#   "<ws_id>"                      a server frame
+#   "<ws_id> <sender>"             relayed from sender (dropped if no longer paired)
+#   "<ws_id> <partner> <instance>" PARTNER_FOUND: now paired with partner, there
+#   "<ws_id> <partner> -"          PARTNER_LEFT: partner has unpaired from ws_id
+#
+# Client and instance ids never contain spaces or newlines.
+#
+# Every envelope opens with a stamp, "@<queued ms> <published ms>" over an empty
+# text: wall-clock time when its oldest frame entered the outbox, and when it was
+# published. The receiver turns these into the remote relay latency and the
+# pub/sub listener's lag for /metrics. It is the only header starting with "@",
+# and an instance that predates it takes it for a client it does not hold and
+# drops it. Instance clocks are NTP-synced, not identical, so both figures are
+# good to a few ms and clamped at zero.
+
+# Frames relayed between clients, from route() to the recipient's socket write:
+# local when both are here, remote when the frame went through the outbox (timed
+# from the oldest frame of its envelope: an upper bound for the rest). Observed
+# by relay_written(), which the socket's writer calls, so both paths include the
+# wait in its outbound queue.
+_RELAY_SECONDS = {path: metrics.histogram("yawnfox_relay_seconds",
+                                          "Relay latency of signaling frames.", path=path)
+                  for path in ("local", "remote")}
+_LISTENER_LAG = metrics.histogram("yawnfox_pubsub_lag_seconds",
+                                  "Envelope PUBLISH to its receipt by the owner's listener.")
+
+# Server frames that never vary, encoded once rather than on every match.
+_PARTNER_FOUND_FRAMES = {role: json.dumps({"name": "PARTNER_FOUND", "data": role})
+                         for role in ("GO_FIRST", "WAIT")}
+_PARTNER_LEFT_FRAME = json.dumps({"name": "PARTNER_LEFT"})
+
+
+def _pack_frames(frames: list) -> str:
+    """Envelope for several frames on one channel: "<header>\n<len>\n<text>" each.
+
+    Lengths count Python str characters, not bytes: both ends are this module,
+    and the client is decode_responses=True.
+    """
+    return "".join(f"{header}\n{len(text)}\n{text}" for header, text in frames)
+
+
+def _unpack_frames(data: str) -> list:
+    frames, i = [], 0
+    while i < len(data):
+        j = data.index("\n", i)
+        k = data.index("\n", j + 1)
+        end = k + 1 + int(data[j + 1:k])
+        frames.append((data[i:j], data[k + 1:end]))
+        i = end
+    return frames
+
+
+def _frame_header(ws_id: str, sender: Optional[str], news: Optional[str]) -> str:
+    if sender is None:
+        return ws_id
+    if news is None:
+        return f"{ws_id} {sender}"
+    return f"{ws_id} {sender} {news or '-'}"
+
+
+def _parse_header(header: str) -> tuple:
+    ws_id, sender, news = (header.split(" ") + [None, None])[:3]
+    return ws_id, sender, ("" if news == "-" else news)
+
+
+def _remember_owner(ws_id: str, owner: str) -> None:
+    _owner_cache[ws_id] = owner
+    _owner_cache.move_to_end(ws_id)
+    if len(_owner_cache) > OWNER_CACHE_SIZE:
+        _owner_cache.popitem(last=False)
+
+
+async def _owner_of(ws_id: str) -> Optional[str]:
+    """The instance a client is connected to, or None if it is not connected."""
+    owner = _owner_cache.get(ws_id)
+    if owner is not None:
+        _owner_cache.move_to_end(ws_id)
+        return owner
+    _bill("owner_lookup")
+    if CLIENT_LAYOUT == "hash":
+        owner = await _redis.hget(client_key(ws_id), "o")
+    else:
+        owner = await _redis.get(conn_key(ws_id))
+    if owner:
+        _remember_owner(ws_id, owner)
+    return owner or None
+
+
+def _publish_later(owner: str, header: str, text: str) -> None:
+    global _flusher
+    frames = _outbox.get(owner)
+    if frames is None:
+        frames = _outbox[owner] = []
+        _outbox_since[owner] = time.time()
+    frames.append((header, text))
+    if _flusher is None or _flusher.done():
+        _flusher = asyncio.get_running_loop().create_task(_flush_outbox())
+
+
+async def _flush_outbox() -> None:
+    while _outbox:
+        batch, since = dict(_outbox), dict(_outbox_since)
+        _outbox.clear()
+        _outbox_since.clear()
+        if not _redis:
+            continue    # down: dropped, as a failed publish would be
         try:
-            if await _local_delivery(target_ws_id, text):
-                return
-        except Exception as e:
-            logger.warning(f"local delivery error: {e}")
-    if not _redis:
-        return
+            published = int(time.time() * 1000)
+            pipe = _redis.pipeline(transaction=False)
+            for owner, frames in batch.items():
+                stamp = f"@{int(since[owner] * 1000)} {published}\n0\n"
+                pipe.publish(inst_chan(owner), stamp + _pack_frames(frames))
+            _bill("relay_publish", len(batch))
+            await pipe.execute()
+        except RedisError as e:
+            logger.warning(f"publish failed: {e}")
+
+
+async def flush() -> None:
+    """Wait until every frame route() has queued so far has been published."""
+    while _flusher is not None and not _flusher.done():
+        await asyncio.shield(_flusher)
+
+
+async def _deliver_here(ws_id: str, text: str, sender: Optional[str] = None,
+                        news: Optional[str] = None, stamp: Optional[tuple] = None) -> bool:
+    if _local_delivery is None:
+        return False
     try:
-        await _redis.publish(chan_key(target_ws_id), text)
-    except RedisError as e:
-        logger.warning(f"publish failed: {e}")
+        return await _local_delivery(ws_id, text, sender, news, stamp)
+    except Exception as e:
+        logger.warning(f"local delivery error: {e}")
+        return False
+
+
+async def _send(target_ws_id: str, text: str, sender: Optional[str] = None,
+                owner: Optional[str] = None, news: Optional[str] = None) -> None:
+    if owner in (None, _instance_id):
+        stamp = ("local", time.time()) if sender is not None and news is None else None
+        if await _deliver_here(target_ws_id, text, sender, news, stamp):
+            return
+    if _inmemory_mode or not _redis:
+        return  # single instance: not delivered locally means not connected
+    if owner is None:
+        try:
+            owner = await _owner_of(target_ws_id)
+        except RedisError as e:
+            logger.warning(f"owner lookup failed: {e}")
+            return
+    if owner is None or owner == _instance_id:
+        return  # not connected anywhere, or ours and already gone
+    _publish_later(owner, _frame_header(target_ws_id, sender, news), text)
+
+
+async def route(target_ws_id: str, message, sender: Optional[str] = None,
+                owner: Optional[str] = None) -> None:
+    """Deliver `message` to a client that may be on any instance.
+
+    message: a dict, or a frame that is already JSON text (relayed signaling,
+    which is forwarded exactly as the client sent it).
+
+    sender: the client relaying it; the receiving side drops the frame unless
+    target_ws_id is still paired with sender, so a caller may route on a cached
+    partner without re-checking Redis. owner: the target's instance, if the
+    caller already knows it (saves the lookup on a cold owner cache).
+    """
+    text = message if isinstance(message, str) else json.dumps(message)
+    await _send(target_ws_id, text, sender, owner)
+
+
+async def partner_left(target_ws_id: str, leaver: str, owner: Optional[str] = None) -> None:
+    """Tell target_ws_id that leaver (its partner until clear_partner) is gone."""
+    await _send(target_ws_id, _PARTNER_LEFT_FRAME, leaver, owner, news="")
 
 
 # --- Matcher --------------------------------------------------------------
 
+pairs_total = metrics.counter("yawnfox_pairs_total", "Pairs formed by this instance's matcher.")
+
 async def trigger_wakeup() -> None:
     """Wake the local matcher immediately and nudge the other instances."""
     if _on_wakeup:
@@ -561,12 +2125,14 @@ async def trigger_wakeup() -> None:
     if not _redis:
         return
     try:
+        _bill("wakeup")
         await _redis.publish(WAKEUP_CHANNEL, "1")
     except RedisError:
         pass
 
 
-async def try_acquire_matcher_lock() -> bool:
+async def try_acquire_matcher_lock(shard: Optional[int] = None) -> bool:
+    """Claim one shard's pass, or (shard=None) the cross-shard pass."""
     global _mem_matcher_locked
     if _inmemory_mode:
         # Single-instance: simple flag prevents re-entrance within one event loop.
@@ -577,12 +2143,15 @@ async def try_acquire_matcher_lock() -> bool:
     if not _redis:
         return False
     try:
-        return bool(await _redis.set(MATCHER_LOCK_KEY, _instance_id, nx=True, px=MATCHER_LOCK_MS))
+        _bill("match")
+        return bool(await _redis.set(
+            matcher_lock_key(shard), _instance_id, nx=True, px=MATCHER_LOCK_MS
+        ))
     except RedisError:
         return False
 
 
-async def release_matcher_lock() -> None:
+async def release_matcher_lock(shard: Optional[int] = None) -> None:
     global _mem_matcher_locked
     if _inmemory_mode:
         _mem_matcher_locked = False
@@ -590,26 +2159,254 @@ async def release_matcher_lock() -> None:
     if not _redis:
         return
     try:
-        await _redis.eval(_RELEASE_LOCK_LUA, 1, MATCHER_LOCK_KEY, _instance_id)
+        await _eval(_RELEASE_LOCK_LUA, 1, matcher_lock_key(shard), _instance_id)
     except RedisError:
         pass
 
 
-async def run_matcher_rounds(max_rounds: int = 200) -> bool:
+async def run_matcher_rounds(max_rounds: int = 200, shard: Optional[int] = None) -> bool:
     """Form pairs while at least two waiting clients remain.
 
-    Each round is one _MATCH_LUA call, which does the selection and the pop
-    atomically. The caller is expected to hold the matcher lock, but correctness
-    no longer depends on it: losing the lock mid-pass can only duplicate work.
+    Each round is one _MATCH_LUA call, which selects, pops and records up to
+    MATCH_BATCH pairs atomically, plus one pipeline announcing them. The caller
+    is expected to hold the matcher lock, but correctness no longer depends on
+    it: losing the lock mid-pass can only duplicate work.
+
+    `shard` restricts the pass to one shard, which is what matcher_loop does
+    under that shard's lock. Without it every shard is passed in turn, followed
+    by the cross-shard pass — the whole job, for callers that hold no locks.
 
     Returns True if it stopped with work possibly remaining (deadline, round
     cap, or ghosts evicted past the window), so the caller can go again rather
     than wait out MATCH_POLL_SECONDS.
     """
     if _inmemory_mode:
-        return await _run_matcher_rounds_inmemory(max_rounds)
+        if MATCH_MODE == "window":
+            return await _window_pass_inmemory()
+        return await _run_matcher_rounds_inmemory(max_rounds * MATCH_BATCH)
     if not _redis:
         return False
+    if shard is not None:
+        return await _shard_rounds(shard, max_rounds)
+    more = False
+    for s in range(MATCH_SHARDS):
+        more |= await _shard_rounds(s, max_rounds)
+    if MATCH_SHARDS > 1:
+        more |= await run_cross_shard_rounds(max_rounds)
+    return more
+
+
+async def _shard_rounds(shard: int, max_rounds: int) -> bool:
+    if MATCH_MODE == "window":
+        return await _window_pass(shard)
+    # A cluster's shard is a slot group, laid out as a single-node shard 0.
+    if REDIS_CLUSTER:
+        return await _run_rounds(_MATCH_LUA, [waiting_key(shard)], max_rounds, _prefix(shard), 0)
+    return await _run_rounds(_MATCH_LUA, [waiting_key(shard)], max_rounds, _prefix(0), shard)
+
+
+# MATCH_MODE=window: per shard, when (epoch ms) its last pass said a client left
+# queued ripens or goes overdue. See match_due().
+_match_due: dict = {}
+
+
+def match_due() -> Optional[float]:
+    """Seconds until a window pass should look again though nobody arrived, or
+    None. A time already past is handed out once: if its pass did not run (the
+    shard's lock was held elsewhere), whoever held it has set its own."""
+    now = time.time() * 1000
+    for shard in [s for s, due in _match_due.items() if due <= now]:
+        del _match_due[shard]
+    if not _match_due:
+        return None
+    return (min(_match_due.values()) - now) / 1000
+
+
+def _solve(shard: Optional[int], waiting: list) -> list:
+    """matching.solve() over `waiting`, noting when the shard (None: the
+    cross-shard pass) should look again."""
+    pairs, due = matching.solve(waiting, time.time() * 1000)
+    if due is None:
+        _match_due.pop(shard, None)
+    else:
+        _match_due[shard] = due
+    return pairs
+
+
+def _window_args(shard: int) -> tuple:
+    # A cluster's shard is a slot group, laid out as a single-node shard 0.
+    if REDIS_CLUSTER:
+        return _prefix(shard), 0
+    return _prefix(0), shard
+
+
+async def _read_window(shard: int) -> tuple:
+    """A shard's window, from _WINDOW_LUA: (full, [(ws_id, score, owner,
+    topics, score as stored)], oldest first). Empty if Redis failed."""
+    prefix, index = _window_args(shard)
+    try:
+        res = await _eval(_WINDOW_LUA, 1, waiting_key(shard), prefix, MATCH_WINDOW, index)
+    except RedisError as e:
+        logger.warning(f"match eval failed: {e}")
+        return False, []
+    waiting = []
+    i = 1
+    while i < len(res):
+        n = int(res[i + 3])
+        waiting.append((res[i], float(res[i + 1]), res[i + 2],
+                        frozenset(res[i + 4:i + 4 + n]), res[i + 1]))
+        i += 4 + n
+    return res[0] == "MORE", waiting
+
+
+async def _claim(keys: list, first: int, prefix: str, pairs: list, at: dict) -> None:
+    """Claim solved pairs with one _CLAIM_LUA; `at` maps a ws_id to (score as
+    stored, its index in `keys`). Then the PARTNER_FOUNDs."""
+    args = [x for a, b in pairs for w in (a, b) for x in (w, at[w][0], at[w][1] + 1)]
+    try:
+        formed = await _eval(_CLAIM_LUA, len(keys), *keys, prefix, first, *args)
+    except RedisError as e:
+        logger.warning(f"match eval failed: {e}")
+        return
+    if formed:
+        await _notify_pairs(formed)
+
+
+async def _window_pass(shard: int) -> bool:
+    """One MATCH_MODE=window pass over a shard: _WINDOW_LUA, matching.solve(),
+    _CLAIM_LUA, then the PARTNER_FOUNDs. True if the window was full and the
+    pass made room in it (pairs formed, ghosts evicted), so there is more."""
+    full, waiting = await _read_window(shard)
+    pairs = _solve(shard, [(w, since, topics) for w, since, _, topics, _ in waiting])
+    if not pairs:
+        return full and len(waiting) < MATCH_WINDOW
+    prefix, index = _window_args(shard)
+    await _claim([waiting_key(shard)], index, prefix, pairs,
+                 {w: (score, 0) for w, _, _, _, score in waiting})
+    return full
+
+
+async def run_cross_shard_rounds(max_rounds: int = 200) -> bool:
+    """Pair the leftovers of different shards (see _MATCH_CROSS_LUA).
+
+    Same contract as run_matcher_rounds; the caller is expected to hold the
+    cross-shard lock (try_acquire_matcher_lock(None)).
+    """
+    if _inmemory_mode or not _redis:
+        return False
+    if MATCH_MODE == "window":
+        return await _cross_window_pass()
+    if REDIS_CLUSTER:
+        return await _cross_group_rounds(max_rounds)
+    keys = [waiting_key(s) for s in range(MATCH_SHARDS)]
+    return await _run_rounds(_MATCH_CROSS_LUA, keys, max_rounds, _prefix(0))
+
+
+async def _cross_window_pass() -> bool:
+    """MATCH_MODE=window's cross-shard pass: every shard's window read as
+    _window_pass reads it, and the oldest MATCH_WINDOW of them solved as one
+    pool, under the same hold and aging, so a client held back by its shard's
+    pass is not handed to a peer from another shard before its hold is up.
+
+    On a single node the pairs are claimed in one _CLAIM_LUA over every shard.
+    On a cluster no script sees two slot groups, so each pair is taken one side
+    at a time, as _cross_group_rounds does. True if a window was full and pairs
+    were formed, so there is more.
+    """
+    reads = await asyncio.gather(*(_read_window(s) for s in range(MATCH_SHARDS)))
+    pool = sorted((since, w, owner, topics, score, s)
+                  for s, (_, waiting) in enumerate(reads)
+                  for w, since, owner, topics, score in waiting)
+    full = any(f for f, _ in reads) or len(pool) > MATCH_WINDOW
+    pool = pool[:MATCH_WINDOW]
+    pairs = _solve(None, [(w, since, topics) for since, w, _, topics, _, _ in pool])
+    if not pairs:
+        return False
+    if not REDIS_CLUSTER:
+        await _claim([waiting_key(s) for s in range(MATCH_SHARDS)], 0, _prefix(0), pairs,
+                     {w: (score, s) for _, w, _, _, score, s in pool})
+        return full
+    # As _group_head() has them: (score, ws_id, owner, topics, group, score as stored).
+    heads = {w: (since, w, owner, set(topics), s, score)
+             for since, w, owner, topics, score, s in pool}
+    for a, b in pairs:
+        if await _take(heads[a], b):
+            if await _take(heads[b], a):
+                await _notify_pairs([a, heads[a][2], b, heads[b][2]])
+            else:
+                await _untake(heads[a])
+    return full
+
+
+async def _cross_group_rounds(max_rounds: int) -> bool:
+    """The cross-shard pass on a cluster, where one script sees one slot group.
+
+    _MATCH_CROSS_LUA's selection over the groups' heads, read with one _HEAD_LUA
+    per group, but each pair is then taken one side at a time (_TAKE_LUA), each
+    only if that client is still queued as it was read. Should the second side
+    be gone (paired by a shard pass, left, re-queued), the first is put back
+    where it was. Not atomic, then, but nobody is paired twice or lost: the
+    worst case is a client briefly out of the pool.
+    """
+    deadline = time.monotonic() + MATCHER_LOCK_MS / 1000 * 0.8
+    heads = list(await asyncio.gather(*(_group_head(g) for g in _groups())))
+    for _ in range(max_rounds * MATCH_BATCH):
+        if time.monotonic() > deadline:
+            return True
+        live = sorted(h for h, _ in heads if h)
+        if len(live) < 2:
+            return any(blind for _, blind in heads)
+        a = live[0]
+        b = next((h for h in live[1:] if h[3] & a[3]), live[1]) if a[3] else live[1]
+        if await _take(a, b[1]):
+            if await _take(b, a[1]):
+                await _notify_pairs([a[1], a[2], b[1], b[2]])
+            else:
+                await _untake(a)
+        heads[a[4]], heads[b[4]] = await asyncio.gather(_group_head(a[4]), _group_head(b[4]))
+    return True
+
+
+async def _group_head(group: int) -> tuple:
+    """(head, blind) of a slot group, from _HEAD_LUA. head is (score, ws_id,
+    owner, topics, group, score as stored) or None; blind if the window was all ghosts."""
+    try:
+        res = await _eval(_HEAD_LUA, 1, waiting_key(group), _prefix(group), MATCH_WINDOW)
+    except RedisError as e:
+        logger.warning(f"match eval failed: {e}")
+        return None, False
+    if len(res) == 1:
+        return None, res[0] == "MORE"
+    return (float(res[2]), res[1], res[3], set(res[4:]), group, res[2]), False
+
+
+async def _take(head: tuple, partner: str) -> bool:
+    ws_id, group = head[1], head[4]
+    try:
+        return bool(await _eval(_TAKE_LUA, 3, waiting_key(group), topics_key(ws_id),
+                                partner_key(ws_id), ws_id, head[5], partner,
+                                topic_index_key(group, ""), _prefix(group)))
+    except RedisError as e:
+        logger.warning(f"match eval failed: {e}")
+        return False
+
+
+async def _untake(head: tuple) -> None:
+    """Undo _take(): back in the pool with its old score and topics, unpaired."""
+    ws_id, group = head[1], head[4]
+    try:
+        await _eval(_ENQUEUE_LUA, 2, waiting_key(group), topics_key(ws_id), ws_id, head[5],
+                    TOPICS_TTL, topic_index_key(group, ""), _prefix(group), *sorted(head[3]))
+        _bill("match")
+        if CLIENT_LAYOUT == "hash":
+            await _redis.hdel(client_key(ws_id), "p")
+        else:
+            await _redis.delete(partner_key(ws_id))
+    except RedisError as e:
+        logger.warning(f"match rollback failed for {ws_id}: {e}")
+
+
+async def _run_rounds(script: str, keys: list, max_rounds: int, prefix: str, *extra) -> bool:
     # Stop before the lock we hold can expire under us, rather than spending a
     # command per round to refresh it.
     deadline = time.monotonic() + MATCHER_LOCK_MS / 1000 * 0.8
@@ -617,103 +2414,252 @@ async def run_matcher_rounds(max_rounds: int = 200) -> bool:
         if time.monotonic() > deadline:
             return True
         try:
-            pair = await _redis.eval(
-                _MATCH_LUA, 1, WAITING_KEY, f"{PREFIX}:", MATCH_WINDOW
+            res = await _eval(
+                script, len(keys), *keys,
+                prefix, MATCH_WINDOW, MATCH_BATCH, *extra,
             )
         except RedisError as e:
             logger.warning(f"match eval failed: {e}")
             return False
-        if not pair:
+        if len(res) > 1:
+            await _notify_pairs(res[1:])
+        if res[0] != "MORE":
             return False        # pool exhausted
-        if len(pair) < 2:
-            continue            # 'RETRY': ghosts evicted, live peers may follow
-        a, b = pair[0], pair[1]
-        await set_partners(a, b)
-        logger.info(f"Match formed: {a} <> {b}")
-        await route(a, {"name": "PARTNER_FOUND", "data": "GO_FIRST"})
-        await route(b, {"name": "PARTNER_FOUND", "data": "WAIT"})
     return True
 
 
+async def _notify_pairs(flat: list) -> None:
+    """Send PARTNER_FOUND for a batch from _MATCH_LUA ([a, owner_a, b, owner_b, ...]).
+
+    Clients this instance owns are written to directly; everyone else's frames
+    join the route() outbox, so a batch costs one PUBLISH per owning instance.
+    Each frame carries the partner and its instance, which the receiving side
+    caches so that relaying during the call needs no Redis reads. The owners
+    come back from the script, so they also warm the owner cache.
+
+    b (WAIT) is told before a (GO_FIRST): a opens with an offer, and b's side
+    must know its partner before that offer arrives or it would drop it.
+    """
+    pairs_total.inc(len(flat) // 4)
+    for i in range(0, len(flat), 4):
+        a, owner_a, b, owner_b = flat[i:i + 4]
+        logger.info(f"Match formed: {a} <> {b}")
+        for ws_id, owner, partner, partner_owner, role in (
+                (b, owner_b, a, owner_a, "WAIT"), (a, owner_a, b, owner_b, "GO_FIRST")):
+            _remember_owner(ws_id, owner)
+            await _send(ws_id, _PARTNER_FOUND_FRAMES[role], partner, owner,
+                        news=partner_owner)
+
+
 async def _run_matcher_rounds_inmemory(max_rounds: int = 200) -> bool:
-    """In-memory equivalent of run_matcher_rounds (single-instance only)."""
-    rounds = 0
-    while rounds < max_rounds:
-        rounds += 1
-        if len(_mem_waiting) < 2:
+    """In-memory equivalent of run_matcher_rounds (single-instance only).
+
+    Same selection as _MATCH_LUA: the oldest live waiter, paired with the oldest
+    live waiter sharing one of its topics, else with the next-oldest live one.
+    Selection and pop are plain dict operations with no await between them, so
+    unlike the Redis path there is nothing to race.
+    """
+    for _ in range(max_rounds):
+        pair = _mem_pop_pair()
+        if pair is None:
             return False
-        # Oldest enqueue timestamp first (fairness mirrors Redis ZRANGE), bounded
-        # to the same window the Lua matcher reads.
-        waiting = sorted(_mem_waiting.items(), key=lambda x: x[1])[:MATCH_WINDOW]
-
-        evicted = False
-        candidate_a, _ = waiting[0]
-        if not await is_connected(candidate_a):
-            await remove_waiting(candidate_a)
+        a, b = pair
+        _mem_partners[a] = b
+        _mem_partners[b] = a
+        pairs_total.inc()
+        logger.info(f"Match formed: {a} <> {b}")
+        # b first, for the reason given in _notify_pairs.
+        await _send(b, _PARTNER_FOUND_FRAMES["WAIT"], a, news=_instance_id)
+        await _send(a, _PARTNER_FOUND_FRAMES["GO_FIRST"], b, news=_instance_id)
+    return True  # hit the round cap; work may remain
+
+
+async def _window_pass_inmemory() -> bool:
+    """In-memory equivalent of _window_pass: the oldest MATCH_WINDOW live
+    waiters, solved and popped with no await in between, then told."""
+    waiting, ghosts = [], []
+    for ws_id in _mem_waiting:
+        if ws_id not in _mem_connections:
+            ghosts.append(ws_id)
             continue
+        waiting.append((ws_id, _mem_since[ws_id], frozenset(_mem_topics.get(ws_id, ()))))
+        if len(waiting) == MATCH_WINDOW:
+            break
+    for g in ghosts:
+        _mem_unqueue(g)
+    pairs = _solve(0, waiting)
+    for a, b in pairs:
+        _mem_unqueue(a)
+        _mem_unqueue(b)
+        _mem_partners[a] = b
+        _mem_partners[b] = a
+        pairs_total.inc()
+        logger.info(f"Match formed: {a} <> {b}")
+    for a, b in pairs:
+        # b first, for the reason given in _notify_pairs.
+        await _send(b, _PARTNER_FOUND_FRAMES["WAIT"], a, news=_instance_id)
+        await _send(a, _PARTNER_FOUND_FRAMES["GO_FIRST"], b, news=_instance_id)
+    return len(waiting) == MATCH_WINDOW and bool(pairs)
 
-        topics_a = _mem_topics.get(candidate_a, set())
-        best_match = None
-        first_alive = None
-
-        for other, _ in waiting[1:]:
-            if not await is_connected(other):
-                await remove_waiting(other)
-                evicted = True
-                continue
-            if first_alive is None:
-                first_alive = other
-            if not topics_a:
-                break  # no topic preference -> longest-waiting peer is enough
-            if topics_a & _mem_topics.get(other, set()):
-                best_match = other
-                break
 
-        if best_match is None:
-            best_match = first_alive
-        if best_match is None:
-            # Only ghosts besides candidate_a. If any were just evicted, live
-            # peers may sit past the window -- mirrors the Lua 'RETRY' branch.
-            if evicted:
-                continue
-            return False
+def _mem_pop_pair() -> Optional[tuple]:
+    """Select and dequeue the next pair, or None if fewer than two live remain.
 
-        # Guard against a concurrent cleanup that ran during an await above
-        if candidate_a not in _mem_waiting or best_match not in _mem_waiting:
+    Ghosts (queued but no longer registered) are evicted as they are met, so
+    each costs O(1) once rather than being re-skipped every round.
+    """
+    while len(_mem_waiting) >= 2:
+        a = next(iter(_mem_waiting))
+        if a not in _mem_connections:
+            _mem_unqueue(a)
             continue
-        _mem_waiting.pop(candidate_a, None)
-        _mem_waiting.pop(best_match, None)
-        _mem_topics.pop(candidate_a, None)
-        _mem_topics.pop(best_match, None)
-
-        await set_partners(candidate_a, best_match)
-        logger.info(f"Match formed: {candidate_a} <> {best_match}")
-        await route(candidate_a, {"name": "PARTNER_FOUND", "data": "GO_FIRST"})
-        await route(best_match, {"name": "PARTNER_FOUND", "data": "WAIT"})
-    return True  # hit the round cap; work may remain
+        best = None
+        for t in _mem_topics.get(a, ()):
+            peer = _mem_first_live(_mem_topic_index.get(t, ()), a)
+            if peer is not None and (best is None or _mem_waiting[peer] < _mem_waiting[best]):
+                best = peer
+        if best is None:
+            best = _mem_first_live(_mem_waiting, a)
+        if best is None:
+            return None
+        _mem_unqueue(a)
+        _mem_unqueue(best)
+        return a, best
+    return None
+
+
+def _mem_first_live(queue, skip: str) -> Optional[str]:
+    """Oldest registered member of `queue` other than `skip`; evicts ghosts ahead of it."""
+    ghosts = []
+    found = None
+    for m in queue:
+        if m == skip:
+            continue
+        if m in _mem_connections:
+            found = m
+            break
+        ghosts.append(m)
+    for g in ghosts:
+        _mem_unqueue(g)
+    return found
 
 
 # --- Rate limiting --------------------------------------------------------
 
+class _IpWindow:
+    """One IP's connection limiter state on this instance."""
+    __slots__ = ("times", "unsynced", "others", "lease_until", "syncing")
+
+    def __init__(self):
+        self.times = deque()        # admissions here, monotonic, oldest first
+        self.unsynced = 0           # ...of which not yet pushed to Redis
+        self.others = 0             # the rest of the fleet's, as of the last sync
+        self.lease_until = 0.0      # that count is trusted until then
+        self.syncing: Optional[asyncio.Task] = None
+
+    def prune(self, now: float) -> None:
+        while self.times and self.times[0] <= now - RATE_LIMIT_WINDOW:
+            self.times.popleft()
+
+
 async def check_rate_limit(ip: str) -> bool:
-    """Sliding-window limiter (per IP). Returns True if the connection is allowed.
+    """Sliding-window connection limiter (per IP). True if the connection is allowed.
 
-    Fails open (allows the connection) when Redis is unavailable so an outage
-    never locks every user out. In-memory mode also fails open.
+    Decided in-process against this instance's admissions plus a lease on the
+    rest of the fleet's (see RATE_LIMIT_SYNC_MS). Works the same in in-memory
+    mode, minus the fleet, and while Redis is down it still limits per instance;
+    the admissions are pushed once it is back.
     """
-    if _inmemory_mode or not _redis:
-        return True
-    now_ms = int(time.time() * 1000)
-    member = f"{now_ms}-{uuid.uuid4().hex[:8]}"
-    try:
-        result = await _redis.eval(
-            _RATE_LIMIT_LUA, 1, rate_key(ip),
-            now_ms, RATE_LIMIT_WINDOW * 1000, RATE_LIMIT_MAX, member,
-        )
-        return result == 1
-    except RedisError as e:
-        logger.warning(f"rate limit check failed (fail-open): {e}")
-        return True
+    now = time.monotonic()
+    w = _rate_local.get(ip)
+    if w is None:
+        w = _rate_local[ip] = _rate_evicted.pop(ip, None) or _IpWindow()
+        if len(_rate_local) > RATE_LIMIT_LOCAL_IPS:
+            _evict_rate_window()
+    else:
+        _rate_local.move_to_end(ip)
+    w.prune(now)
+    # Over the command budget the fleet's counts are optional work: shed them.
+    synced = _redis is not None and not _inmemory_mode and not over_budget()
+    if synced and (w.times or w.others) and now >= w.lease_until:
+        if w.syncing is None:
+            w.syncing = asyncio.ensure_future(_sync_rate_limits([ip]))
+            w.syncing.add_done_callback(lambda _: setattr(w, "syncing", None))
+        await asyncio.shield(w.syncing)
+    allowed = len(w.times) + w.others < RATE_LIMIT_MAX
+    if allowed:
+        w.times.append(now)
+        w.unsynced += 1
+    if synced:
+        # Refused attempts are synced too: the count they come back with is
+        # what lifts a refusal once the fleet's admissions age out.
+        _rate_dirty.add(ip)
+        if len(_rate_dirty) == 1:
+            asyncio.get_running_loop().call_later(
+                RATE_LIMIT_SYNC_MS / 1000, lambda: _rate_dirty and _spawn(_sync_rate_limits()))
+    return allowed
+
+
+def _evict_rate_window() -> None:
+    """Make room in _rate_local: drop its least recently seen IP. One with
+    admissions not yet in Redis is kept aside for the next sync instead, or an
+    attacker cycling through addresses could push everyone else's admissions out
+    before they count. Should RATE_LIMIT_LOCAL_IPS of them pile up before that
+    sync, they are synced at once; only while syncs fail are the oldest dropped,
+    past twice that."""
+    ip, w = _rate_local.popitem(last=False)
+    if not w.unsynced or _inmemory_mode:
+        return
+    _rate_evicted[ip] = w
+    if len(_rate_evicted) == RATE_LIMIT_LOCAL_IPS:
+        _spawn(_sync_rate_limits())
+    elif len(_rate_evicted) > 2 * RATE_LIMIT_LOCAL_IPS:
+        _rate_evicted.popitem(last=False)
+
+
+async def _sync_rate_limits(ips: Optional[list] = None) -> None:
+    """Push unsynced admissions, renew leases: one EVAL per 500 IPs (and slot group).
+
+    Every IP seen since the last sync, and every IP evicted with admissions
+    still to push, when `ips` is None. Never raises.
+    """
+    global _rate_syncs
+    windows = {}
+    if ips is None:
+        ips = list(_rate_dirty)
+        _rate_dirty.clear()
+        windows.update(_rate_evicted)
+        _rate_evicted.clear()
+    windows.update((ip, _rate_local[ip]) for ip in ips if ip in _rate_local)
+    for _, chunk in _chunks(list(windows)):
+        ws = [windows[ip] for ip in chunk]
+        pushed = [w.unsynced for w in ws]
+        for w in ws:
+            w.unsynced = 0
+        _rate_syncs += 1
+        try:
+            if not _redis:
+                raise RedisError("redis is down")
+            totals = await _eval(_RATE_SYNC_LUA[RATE_LIMIT_ENGINE], len(chunk),
+                                 *[rate_key(ip) for ip in chunk], int(time.time() * 1000),
+                                 RATE_LIMIT_WINDOW * 1000, RATE_LIMIT_MAX,
+                                 f"{_instance_id}:{_rate_syncs}", *pushed)
+        except RedisError as e:
+            # Keep them for the next sync; until then each IP is limited on
+            # this instance's admissions alone.
+            for ip, w, n in zip(chunk, ws, pushed):
+                w.unsynced += n
+                if n and ip not in _rate_local:
+                    _rate_evicted[ip] = w
+            logger.warning(f"rate limit sync failed for {len(chunk)} IPs: {e}")
+            continue
+        now = time.monotonic()
+        for w, total in zip(ws, totals):
+            w.prune(now)
+            # Admissions made while this call was out are in times but not
+            # yet in total.
+            w.others = max(0, int(total) - (len(w.times) - w.unsynced))
+            w.lease_until = now + RATE_LIMIT_SYNC_MS / 1000
 
 
 # --- Pub/Sub listener -----------------------------------------------------
@@ -721,9 +2667,10 @@ async def check_rate_limit(ip: str) -> bool:
 async def pubsub_listener() -> None:
     """Background task: deliver cross-instance messages and matcher wakeups.
 
-    Uses a single pattern subscription (`yf:chan:*`) so connections never have
-    to (un)subscribe individually; each instance simply ignores channels for
-    clients it does not own. Reconnects with backoff on failure.
+    Subscribes to this instance's own delivery channel (see the Delivery section)
+    and the wakeup channel, nothing per client, so connections never have to
+    (un)subscribe individually and no instance hears frames for clients it does
+    not own. Reconnects with backoff on failure.
 
     Doubles as this instance's Redis health signal, which is why nothing else
     polls for it. The connection here is long lived, and redis-py PINGs it every
@@ -748,10 +2695,14 @@ async def pubsub_listener() -> None:
             await asyncio.sleep(1.0)
             continue
         try:
-            _pubsub = _client.pubsub(ignore_subscribe_messages=True)
-            await _pubsub.psubscribe(CHAN_PATTERN)
-            await _pubsub.subscribe(WAKEUP_CHANNEL)
-            # Both subscribes are real commands, so reaching here proves the
+            _pubsub = _pubsub_client.pubsub(ignore_subscribe_messages=True)
+            my_chan = inst_chan(_instance_id)
+            _bill("connect")
+            await _pubsub.subscribe(my_chan, WAKEUP_CHANNEL)
+            # A reconnect is usually a restart or failover, which empties the
+            # script cache; reload before the first EVALSHA can miss.
+            await _load_scripts()
+            # The subscribe is a real command, so reaching here proves the
             # connection works — including on the first pass after a failed
             # startup, which is how a cold start during an outage recovers.
             _set_redis_up(True)
@@ -769,17 +2720,19 @@ async def pubsub_listener() -> None:
                     # reported healthy indefinitely (still "redis" after 47s).
                     # So when the link has gone quiet, ask a question that has to
                     # be answered. A failure raises into the except below.
-                    if time.monotonic() - last_proof >= HEALTH_PING_SECONDS:
+                    # Stretched as the command budget runs low (budget_stretch).
+                    if time.monotonic() - last_proof >= HEALTH_PING_SECONDS * budget_stretch():
                         # wait_for, not the client's socket_timeout: measured, a
                         # PING against a SIGSTOPed server was still blocked after
                         # 25s despite socket_timeout=5 and retry_on_timeout. An
                         # unbounded await here would wedge this whole task, which
                         # also carries cross-instance delivery.
-                        await asyncio.wait_for(_client.ping(), HEALTH_PING_TIMEOUT)
+                        _bill("health_ping")
+                        await asyncio.wait_for(_pubsub_client.ping(), HEALTH_PING_TIMEOUT)
                         last_proof = time.monotonic()
                     continue
                 last_proof = time.monotonic()   # real traffic is its own proof
-                if msg.get("type") not in ("message", "pmessage"):
+                if msg.get("type") != "message":
                     continue
                 channel = msg.get("channel")
                 data = msg.get("data")
@@ -787,13 +2740,18 @@ async def pubsub_listener() -> None:
                     if _on_wakeup:
                         _on_wakeup()
                     continue
-                if channel and channel.startswith(CHAN_PREFIX) and data is not None:
-                    ws_id = channel[len(CHAN_PREFIX):]
-                    if _local_delivery is not None:
-                        try:
-                            await _local_delivery(ws_id, data)
-                        except Exception as e:
-                            logger.warning(f"pubsub local delivery failed: {e}")
+                if channel == my_chan and data:
+                    stamp = None
+                    for header, text in _unpack_frames(data):
+                        if header[0] == "@":
+                            queued, published = header[1:].split(" ")
+                            now = time.time() * 1000
+                            _LISTENER_LAG.observe(max(0.0, now - int(published)) / 1000)
+                            stamp = ("remote", int(queued) / 1000)
+                            continue
+                        ws_id, sender, news = _parse_header(header)
+                        relayed = stamp if sender is not None and news is None else None
+                        await _deliver_here(ws_id, text, sender, news, relayed)
         except asyncio.CancelledError:
             raise
         except Exception as e:
@@ -0,0 +1,179 @@
+"""The one-hash-per-client layout (CLIENT_LAYOUT=hash).
+
+Drives store in-process against a bare Redis, like test_matcher.py, but with
+every client's state in one yf:c:<id> hash and compact ids. Everything a client
+goes through is covered, from registering to being swept, through the public
+store calls only, so the same paths run as in production.
+
+    redis-server --port 6390 --daemonize yes --save "" --appendonly no
+    REDIS_URL=redis://localhost:6390 python tests/test_client_layout.py
+
+Env overrides: REDIS_URL (default redis://localhost:6390).
+"""
+import os
+import sys
+import json
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("REDIS_URL", "redis://localhost:6390")
+os.environ["CLIENT_LAYOUT"] = "hash"
+
+import redis.asyncio as aioredis  # noqa: E402
+
+import store  # noqa: E402  (reads CLIENT_LAYOUT at import)
+
+REDIS_URL = os.environ["REDIS_URL"]
+
+passed = []
+failed = []
+heard = []
+
+
+def check(name, ok, detail=""):
+    (passed if ok else failed).append(name)
+    print(f"  [{'PASS' if ok else 'FAIL'}] {name}{(' -> ' + detail) if detail else ''}")
+
+
+async def reset(r):
+    keys = [k async for k in r.scan_iter(match=f"{store.PREFIX}:*", count=1000)]
+    for i in range(0, len(keys), 500):
+        await r.delete(*keys[i:i + 500])
+
+
+async def deliver(ws_id, text, sender=None, news=None, stamp=None):
+    heard.append((ws_id, json.loads(text)["name"]))
+    return True
+
+
+async def client_keys(r) -> list:
+    """Every key a client could own, in either layout."""
+    keys = []
+    for kind in ("c", "conn", "partner", "topics"):
+        keys += [k async for k in r.scan_iter(match=f"{store.PREFIX}:{kind}:*", count=1000)]
+    return keys
+
+
+async def connected(n: int) -> list:
+    ids = [store.new_client_id() for _ in range(n)]
+    await store._register(ids)
+    return ids
+
+
+async def test_one_hash(r):
+    print("\nTest 1: a queued client is one small hash, under a compact id")
+    await reset(r)
+    a, b = await connected(2)
+    check("ids are 22 url-safe characters",
+          len(a) == 22 and all(c.isalnum() or c in "-_" for c in a), a)
+    await store.enqueue_waiting(a, ["chess", "go"])
+    keys = await client_keys(r)
+    check("one key per client, nothing in the keys layout",
+          sorted(keys) == sorted([store.client_key(a), store.client_key(b)]), str(keys))
+    fields = await r.hgetall(store.client_key(a))
+    check("it holds the instance and the topics",
+          fields == {"o": store.instance_id(), "t:chess": "", "t:go": ""}, str(fields))
+    encoding = await r.object("encoding", store.client_key(a))
+    check("stored as a listpack", encoding in ("listpack", "ziplist"), str(encoding))
+    check("the client reads back as connected", await store.is_connected(a)
+          and await store._owner_of(a) == store.instance_id())
+
+
+async def test_match_and_next(r):
+    print("\nTest 2: matching, Next and LEAVE in the hash")
+    await reset(r)
+    a, b, c = await connected(3)
+    for ws_id, topics in ((a, ["chess"]), (b, []), (c, ["chess"])):
+        await store.enqueue_waiting(ws_id, topics)
+        await asyncio.sleep(0.002)
+    heard.clear()
+    await store.run_matcher_rounds()
+    check("the topic match wins",
+          await store.get_partner(a) == c and await store.get_partner(c) == a)
+    check("pairing clears the topics, keeps the instance",
+          await r.hgetall(store.client_key(a)) == {"o": store.instance_id(), "p": c})
+    check("the topic index is empty", await r.exists(store.topic_index_key(0, "chess")) == 0)
+    check("both are told", sorted(w for w, _ in heard) == sorted([a, c]))
+    heard.clear()
+    partner = await store.requeue(a, ["go"])
+    check("Next: the partner is told and both halves are gone",
+          partner == c and (c, "PARTNER_LEFT") in heard
+          and await store.get_partner(a) is None and await store.get_partner(c) is None)
+    check("and it is queued with its new topics",
+          await r.hgetall(store.client_key(a)) == {"o": store.instance_id(), "t:go": ""}
+          and await r.zscore(store.topic_index_key(0, "go"), a) is not None)
+    await store.remove_waiting(a)
+    check("LEAVE: out of the pool, the topics dropped",
+          await r.hgetall(store.client_key(a)) == {"o": store.instance_id()}
+          and await r.zscore(store.WAITING_KEY, a) is None)
+    await store.set_partners(b, c)
+    check("set_partners and clear_partner",
+          await store.get_partner(c) == b and await store.clear_partner(b) == c
+          and await store.get_partner(c) is None)
+
+
+async def test_disconnect(r):
+    print("\nTest 3: a disconnect deletes the hash outright")
+    await reset(r)
+    a, b = await connected(2)
+    await store.enqueue_waiting(a, ["chess"])
+    await store.set_partners(a, b)
+    heard.clear()
+    await store.disconnect(a)
+    check("the client's hash is gone", await r.exists(store.client_key(a)) == 0)
+    check("the partner is told and keeps only its instance",
+          (b, "PARTNER_LEFT") in heard
+          and await r.hgetall(store.client_key(b)) == {"o": store.instance_id()})
+    await store.unregister_connection(b)
+    check("unregistering the last field leaves no key", await client_keys(r) == [])
+
+
+async def test_sweep(r):
+    print("\nTest 4: the heartbeat sweeps a dead instance's hashes in one command")
+    await reset(r)
+    mine = await connected(2)
+    dead = [store.new_client_id() for _ in range(400)]
+    pipe = r.pipeline(transaction=False)
+    for ws_id in dead:
+        pipe.hset(store.client_key(ws_id), mapping={"o": "dead", "t:chess": ""})
+        pipe.zadd(store.WAITING_KEY, {ws_id: 1})
+        pipe.zadd(store.topic_index_key(0, "chess"), {ws_id: 1})
+    pipe.sadd(store.clients_key("dead"), *dead)
+    pipe.sadd(f"{store.PREFIX}:instances", "dead")
+    await pipe.execute()
+    await store.set_partners(mine[0], dead[0])
+    heartbeats = store.command_counts()["heartbeat"]
+    heard.clear()
+    await store.renew_lease(mine)
+    check("one heartbeat command for 400 swept clients",
+          store.command_counts()["heartbeat"] == heartbeats + 1)
+    check("only the live clients' hashes are left",
+          sorted(await client_keys(r)) == sorted(store.client_key(x) for x in mine))
+    check("pool and topic index are empty",
+          await r.exists(store.WAITING_KEY, store.topic_index_key(0, "chess")) == 0)
+    check("the live partner is told and unpaired",
+          (mine[0], "PARTNER_LEFT") in heard and await store.get_partner(mine[0]) is None)
+
+
+async def main():
+    r = aioredis.from_url(REDIS_URL, decode_responses=True)
+    await store.connect()
+    store.set_local_delivery(deliver)
+    try:
+        await test_one_hash(r)
+        await test_match_and_next(r)
+        await test_disconnect(r)
+        await test_sweep(r)
+        await reset(r)
+    finally:
+        await store.close()
+        await r.aclose()
+
+    print(f"\n==== {len(passed)} passed, {len(failed)} failed ====")
+    if failed:
+        print("FAILED:", ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
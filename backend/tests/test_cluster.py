@@ -0,0 +1,264 @@
+"""The Redis Cluster key layout (REDIS_CLUSTER=true).
+
+Self-contained: starts a three-node cluster of its own on dedicated ports
+(redis-server --cluster-enabled, joined with redis-cli --cluster create) and
+drives store in-process against it with MATCH_SHARDS=6 slot groups. The other
+suites use a single node, which serves any key from any script, so none of
+them would notice a script touching two slots.
+
+    python tests/test_cluster.py
+
+Env overrides: CLUSTER_PORT (7100: nodes on 7100-7102).
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+CLUSTER_PORT = int(os.environ.get("CLUSTER_PORT", "7100"))
+PORTS = [CLUSTER_PORT + i for i in range(3)]
+os.environ["REDIS_URL"] = f"redis://127.0.0.1:{CLUSTER_PORT}"
+os.environ["REDIS_CLUSTER"] = "true"
+os.environ["MATCH_SHARDS"] = "6"
+os.environ["FLY_MACHINE_ID"] = "cluster-test"
+
+import redis.asyncio as aioredis  # noqa: E402
+from redis.crc import key_slot  # noqa: E402
+
+import store  # noqa: E402  (reads the environment above at import)
+
+passed = []
+failed = []
+
+
+def check(name, ok, detail=""):
+    (passed if ok else failed).append(name)
+    print(f"  [{'PASS' if ok else 'FAIL'}] {name}{(' -> ' + detail) if detail else ''}")
+
+
+# --- cluster helpers ------------------------------------------------------
+
+def cluster_up():
+    for port in PORTS:
+        subprocess.run(
+            ["redis-server", "--port", str(port), "--daemonize", "yes", "--save", "",
+             "--appendonly", "no", "--cluster-enabled", "yes",
+             "--cluster-config-file", f"/tmp/yawnfox-cluster-{port}.conf"],
+            check=True, capture_output=True,
+        )
+    time.sleep(0.5)
+    subprocess.run(
+        ["redis-cli", "--cluster", "create", *[f"127.0.0.1:{p}" for p in PORTS],
+         "--cluster-replicas", "0", "--cluster-yes"],
+        check=True, capture_output=True,
+    )
+    end = time.monotonic() + 20
+    while time.monotonic() < end:
+        states = [subprocess.run(["redis-cli", "-p", str(p), "cluster", "info"],
+                                 capture_output=True, text=True).stdout for p in PORTS]
+        if all("cluster_state:ok" in s for s in states):
+            return
+        time.sleep(0.2)
+    raise RuntimeError("cluster never reached cluster_state:ok")
+
+
+def cluster_down():
+    for port in PORTS:
+        subprocess.run(["redis-cli", "-p", str(port), "shutdown", "nosave"], capture_output=True)
+        try:
+            os.remove(f"/tmp/yawnfox-cluster-{port}.conf")
+        except OSError:
+            pass
+
+
+async def reset(nodes):
+    for n in nodes:
+        await n.flushall()
+
+
+def ids_in(group, n, start=0):
+    """n client ids whose slot group is `group`."""
+    out, i = [], start
+    while len(out) < n:
+        if store.group_of(f"c{i}") == group:
+            out.append(f"c{i}")
+        i += 1
+    return out
+
+
+heard = []
+
+
+async def deliver(ws_id, text, sender=None, news=None, stamp=None):
+    heard.append((ws_id, json.loads(text)["name"], sender))
+    return True
+
+
+# --- tests ----------------------------------------------------------------
+
+async def test_layout(r, nodes):
+    print("\nTest 1: a client's keys share a slot, and the groups spread over the nodes")
+    await reset(nodes)
+    ids = [f"c{i}" for i in range(60)]
+    await store._register(ids)
+    check("60 clients fall in all 6 groups", {store.group_of(x) for x in ids} == set(range(6)))
+    me = store.instance_id()
+    same = all(len({key_slot(k.encode()) for k in (
+        store.conn_key(x), store.partner_key(x), store.topics_key(x),
+        store.waiting_key(store.group_of(x)), store.lease_key(me, store.group_of(x)),
+        store.clients_key(me, store.group_of(x)),
+        store.topic_index_key(store.shard_for(x), "chess"))}) == 1 for x in ids)
+    check("a client's keys all map to its group's slot", same)
+    sizes = [await n.dbsize() for n in nodes]
+    check("every node holds some of them", all(sizes), str(sizes))
+    connected = await asyncio.gather(*(store.is_connected(x) for x in ids))
+    check("and every client reads back as connected", all(connected))
+
+
+async def test_matching(r, nodes):
+    print("\nTest 2: pairs form within a group and across groups")
+    await reset(nodes)
+    a, b = ids_in(0, 2)
+    x, y, z = ids_in(1, 1)[0], ids_in(2, 1)[0], ids_in(3, 1)[0]
+    await store._register([a, b, x, y, z])
+    for ws_id, topics in ((a, []), (b, []), (x, ["chess"]), (y, []), (z, ["chess"])):
+        await store.enqueue_waiting(ws_id, topics)
+        await asyncio.sleep(0.002)              # distinct enqueue_ms: a fixed queue order
+    heard.clear()
+    await store.run_matcher_rounds()
+    check("two in one group are paired by its shard pass",
+          await store.get_partner(a) == b and await store.get_partner(b) == a)
+    check("one per group: the cross pass pairs the topic match",
+          await store.get_partner(x) == z and await store.get_partner(z) == x,
+          f"x->{await store.get_partner(x)}")
+    check("the one left over stays queued",
+          await r.zscore(store.waiting_key(2), y) is not None
+          and await store.get_partner(y) is None)
+    check("the pair's topic index entries are gone",
+          await r.exists(store.topic_index_key(1, "chess"), store.topic_index_key(3, "chess")) == 0)
+    found = sorted(w for w, name, _ in heard if name == "PARTNER_FOUND")
+    check("all four are told", found == sorted([a, b, x, z]), str(found))
+
+
+async def test_cross_rollback(r, nodes):
+    print("\nTest 3: a cross-group pair whose second side has gone puts the first back")
+    await reset(nodes)
+    p, q = ids_in(1, 1)[0], ids_in(2, 1)[0]
+    await store._register([p, q])
+    await store.enqueue_waiting(p, ["go"])
+    await store.enqueue_waiting(q, [])
+    (hp, _), (hq, _) = await asyncio.gather(store._group_head(1), store._group_head(2))
+    score = await r.zscore(store.waiting_key(1), p)
+    await store.remove_waiting(q)               # gone between the read and the take
+    took = await store._take(hp, q)
+    check("the first side is taken", took and await store.get_partner(p) == q)
+    check("the second is not", not await store._take(hq, p))
+    await store._untake(hp)
+    check("the first is back at its old place, topics and all",
+          await r.zscore(store.waiting_key(1), p) == score
+          and await r.zscore(store.topic_index_key(1, "go"), p) == score
+          and await r.smembers(store.topics_key(p)) == {"go"})
+    check("and unpaired", await store.get_partner(p) is None)
+
+
+async def test_unpair(r, nodes):
+    print("\nTest 4: leaving a partner in another group clears its half too")
+    await reset(nodes)
+    x, y, u, v, s, t = (ids_in(g, 1)[0] for g in (1, 2, 3, 4, 5, 0))
+    await store._register([x, y, u, v, s, t])
+    for a, b in ((x, y), (u, v), (s, t)):
+        await store.set_partners(a, b)
+    heard.clear()
+    await store.disconnect(x)
+    check("disconnect: the partner is told", (y, "PARTNER_LEFT", x) in heard, str(heard))
+    check("and both halves are gone",
+          await store.get_partner(x) is None and await store.get_partner(y) is None)
+    heard.clear()
+    partner = await store.requeue(u, [])
+    check("Next: the partner is told", partner == v and (v, "PARTNER_LEFT", u) in heard)
+    check("and both halves are gone, the client queued in its group",
+          await store.get_partner(u) is None and await store.get_partner(v) is None
+          and await r.zscore(store.waiting_key(3), u) is not None)
+    check("clear_partner: both halves",
+          await store.clear_partner(s) == t and await store.get_partner(t) is None)
+
+
+async def test_sweep(r, nodes):
+    print("\nTest 5: the heartbeat sweeps a dead instance in every group")
+    await reset(nodes)
+    live = [ids_in(g, 1, 1000)[0] for g in range(6)]
+    dead = [f"d{i}" for i in range(30)]
+    await store._register(live)
+    for ws_id in dead:
+        g = store.group_of(ws_id)
+        await r.set(store.conn_key(ws_id), "dead")
+        await r.sadd(store.clients_key("dead", g), ws_id)
+        await r.sadd(f"{store._prefix(g)}instances", "dead")
+    partner = next(d for d in dead if store.group_of(d) != store.group_of(live[0]))
+    await store.set_partners(live[0], partner)
+    heard.clear()
+    await store.renew_lease(live)
+    check("every dead client is gone",
+          not any([await r.exists(store.conn_key(d)) for d in dead]))
+    check("in every group, client sets and all",
+          not any([await r.exists(store.clients_key("dead", g)) for g in range(6)]))
+    check("a live partner in another group is told and unpaired",
+          (live[0], "PARTNER_LEFT", partner) in heard and await store.get_partner(live[0]) is None)
+    leases = [await r.ttl(store.lease_key(store.instance_id(), g)) for g in range(6)]
+    check("our lease is renewed in every group", all(0 < t <= store.LEASE_TTL for t in leases),
+          str(leases))
+    check("the live clients are untouched", all(await asyncio.gather(
+        *(store.is_connected(x) for x in live))))
+    day = time.strftime("%Y%m%d", time.gmtime())
+    check("the budget is counted once, in the first group",
+          int(await r.get(store.budget_key(day)) or 0) > 0)
+
+
+async def test_rate_limits(r, nodes):
+    print("\nTest 6: rate-limit syncs split per group")
+    await reset(nodes)
+    ips = [f"198.51.100.{i}" for i in range(30)]
+    for ip in ips:
+        await store.check_rate_limit(ip)
+    await store._sync_rate_limits(ips)
+    groups = {store.group_of(ip) for ip in ips}
+    present = [await r.exists(store.rate_key(ip)) for ip in ips]
+    check("every IP's window reached Redis", all(present), f"groups={sorted(groups)}")
+
+
+async def main():
+    cluster_down()          # clear anything left by an earlier run
+    cluster_up()
+    r = aioredis.RedisCluster.from_url(os.environ["REDIS_URL"], decode_responses=True)
+    nodes = [aioredis.from_url(f"redis://127.0.0.1:{p}", decode_responses=True) for p in PORTS]
+    if not await store.connect():
+        print("store could not connect; aborting")
+        sys.exit(1)
+    store.set_local_delivery(deliver)
+    try:
+        await test_layout(r, nodes)
+        await test_matching(r, nodes)
+        await test_cross_rollback(r, nodes)
+        await test_unpair(r, nodes)
+        await test_sweep(r, nodes)
+        await test_rate_limits(r, nodes)
+    finally:
+        await store.close()
+        await r.aclose()
+        for n in nodes:
+            await n.aclose()
+
+    print(f"\n==== {len(passed)} passed, {len(failed)} failed ====")
+    if failed:
+        print("FAILED:", ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    finally:
+        cluster_down()
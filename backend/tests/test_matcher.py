@@ -14,6 +14,8 @@ Env overrides: REDIS_URL (default redis://localhost:6390).
 """
 import os
 import sys
+import json
+import time
 import asyncio
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -22,6 +24,7 @@ os.environ.setdefault("REDIS_URL", "redis://localhost:6390")
 import redis.asyncio as aioredis
 
 import store  # noqa: E402  (must follow the REDIS_URL default: see store._inmemory_mode)
+import matching  # noqa: E402
 
 REDIS_URL = os.environ["REDIS_URL"]
 
@@ -41,13 +44,27 @@ async def reset(r):
         await r.delete(*keys[i:i + 500])
 
 
-async def seed(r, ws_id, score, topics=(), live=True):
-    """Put one member in the waiting pool at an explicit score (= queue order)."""
-    await r.zadd(store.WAITING_KEY, {ws_id: score})
+def envelope(data):
+    """The frames of a published envelope, without the stamp it opens with."""
+    frames = store._unpack_frames(data)
+    return frames[1:] if frames and frames[0][0].startswith("@") else frames
+
+
+async def seed(r, ws_id, score, topics=(), live=True, owner="test-instance"):
+    """Put one member in the waiting pool at an explicit score (= queue order).
+
+    A live member is owned by `owner`, whose lease is taken (without a TTL, so
+    a slow run cannot expire it). A ghost has no conn key at all.
+    """
+    shard = store.shard_for(ws_id, topics)
+    await r.zadd(store.waiting_key(shard), {ws_id: score})
     if topics:
         await r.sadd(store.topics_key(ws_id), *topics)
+        for t in topics:
+            await r.zadd(store.topic_index_key(shard, t), {ws_id: score})
     if live:
-        await r.set(store.conn_key(ws_id), "test-instance")
+        await r.set(store.conn_key(ws_id), owner)
+        await r.set(store.lease_key(owner), 1)
 
 
 async def test_topic_preference(r):
@@ -115,23 +132,655 @@ async def test_cost_is_not_proportional_to_pool(r):
     def calls(cmd):
         return info.get(f"cmdstat_{cmd}", {}).get("calls", 0)
 
-    # EVAL is client-issued (and the unit Upstash bills); EXISTS/ZREM/SMEMBERS
+    # EVAL is client-issued (and the unit Upstash bills); GET/ZREM/SMEMBERS
     # below it run inside the script. The old matcher issued one EXISTS per
     # candidate as its own round-trip, so this pool cost 5000+ of them.
     evals = calls("eval") + calls("evalsha")
     check("clearing 5000 ghosts + 1 pairing costs < 100 client round-trips",
-          evals < 100, f"eval={evals}, internal exists={calls('exists')}")
+          evals < 100, f"eval={evals}, internal get={calls('get')}")
     check("the pair was still formed", await store.get_partner("a") == "b")
 
 
+async def test_topic_index_at_depth(r):
+    print("\nTest 5: topic peers are found anywhere in a 5,000-waiter pool")
+    await reset(r)
+    # 250 topics, 20 clients each, interleaved: every client's nearest topic
+    # peer is queued 250 places behind it, far outside the 64-entry window. A
+    # window scan finds none of them and falls back to queue order every time.
+    pipe = r.pipeline(transaction=False)
+    for i in range(5000):
+        ws_id, topic = f"w{i:04d}", f"t{i % 250}"
+        pipe.zadd(store.WAITING_KEY, {ws_id: i})
+        pipe.set(store.conn_key(ws_id), "test-instance")
+        pipe.sadd(store.topics_key(ws_id), topic)
+        pipe.zadd(store.topic_index_key(0, topic), {ws_id: i})
+    pipe.set(store.lease_key("test-instance"), 1)
+    await pipe.execute()
+
+    await r.config_resetstat()
+    await store.run_matcher_rounds(max_rounds=1000)
+    info = await r.info("commandstats")
+
+    def stat(cmd, field="calls"):
+        return info.get(f"cmdstat_{cmd}", {}).get(field, 0)
+
+    partners = await r.mget([store.partner_key(f"w{i:04d}") for i in range(5000)])
+    hits = sum(1 for i, p in enumerate(partners) if p and int(p[1:]) % 250 == i % 250)
+    check("every client is paired", all(partners), f"unpaired={partners.count(None)}")
+    check("topic hit rate is ~100%, not ~0%", hits >= 0.99 * 5000, f"hits={hits}/5000")
+    # Script-internal calls show up in commandstats too. The window scan did a
+    # SMEMBERS per live window member; the index needs one per pair member.
+    smembers = stat("smembers")
+    check("about one SMEMBERS per paired client, not one per window member",
+          smembers <= 3 * 5000,
+          f"smembers={smembers}, eval usec/call={stat('evalsha', 'usec_per_call')}")
+
+
+async def test_batch_cost(r):
+    print("\nTest 6: a batch of pairs costs one EVAL, not four commands a pair")
+    await reset(r)
+    for i in range(60):
+        await seed(r, f"c{i:02d}", i, ["chess"] if i % 3 == 0 else (),
+                   owner=f"inst-{i % 2}")
+
+    await r.config_resetstat()
+    await store.run_matcher_rounds(max_rounds=10)
+    await store.flush()
+    info = await r.info("commandstats")
+
+    def calls(cmd):
+        return info.get(f"cmdstat_{cmd}", {}).get("calls", 0)
+
+    paired = sum([bool(await store.get_partner(f"c{i:02d}")) for i in range(60)])
+    check("all 60 clients are paired", paired == 60, f"paired={paired}")
+    check("the topic peers still find each other first",
+          await store.get_partner("c00") == "c03", f"c00 -> {await store.get_partner('c00')}")
+    # 30 pairs used to be 30 EVALs + 30 MULTIs + 60 publishes, one RTT each.
+    # Now: one EVAL for the window (plus a final empty read), partner keys
+    # written inside it, and one PUBLISH per instance that owns any of them.
+    evals = calls("eval") + calls("evalsha")
+    check("30 pairs cost at most 2 EVALs", evals <= 2, f"eval={evals}")
+    check("no separate set_partners transaction", calls("multi") == 0,
+          f"multi={calls('multi')}")
+    check("one PUBLISH per owning instance, not per client", calls("publish") == 2,
+          f"publish={calls('publish')}")
+
+
+async def test_sharded_pool(r):
+    print("\nTest 7: a sharded pool still pairs everyone, topics first")
+    await reset(r)
+    store.MATCH_SHARDS = 4
+    try:
+        # Two topic-less clients that hash to different shards, neither of them
+        # the chess shard: only the cross-shard pass can pair them.
+        taken = {store.shard_for("a", ["chess"])}
+        loners = []
+        for i in range(100):
+            ws_id = f"loner-{i}"
+            if store.shard_for(ws_id) not in taken:
+                taken.add(store.shard_for(ws_id))
+                loners.append(ws_id)
+            if len(loners) == 2:
+                break
+        await seed(r, "a", 1, ["chess"])
+        await seed(r, loners[0], 2)
+        await seed(r, "c", 3, ["chess"])
+        await seed(r, loners[1], 4)
+        await seed(r, "ghost", 0, live=False)
+
+        await store.run_matcher_rounds(max_rounds=10)
+
+        check("a shared topic lands both clients in one shard",
+              store.shard_for("a", ["chess"]) == store.shard_for("c", ["chess"]))
+        check("the topic match is still preferred", await store.get_partner("a") == "c",
+              f"a -> {await store.get_partner('a')}")
+        check("clients alone in their shards are paired across shards",
+              await store.get_partner(loners[0]) == loners[1],
+              f"{loners[0]} -> {await store.get_partner(loners[0])}")
+        check("nobody is left waiting", sum(await store.waiting_counts()) == 0,
+              str(await store.waiting_counts()))
+
+        await seed(r, "d", 5, ["darts"])
+        await store.remove_waiting("d")
+        check("remove_waiting finds a client whatever its shard",
+              sum(await store.waiting_counts()) == 0)
+    finally:
+        store.MATCH_SHARDS = 1
+
+
+async def test_relay_per_instance(r):
+    print("\nTest 8: relayed frames go to the owner's channel, coalesced")
+    await reset(r)
+    for i in range(6):
+        await r.set(store.conn_key(f"r{i}"), f"inst-{i % 2}")
+    sub = r.pubsub(ignore_subscribe_messages=True)
+    await sub.subscribe(store.inst_chan("inst-0"), store.inst_chan("inst-1"))
+    for i in range(6):                     # warm the owner cache
+        await store.route(f"r{i}", {"name": "WARM"})
+    await store.route("gone", {"name": "NOBODY"})
+    await store.flush()
+
+    await r.config_resetstat()
+    # A burst inside one loop tick, as an ICE trickle arrives.
+    await asyncio.gather(*[store.route(f"r{n % 6}", {"name": "ICE", "data": n})
+                           for n in range(30)])
+    await store.flush()
+    info = await r.info("commandstats")
+
+    def calls(cmd):
+        return info.get(f"cmdstat_{cmd}", {}).get("calls", 0)
+
+    got, stamped = {}, True
+    end = time.monotonic() + 1.0
+    while time.monotonic() < end:   # a None may just be a subscribe confirmation
+        if (msg := await sub.get_message(timeout=0.1)) is None:
+            continue
+        stamped &= store._unpack_frames(msg["data"])[0][0].startswith("@")
+        for ws_id, text in envelope(msg["data"]):
+            got.setdefault(msg["channel"], []).append((ws_id, json.loads(text)))
+    await sub.aclose()
+    ice = {ch: [(w, m["data"]) for w, m in frames if m["name"] == "ICE"]
+           for ch, frames in got.items()}
+    check("each instance hears only its own clients",
+          len(got) == 2 and all(int(w[1:]) % 2 == int(ch[-1]) for ch, frames in got.items() for w, _ in frames),
+          str({ch: len(f) for ch, f in got.items()}))
+    check("nothing is published for a client that is not connected",
+          not any(w == "gone" for frames in got.values() for w, _ in frames))
+    check("30 frames to 2 instances cost 2 PUBLISHes and no owner lookups",
+          calls("publish") == 2 and calls("get") == 0,
+          f"publish={calls('publish')}, get={calls('get')}")
+    check("frames arrive in the order they were routed",
+          [n for _, n in ice.get(store.inst_chan("inst-0"), [])] == list(range(0, 30, 2)))
+    check("every envelope opens with its timing stamp", stamped and bool(got))
+
+
+async def test_disconnect_batch(r):
+    print("\nTest 9: disconnects in one window share one script")
+    await reset(r)
+    await seed(r, "a", 1, ["chess"])                       # queued
+    for x, y in (("b", "c"), ("e", "f")):                  # two live pairs
+        await r.set(store.conn_key(x), "inst-0")
+        await r.set(store.conn_key(y), "inst-1")
+        await r.set(store.partner_key(x), y)
+        await r.set(store.partner_key(y), x)
+    await r.set(store.conn_key("d"), "inst-0")              # only connected
+    await r.sadd(store.clients_key("inst-0"), "b", "d", "e")
+    await r.set(store.lease_key("inst-1"), 1)
+    sub = r.pubsub(ignore_subscribe_messages=True)
+    await sub.subscribe(store.inst_chan("inst-1"))
+
+    await r.config_resetstat()
+    await asyncio.gather(*[store.disconnect(x) for x in ("a", "b", "d", "e")])
+    await store.flush()
+    info = await r.info("commandstats")
+
+    def calls(cmd):
+        return info.get(f"cmdstat_{cmd}", {}).get("calls", 0)
+
+    left = []
+    end = time.monotonic() + 1.0
+    while time.monotonic() < end:
+        if (msg := await sub.get_message(timeout=0.1)) is not None:
+            left += [(h, json.loads(t)["name"]) for h, t in envelope(msg["data"])]
+    await sub.aclose()
+    check("four disconnects cost one EVAL", calls("eval") + calls("evalsha") == 1,
+          f"eval={calls('eval')}")
+    check("both partners told in one PUBLISH to their instance", calls("publish") == 1
+          and sorted(left) == [("c b -", "PARTNER_LEFT"), ("f e -", "PARTNER_LEFT")], str(left))
+    gone = [store.conn_key(x) for x in "abde"] + [store.partner_key(x) for x in "bcef"] + [
+        store.topics_key("a"), store.topic_index_key(0, "chess"), store.WAITING_KEY,
+        store.clients_key("inst-0")]
+    check("presence, client set, partners, pool and topic index are all cleared",
+          await r.exists(*gone) == 0, str([k for k in gone if await r.exists(k)]))
+    check("the partners themselves stay connected", await r.exists(store.conn_key("c")) == 1)
+
+
+async def test_requeue(r):
+    print("\nTest 10: Next is one script: unpair, requeue, wake")
+    await reset(r)
+    await seed(r, "a", 1, ["chess"])          # queued before it was paired
+    await r.set(store.partner_key("a"), "b")
+    await r.set(store.partner_key("b"), "a")
+    await r.set(store.conn_key("b"), "inst-1")
+    sub = r.pubsub()
+    await sub.subscribe(store.inst_chan("inst-1"), store.WAKEUP_CHANNEL)
+    for _ in range(2):      # the wakeup is published in the script: be listening first
+        await sub.get_message(timeout=1.0)
+
+    await r.config_resetstat()
+    old = await store.requeue("a", ["go"])
+    await store.flush()
+    info = await r.info("commandstats")
+
+    def calls(cmd):
+        return info.get(f"cmdstat_{cmd}", {}).get("calls", 0)
+
+    heard = []
+    end = time.monotonic() + 1.0
+    while time.monotonic() < end:
+        if (msg := await sub.get_message(timeout=0.1)) is None or msg["type"] != "message":
+            continue
+        if msg["channel"] == store.WAKEUP_CHANNEL:
+            heard.append("wakeup")
+        else:
+            heard += [(h, json.loads(t)["name"]) for h, t in envelope(msg["data"])]
+    await sub.aclose()
+    # Was remove_waiting + clear_partner + enqueue_waiting EVALs and a wakeup
+    # PUBLISH, one round-trip each; the only other command is PARTNER_LEFT.
+    check("requeue costs one EVAL and no transaction",
+          calls("eval") + calls("evalsha") == 1 and calls("multi") == 0,
+          f"eval={calls('eval')}, multi={calls('multi')}")
+    check("reports the old partner and tells it", old == "b"
+          and ("b a -", "PARTNER_LEFT") in heard, f"old={old}, heard={heard}")
+    check("the other instances' matchers are woken", "wakeup" in heard)
+    check("both sides are unpaired",
+          await r.exists(store.partner_key("a"), store.partner_key("b")) == 0)
+    check("back in the pool under the new topics only",
+          await r.zscore(store.waiting_key(store.shard_for("a", ["go"])), "a") is not None
+          and await r.smembers(store.topics_key("a")) == {"go"}
+          and await r.exists(store.topic_index_key(store.shard_for("a", ["chess"]), "chess")) == 0
+          and await r.zscore(store.topic_index_key(store.shard_for("a", ["go"]), "go"), "a")
+          is not None)
+    check("requeue without a partner reports none", await store.requeue("a", []) is None
+          and await r.exists(store.topics_key("a")) == 0)
+
+
+async def test_script_registry(r):
+    print("\nTest 11: scripts go by SHA and survive a flushed script cache")
+    await reset(r)
+    await seed(r, "a", 1)
+    await seed(r, "b", 2)
+    before = dict(store.script_stats["match"])
+    await r.config_resetstat()
+    await store.run_matcher_rounds()
+    info = await r.info("commandstats")
+
+    def calls(cmd):
+        return info.get(f"cmdstat_{cmd}", {}).get("calls", 0)
+
+    sent = store.script_stats["match"]["bytes"] - before["bytes"]
+    saved = store.script_stats["match"]["saved"] - before["saved"]
+    check("the matcher sends EVALSHA, never the script text",
+          calls("evalsha") >= 1 and calls("eval") == 0 and await store.get_partner("a") == "b",
+          f"evalsha={calls('evalsha')}, eval={calls('eval')}")
+    check("a match round is under a third of its EVAL size", sent * 3 < sent + saved,
+          f"sent={sent}B, saved={saved}B")
+
+    await r.script_flush()      # what a restart or failover does to the cache
+    reloads = store.script_stats["reloads"]
+    await seed(r, "c", 3, ["go"])
+    await store.remove_waiting("c")
+    check("NOSCRIPT is recovered transparently",
+          store.script_stats["reloads"] == reloads + 1
+          and await r.zcard(store.WAITING_KEY) == 0)
+    await store.remove_waiting("c")
+    check("and costs one reload, not one per call", store.script_stats["reloads"] == reloads + 1)
+    await store._load_scripts()  # as the resubscribe after a real failover would
+
+
+async def test_instance_lease(r):
+    print("\nTest 12: presence is an instance lease; dead instances are swept")
+    await reset(r)
+    mine = [f"l{i:04d}" for i in range(2000)]
+    for i in range(0, len(mine), 500):
+        await store._register(mine[i:i + 500])
+    await r.config_resetstat()
+    sent = store.script_stats["lease"]["bytes"]
+    await store.renew_lease(mine)
+    info = await r.info("commandstats")
+
+    def calls(cmd):
+        return info.get(f"cmdstat_{cmd}", {}).get("calls", 0)
+
+    sent = store.script_stats["lease"]["bytes"] - sent
+    check("a heartbeat for 2,000 clients is one small command",
+          calls("eval") + calls("evalsha") == 1 and sent < 200,
+          f"evalsha={calls('evalsha')}, {sent} bytes")
+    check("the lease carries the TTL, the clients carry none",
+          0 < await r.ttl(store.lease_key(store.instance_id())) <= store.LEASE_TTL
+          and await r.ttl(store.conn_key(mine[0])) == -1
+          and await store.is_connected(mine[0]))
+
+    # An instance that died: a queued client, and one paired with a live client
+    # elsewhere. Its lease is simply absent, as after LEASE_TTL.
+    await seed(r, "x", 1, ["chess"], owner="dead")
+    await r.delete(store.lease_key("dead"))
+    await r.set(store.conn_key("y"), "dead")
+    await seed(r, "z", 2, owner="inst-1")
+    await r.zrem(store.WAITING_KEY, "z")
+    await r.set(store.partner_key("y"), "z")
+    await r.set(store.partner_key("z"), "y")
+    await r.sadd(store.clients_key("dead"), "x", "y")
+    await r.sadd(f"{store.PREFIX}:instances", "dead")
+    check("its clients are ghosts at once", not await store.is_connected("x")
+          and not await store.is_connected("y") and await store.is_connected("z"))
+    await seed(r, "w", 3, ["chess"])
+    await store.run_matcher_rounds()
+    check("the matcher does not pair a live client with one of them",
+          await store.get_partner("w") is None and await r.zscore(store.WAITING_KEY, "w"))
+
+    sub = r.pubsub()
+    await sub.subscribe(store.inst_chan("inst-1"))
+    await sub.get_message(timeout=1.0)
+    await store.renew_lease(mine)
+    await store.flush()
+    heard = []
+    end = time.monotonic() + 1.0
+    while time.monotonic() < end:
+        if (msg := await sub.get_message(timeout=0.1)) and msg["type"] == "message":
+            heard += [(h, json.loads(t)["name"]) for h, t in envelope(msg["data"])]
+    await sub.aclose()
+    left = [k for k in (store.conn_key("x"), store.conn_key("y"), store.topics_key("x"),
+                        store.partner_key("y"), store.partner_key("z"), store.clients_key("dead"))
+            if await r.exists(k)]
+    check("the next heartbeat sweeps every key they left", not left, str(left))
+    check("and tells their live partners", heard == [("z y -", "PARTNER_LEFT")], str(heard))
+    check("the dead instance leaves the registry",
+          not await r.sismember(f"{store.PREFIX}:instances", "dead"))
+
+    # A lapsed lease of our own (an outage longer than LEASE_TTL) that another
+    # instance swept meanwhile: the heartbeat puts our clients back.
+    await r.delete(store.lease_key(store.instance_id()), store.clients_key(store.instance_id()),
+                   *[store.conn_key(x) for x in mine])
+    await store.renew_lease(mine)
+    check("clients swept during a lapse are registered again",
+          await r.scard(store.clients_key(store.instance_id())) == len(mine)
+          and await store.is_connected(mine[-1]))
+
+
+async def test_connection_limiter(r):
+    print("\nTest 13: the connection limiter decides locally, syncs in batches")
+    await reset(r)
+    store._rate_local.clear()
+    await r.config_resetstat()
+    first = [await store.check_rate_limit(f"198.51.100.{i}") for i in range(200)]
+    info = await r.info("commandstats")
+    evals = sum(info.get(f"cmdstat_{c}", {}).get("calls", 0) for c in ("eval", "evalsha"))
+    check("200 first-time IPs are admitted with no Redis round-trip",
+          all(first) and evals == 0, f"eval={evals}")
+    await asyncio.sleep(store.RATE_LIMIT_SYNC_MS / 1000 + 0.3)
+    info = await r.info("commandstats")
+    check("and reach Redis in one EVAL",
+          info.get("cmdstat_evalsha", {}).get("calls") == 1
+          and await r.exists(store.rate_key("198.51.100.7")), str(info))
+
+    engine = store.RATE_LIMIT_ENGINE
+    try:
+        for n, store.RATE_LIMIT_ENGINE in enumerate(("gcra", "buckets", "zset")):
+            # Another instance already admitted 3 from this IP; we have not
+            # synced yet. Its sync is the same script ours is.
+            ip = f"203.0.113.{n}"
+            await store._eval(store._RATE_SYNC_LUA[store.RATE_LIMIT_ENGINE], 1,
+                              store.rate_key(ip), int(time.time() * 1000),
+                              store.RATE_LIMIT_WINDOW * 1000, store.RATE_LIMIT_MAX, "inst-b", 3)
+            got = [await store.check_rate_limit(ip) for _ in range(4)]
+            check(f"{store.RATE_LIMIT_ENGINE}: a repeat visitor renews its lease and "
+                  "sees the fleet's admissions", got == [True, True, False, False], str(got))
+    finally:
+        store.RATE_LIMIT_ENGINE = engine
+
+    # Two syncs naming the same IP in the same millisecond: the single-IP one
+    # of a stale lease, and the batch.
+    now, key = int(time.time() * 1000), store.rate_key("203.0.113.9")
+    for call in (1, 2):
+        await store._eval(store._RATE_SYNC_LUA["zset"], 1, key, now,
+                          store.RATE_LIMIT_WINDOW * 1000, store.RATE_LIMIT_MAX,
+                          f"{store.instance_id()}:{call}", 1)
+    check("zset: two syncs in one millisecond both count", await r.zcard(key) == 2,
+          str(await r.zcard(key)))
+
+    saved = store.RATE_LIMIT_LOCAL_IPS
+    try:
+        store._rate_local.clear()
+        store.RATE_LIMIT_LOCAL_IPS = 3
+        await asyncio.sleep(store.RATE_LIMIT_SYNC_MS / 1000 + 0.3)    # nothing pending
+        ips = [f"198.51.100.{200 + i}" for i in range(10)]
+        for ip in ips:
+            await store.check_rate_limit(ip)
+            await asyncio.sleep(0)      # each from its own connection's task
+        check("memory holds RATE_LIMIT_LOCAL_IPS windows", len(store._rate_local) == 3)
+        await asyncio.sleep(store.RATE_LIMIT_SYNC_MS / 1000 + 0.3)
+        present = [await r.exists(store.rate_key(ip)) for ip in ips]
+        check("but the admissions of the ones evicted unsynced still reach Redis",
+              all(present) and not store._rate_evicted, str(present))
+    finally:
+        store.RATE_LIMIT_LOCAL_IPS = saved
+
+    store._inmemory_mode = True
+    try:
+        store._rate_local.clear()
+        got = [await store.check_rate_limit("192.0.2.1") for _ in range(7)]
+        check("in-memory mode limits too (it used to fail open)",
+              got.count(True) == store.RATE_LIMIT_MAX, str(got))
+    finally:
+        store._inmemory_mode = False
+
+
+async def test_metrics(r):
+    print("\nTest 14: /metrics sees scripts, pairs and both relay paths")
+    await reset(r)
+    await seed(r, "a", 1)
+    await seed(r, "b", 2)
+    match = store._SCRIPT_SECONDS[store._MATCH_LUA]
+    calls, pairs = match.count, store.pairs_total.value
+    await store.run_matcher_rounds(max_rounds=1)
+    check("a match script call is timed", match.count == calls + 1 and match.sum > 0,
+          f"count={match.count}")
+    check("the pair is counted", store.pairs_total.value == pairs + 1)
+
+    # Frames for this very instance, published and heard back by its own
+    # listener: the remote path, end to end, without a second process.
+    heard = []
+
+    async def deliver(ws_id, text, sender=None, news=None, stamp=None):
+        heard.append(ws_id)
+        if stamp is not None:
+            store.relay_written(stamp)      # as main's writer does once it is written
+        return ws_id == "here"
+
+    store.set_local_delivery(deliver)
+    listener = asyncio.create_task(store.pubsub_listener())
+    local, remote = store._RELAY_SECONDS["local"], store._RELAY_SECONDS["remote"]
+    lag = store._LISTENER_LAG
+    before = (local.count, remote.count, lag.count)
+    try:
+        end = time.monotonic() + 2.0
+        while store._pubsub is None and time.monotonic() < end:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)        # ...and its SUBSCRIBE has been answered
+        await store.route("here", '{"name":"SDP_OFFER"}', sender="peer")
+        for n in range(3):
+            store._publish_later(store.instance_id(), "there peer", f'{{"n":{n}}}')
+        await store.flush()
+        end = time.monotonic() + 2.0
+        while heard.count("there") < 3 and time.monotonic() < end:
+            await asyncio.sleep(0.01)
+    finally:
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+        store.set_local_delivery(None)
+    check("a local relay is timed", local.count == before[0] + 1)
+    check("three remote frames, one envelope: three relays, one lag sample",
+          remote.count == before[1] + 3 and lag.count == before[2] + 1,
+          f"remote={remote.count - before[1]}, lag={lag.count - before[2]}")
+    check("the stamp is never delivered as a frame", not any(w.startswith("@") for w in heard))
+
+    text = store.metrics.render()
+    check("the exposition is well formed",
+          '# TYPE yawnfox_redis_script_seconds histogram' in text
+          and 'yawnfox_redis_script_seconds_bucket{script="match",le="+Inf"}' in text
+          and f'yawnfox_relay_seconds_count{{path="remote"}} {remote.count}' in text
+          and text.endswith("\n"))
+
+
+async def test_command_ledger(r):
+    print("\nTest 15: every command is on the ledger; the budget governor")
+    await reset(r)
+    store._lease_held = False
+    await r.set(store.conn_key("far"), "inst-1")
+    before = sum(store.command_counts().values())
+    await r.config_resetstat()
+    await store.register_connection("a")
+    await store.register_connection("b")
+    await store.enqueue_waiting("a", ["chess"])
+    await store.requeue("b", ["chess"])
+    await store.run_matcher_rounds()
+    await store.route("far", {"name": "ICE"}, sender="a")
+    await store.flush()
+    await store.disconnect("a")
+    await store.renew_lease(["b"])
+    info = await r.info("commandstats")
+    # CLIENT is redis-py's own handshake on a new pooled connection (see _bill).
+    sent = sum(v["calls"] for k, v in info.items() if k.startswith("cmdstat_")
+               and not k.startswith(("cmdstat_config", "cmdstat_info", "cmdstat_client")))
+    ledger = store.command_counts()
+    check("the ledger counts what Redis received", sum(ledger.values()) - before == sent,
+          f"ledger={sum(ledger.values()) - before}, redis={sent}")
+    check("by operation", all(ledger[op] > 0 for op in
+                              ("register", "queue", "match", "owner_lookup", "relay_publish",
+                               "disconnect", "heartbeat")))
+
+    day = time.strftime("%Y%m%d", time.gmtime())
+    fleet = int(await r.get(store.budget_key(day)))
+    check("the heartbeat reports them to the day's fleet counter",
+          fleet > 0 and store.budget_used() - store._unreported == fleet
+          and 0 < await r.ttl(store.budget_key(day)) <= 172800, f"fleet={fleet}")
+    await r.incrby(store.budget_key(day), 1000)     # another instance's share
+    await store.renew_lease(["b"])
+    check("and learn the rest of the fleet's", store.budget_used() >= fleet + 1000)
+
+    saved = store.REDIS_DAILY_BUDGET
+    try:
+        store.REDIS_DAILY_BUDGET = 0
+        check("no budget, no governor", store.budget_stretch() == 1.0 and not store.over_budget())
+        store.REDIS_DAILY_BUDGET = int(store.budget_used() / 0.9)
+        stretch = store.budget_stretch()
+        check("past the soft limit, optional intervals stretch",
+              1.0 < stretch < store.BUDGET_MAX_STRETCH and not store.over_budget(), f"{stretch:.2f}")
+        store.REDIS_DAILY_BUDGET = store.budget_used()
+        store._rate_local.clear()
+        store._rate_dirty.clear()
+        await r.config_resetstat()
+        allowed = [await store.check_rate_limit("192.0.2.77") for _ in range(store.RATE_LIMIT_MAX + 1)]
+        await asyncio.sleep(store.RATE_LIMIT_SYNC_MS / 1000 + 0.3)
+        info = await r.info("commandstats")
+        check("at the budget: rate-limit syncs are shed, the limit still holds locally",
+              store.over_budget() and store.budget_stretch() == store.BUDGET_MAX_STRETCH
+              and not store._rate_dirty and "cmdstat_evalsha" not in info
+              and allowed == [True] * store.RATE_LIMIT_MAX + [False], str(allowed))
+        await store.route("b", {"name": "STILL"})
+        check("matching and relay are never governed", await store.run_matcher_rounds() is False)
+    finally:
+        store.REDIS_DAILY_BUDGET = saved
+        store._rate_local.clear()
+
+
+async def test_loop_monitor(r):
+    print("\nTest 16: a blocked event loop is measured and its culprit logged")
+    import logging
+    import loopmon
+
+    logs = []
+    handler = logging.Handler()
+    handler.emit = lambda record: logs.append(record.getMessage())
+    logging.getLogger("yawnfox.loop").addHandler(handler)
+    lag, stalls = loopmon.LOOP_LAG, loopmon.LOOP_STALLS.value
+
+    def slow_samples():     # in buckets above 100 ms
+        return sum(n for b, n in zip(lag.bounds + (float("inf"),), lag.counts) if b > 0.1)
+
+    slow = slow_samples()
+    sampler = asyncio.create_task(loopmon.sample_lag())
+    try:
+        await asyncio.sleep(0.3)
+
+        def block_the_loop():
+            time.sleep(loopmon.LOOP_SLOW_MS / 1000 * 2)
+
+        block_the_loop()
+        await asyncio.sleep(0.3)
+    finally:
+        sampler.cancel()
+        await asyncio.gather(sampler, return_exceptions=True)
+        logging.getLogger("yawnfox.loop").removeHandler(handler)
+    await asyncio.to_thread(loopmon._watchdog.join, 1.0)
+    late = slow_samples() - slow
+    check("the sampler records the stall as lag", late == 1, f"{late} slow samples")
+    check("the watchdog logs it once, with the blocking call's stack",
+          loopmon.LOOP_STALLS.value == stalls + 1 and len(logs) == 1
+          and "block_the_loop" in logs[0], f"{len(logs)} logs")
+    check("and stops with the sampler", not loopmon._watchdog.is_alive())
+
+
+async def test_autopipeline(r):
+    print("\nTest 17: commands issued together go out as one pipeline")
+    await reset(r)
+    if not store.REDIS_AUTOPIPELINE:
+        check("REDIS_AUTOPIPELINE is off: nothing to test", True)
+        return
+    flushes = store._FLUSH_COMMANDS
+    count, total = flushes.count, flushes.sum
+    await r.set(f"{store.PREFIX}:not-a-number", "x")
+    await r.set(store.conn_key("here"), store.instance_id())
+    await r.set(store.lease_key(store.instance_id()), "1")
+    calls = [store._redis.set(f"{store.PREFIX}:k{i}", i) for i in range(50)]
+    calls += [store._redis.get(f"{store.PREFIX}:k{i}") for i in range(50)]
+    calls += [store.is_connected(ws_id) for ws_id in ("here", "gone")]
+    replies = await asyncio.gather(*calls)
+    # The 100 plain commands are queued as they are called; the two scripted
+    # checks once gather() has started them, together, an iteration later.
+    check("one flush per loop iteration, however many callers",
+          flushes.count == count + 2 and flushes.sum == total + 102,
+          f"{flushes.count - count} flushes, {flushes.sum - total:.0f} commands")
+    check("each caller gets its own reply, parsed as redis-py would",
+          replies[:50] == [True] * 50 and replies[50:100] == [str(i) for i in range(50)]
+          and replies[100:] == [True, False], str(replies[100:]))
+
+    lost = asyncio.ensure_future(store._redis.get(f"{store.PREFIX}:k1"))
+    kept = store._redis.get(f"{store.PREFIX}:k2")
+    lost.cancel()
+    check("a caller that gives up does not take the flush with it",
+          await kept == "2" and lost.cancelled())
+
+    replies = await asyncio.gather(store._redis.get(f"{store.PREFIX}:k3"),
+                                   store._redis.incr(f"{store.PREFIX}:not-a-number"),
+                                   return_exceptions=True)
+    check("an error reaches only the command that caused it",
+          replies[0] == "3" and isinstance(replies[1], store.RedisError), str(replies))
+    # Some Redis stand-ins (fakeredis) close a connection after an error reply.
+    await store._client.connection_pool.disconnect()
+
+
+def mem_reset():
+    for d in (store._mem_waiting, store._mem_topics, store._mem_topic_index,
+              store._mem_partners, store._mem_since, store._match_due):
+        d.clear()
+    store._mem_connections.clear()
+
+
+async def mem_seed(ws_id, topics=(), live=True):
+    """In-memory counterpart of seed(): queue order is call order."""
+    if live:
+        await store.register_connection(ws_id)
+    await store.enqueue_waiting(ws_id, topics)
+
+
+def workload(n, seed_value=7):
+    """A mixed pool: 0-3 topics from 30, and one client in ten a ghost."""
+    import random
+    rng = random.Random(seed_value)
+    return [(f"m{i:04d}", rng.sample([f"t{k}" for k in range(30)], rng.randrange(4)),
+             rng.random() > 0.1) for i in range(n)]
+
+
 async def test_inmemory_parity(r):
-    print("\nTest 5: in-memory mode makes the same choice")
+    print("\nTest 18: in-memory mode makes the same choice")
     await reset(r)
     store._inmemory_mode = True
     try:
-        store._mem_waiting.update({"a": 1, "b": 2, "c": 3})
-        store._mem_topics.update({"a": {"chess"}, "b": {"cooking"}, "c": {"chess"}})
-        store._mem_connections.update({"a", "b", "c"})
+        await mem_seed("a", ["chess"])
+        await mem_seed("b", ["cooking"])
+        await mem_seed("c", ["chess"])
 
         await store.run_matcher_rounds(max_rounds=1)
 
@@ -139,11 +788,172 @@ async def test_inmemory_parity(r):
               store._mem_partners.get("a") == "c", f"a -> {store._mem_partners.get('a')}")
         check("in-memory matcher leaves the non-match queued",
               list(store._mem_waiting) == ["b"])
+
+        # The same 600-client pool through both matchers must give the same pairs.
+        mem_reset()
+        clients = workload(600)
+        for ws_id, topics, live in clients:
+            await mem_seed(ws_id, topics, live)
+        await store.run_matcher_rounds(max_rounds=1000)
+        mem_pairs = dict(store._mem_partners)
+    finally:
+        store._inmemory_mode = False
+        mem_reset()
+
+    await reset(r)
+    for i, (ws_id, topics, live) in enumerate(clients):
+        await seed(r, ws_id, i, topics, live)
+    await store.run_matcher_rounds(max_rounds=1000)
+    ids = [c[0] for c in clients]
+    redis_pairs = {k: v for k, v in zip(ids, await r.mget([store.partner_key(i) for i in ids]))
+                   if v}
+    diff = sum(1 for k in set(mem_pairs) | set(redis_pairs)
+               if mem_pairs.get(k) != redis_pairs.get(k))
+    check("600 mixed clients: in-memory and Redis form identical pairs",
+          diff == 0 and len(mem_pairs) > 500, f"pairs={len(mem_pairs) // 2}, differing={diff}")
+
+
+async def test_inmemory_throughput(r):
+    print("\nTest 19: the in-memory matcher drains 100,000 waiters quickly")
+    store._inmemory_mode = True
+    try:
+        mem_reset()
+        import random
+        rng = random.Random(3)
+        for i in range(100_000):
+            await mem_seed(f"x{i:06d}", rng.sample([f"t{k}" for k in range(1000)],
+                                                   rng.randrange(4)), live=i % 20 != 0)
+        started = time.perf_counter()
+        while await store.run_matcher_rounds(max_rounds=1000):
+            pass
+        took = time.perf_counter() - started
+        # Sorting the pool every round made this O(pairs x n log n): ~47,500
+        # sorts of up to 100k entries, hours of CPU. Now it is linear overall.
+        check("every live client is paired", len(store._mem_partners) >= 95_000 - 1,
+              f"paired={len(store._mem_partners)}")
+        check("the whole pool drains in under 10s", took < 10,
+              f"{took:.2f}s, {len(store._mem_partners) / 2 / took:,.0f} pairs/s")
     finally:
         store._inmemory_mode = False
-        for d in (store._mem_waiting, store._mem_topics, store._mem_partners):
-            d.clear()
-        store._mem_connections.clear()
+        mem_reset()
+
+
+async def test_window_mode(r):
+    print("\nTest 20: MATCH_MODE=window pairs for the most shared topics")
+    await reset(r)
+    store.MATCH_MODE = "window"
+    now = time.time() * 1000
+    try:
+        # Greedy gives a b (its oldest chess peer) and leaves c with d.
+        await seed(r, "a", now - 400, ["chess", "go"])
+        await seed(r, "b", now - 300, ["chess"])
+        await seed(r, "c", now - 200, ["go"])
+        await seed(r, "d", now - 100, ["chess"])
+        before = store.command_counts()["match"]
+        await store.run_matcher_rounds()
+        check("a goes to c, so that b and d share chess",
+              await store.get_partner("a") == "c" and await store.get_partner("b") == "d",
+              f"a -> {await store.get_partner('a')}, b -> {await store.get_partner('b')}")
+        check("one pass: a read and a claim",
+              store.command_counts()["match"] - before == 2,
+              str(store.command_counts()["match"] - before))
+        check("the pool and topic index are empty",
+              await r.zcard(store.WAITING_KEY) == 0
+              and await r.exists(store.topic_index_key(0, "chess")) == 0)
+
+        await reset(r)
+        await seed(r, "e", now, ["chess"])
+        await seed(r, "f", now)
+        await store.run_matcher_rounds()
+        due = store.match_due()
+        check("a fresh client with topics is held for a topic peer",
+              await store.get_partner("e") is None and await r.zcard(store.WAITING_KEY) == 2)
+        check("and the matcher is due back when it ripens",
+              due is not None
+              and matching.MATCH_HOLD_MS / 1000 - 0.5 < due <= matching.MATCH_HOLD_MS / 1000,
+              str(due))
+        await reset(r)
+        await seed(r, "e", now - matching.MATCH_HOLD_MS - 1, ["chess"])
+        await seed(r, "f", now)
+        await store.run_matcher_rounds()
+        check("once ripe, it takes anyone", await store.get_partner("e") == "f")
+
+        await reset(r)
+        await seed(r, "g", now - matching.MATCH_MAX_WAIT_MS - 1)
+        await seed(r, "h", now - 200, ["chess"])
+        await seed(r, "i", now - 100, ["chess"])
+        await store.run_matcher_rounds()
+        check("an overdue client is paired before a topic pair is formed",
+              await store.get_partner("g") == "h", f"g -> {await store.get_partner('g')}")
+
+        await reset(r)
+        await seed(r, "j", 5)
+        await seed(r, "k", 6)
+        formed = await store._eval(store._CLAIM_LUA, 1, store.WAITING_KEY, store._prefix(0), 0,
+                                   "j", 5, 1, "k", 7, 1)
+        check("a claim skips a pair no longer queued as read",
+              formed == [] and await r.zcard(store.WAITING_KEY) == 2, str(formed))
+
+        store._inmemory_mode = True
+        for ws_id, topics in (("a", ["chess", "go"]), ("b", ["chess"]), ("c", ["go"]),
+                              ("d", ["chess"])):
+            await mem_seed(ws_id, topics)
+        await store.run_matcher_rounds()
+        check("in-memory mode makes the same choice",
+              store._mem_partners == {"a": "c", "c": "a", "b": "d", "d": "b"},
+              str(store._mem_partners))
+    finally:
+        store.MATCH_MODE = "greedy"
+        store._inmemory_mode = False
+        store._match_due.clear()
+        mem_reset()
+
+
+async def test_window_mode_sharded(r):
+    print("\nTest 21: MATCH_MODE=window holds clients across shards too")
+    await reset(r)
+    store.MATCH_MODE = "window"
+    store.MATCH_SHARDS = 4
+    now = time.time() * 1000
+    try:
+        # Topics pick the shard (the least of them): find two that part.
+        topics = [f"t{i}" for i in range(40)]
+        chess = store.shard_for("x", ["chess"])
+        other = next(t for t in topics if store.shard_for("y", [t]) != chess)
+        await seed(r, "x", now - 200, ["chess"])
+        await seed(r, "y", now - 100, [other])
+        await store.run_matcher_rounds()
+        check("fresh peers sharing nothing stay queued, in different shards",
+              await store.get_partner("x") is None and sum(await store.waiting_counts()) == 2,
+              f"x -> {await store.get_partner('x')}")
+        due = store.match_due()
+        check("and the matcher is due back when they ripen",
+              due is not None and due <= matching.MATCH_HOLD_MS / 1000, str(due))
+
+        await reset(r)
+        await seed(r, "x", now - matching.MATCH_HOLD_MS - 200, ["chess"])
+        await seed(r, "y", now - matching.MATCH_HOLD_MS - 100, [other])
+        await store.run_matcher_rounds()
+        check("once both are ripe, the cross-shard pass pairs them",
+              await store.get_partner("x") == "y", f"x -> {await store.get_partner('x')}")
+
+        # {chess, go} queues under chess; {go} under go. If those part, only the
+        # cross-shard pass can see they share go.
+        go = next(t for t in topics if store.shard_for("v", [t]) != chess)
+        await reset(r)
+        await seed(r, "u", now - 200, ["chess", go])
+        await seed(r, "v", now - 100, [go])
+        await store.run_matcher_rounds()
+        check("fresh peers sharing a topic are paired across shards at once",
+              await store.get_partner("u") == "v", f"u -> {await store.get_partner('u')}")
+        check("the pool and topic indexes are empty",
+              sum(await store.waiting_counts()) == 0
+              and await r.exists(store.topic_index_key(chess, "chess")) == 0
+              and await r.exists(store.topic_index_key(store.shard_for("v", [go]), go)) == 0)
+    finally:
+        store.MATCH_MODE = "greedy"
+        store.MATCH_SHARDS = 1
+        store._match_due.clear()
 
 
 async def main():
@@ -154,7 +964,23 @@ async def main():
         await test_no_topic_fallback(r)
         await test_ghosts_past_the_window(r)
         await test_cost_is_not_proportional_to_pool(r)
+        await test_topic_index_at_depth(r)
+        await test_batch_cost(r)
+        await test_sharded_pool(r)
+        await test_relay_per_instance(r)
+        await test_disconnect_batch(r)
+        await test_requeue(r)
+        await test_script_registry(r)
+        await test_instance_lease(r)
+        await test_connection_limiter(r)
+        await test_metrics(r)
+        await test_command_ledger(r)
+        await test_loop_monitor(r)
+        await test_autopipeline(r)
         await test_inmemory_parity(r)
+        await test_inmemory_throughput(r)
+        await test_window_mode(r)
+        await test_window_mode_sharded(r)
         await reset(r)
     finally:
         await store.close()
@@ -12,8 +12,12 @@ Verifies:
   1. Cross-instance matching (clients on different instances get paired)
   2. Cross-instance signaling relay (SDP/ICE/PARTNER_LEFT across instances)
   3. Same-instance matching (fast local path)
-  4. Sliding-window rate limiting (per IP, at connect)
+  4. Sliding-window rate limiting (per IP, at connect), on one instance and
+     across two once they have synced
   5. Per-socket message rate limiting (token bucket, after connect)
+  6. Relay cost: a call setup does no Redis reads, and no publishes at all
+     when both peers share an instance (partner is cached on the socket)
+  7. /metrics: the traffic above shows up in each instance's histograms
 
 See also tests/test_matcher.py for the matcher selection logic and its Redis
 cost, which this file cannot isolate (it races the live matcher loop).
@@ -24,9 +28,10 @@ import os
 import sys
 import json
 import asyncio
+import urllib.request
 
 import redis.asyncio as aioredis
-from websockets.asyncio.client import connect
+from websockets.asyncio.client import connect as ws_connect
 from websockets.exceptions import ConnectionClosed
 
 URL_A = os.environ.get("INST_A_URL", "ws://127.0.0.1:8001/api/matchmaking")
@@ -36,6 +41,21 @@ REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379")
 passed = []
 failed = []
 
+# Each test that needs a fresh connection budget connects as a client IP of its
+# own (the instances trust Fly-Client-IP). Deleting the yf:rl:* keys is no longer
+# enough: every instance keeps its own recent admissions in memory.
+client_ip = "10.0.0.1"
+
+
+def connect(url):
+    return ws_connect(url, additional_headers={"Fly-Client-IP": client_ip})
+
+
+def new_client_ip():
+    global client_ip
+    last = int(client_ip.rsplit(".", 1)[1]) + 1
+    client_ip = f"10.0.0.{last}"
+
 
 def check(name, ok, detail=""):
     (passed if ok else failed).append(name)
@@ -84,6 +104,16 @@ async def test_cross_instance_match_and_relay():
         got = await recv_until(answerer, "SDP_ICE_CANDIDATE")
         check("ICE candidate relayed across instances", got.get("data") == "ICE_BLOB")
 
+        # Relayed text is forwarded untouched, and the browser acts on the last
+        # "name" key, so that is the one the server must judge the frame by.
+        for spoof in ('{"name":"SDP_ICE_CANDIDATE","data":"x","name":"PARTNER_LEFT"}',
+                      '{"name":"SDP_ICE_CANDIDATE","data":"x","n\\u0061me":"PARTNER_LEFT"}'):
+            await offerer.send(spoof)
+        await offerer.send(json.dumps({"name": "SDP_ICE_CANDIDATE", "data": "AFTER"}))
+        got = await recv(answerer)
+        check("a frame whose last name is not relayable is dropped", got.get("data") == "AFTER",
+              str(got))
+
         await offerer.close()
         got = await recv_until(answerer, "PARTNER_LEFT")
         check("PARTNER_LEFT delivered when partner disconnects", got.get("name") == "PARTNER_LEFT")
@@ -100,46 +130,49 @@ async def test_same_instance_match():
               msg_a.get("name") == "PARTNER_FOUND" and msg_b.get("name") == "PARTNER_FOUND")
 
 
-async def flush_rate_keys():
-    r = aioredis.from_url(REDIS_URL, decode_responses=True)
-    keys = [k async for k in r.scan_iter(match="yf:rl:*")]
-    if keys:
-        await r.delete(*keys)
-    await r.aclose()
+async def attempt(url) -> bool:
+    """Open one connection. True if it was accepted, False if rate limited."""
+    try:
+        ws = await connect(url)
+    except Exception:
+        return False
+    try:
+        msg = await recv(ws, timeout=1.5)
+        return msg.get("name") != "RATE_LIMITED"
+    except asyncio.TimeoutError:
+        return True                  # idle accepted connection (no frame sent)
+    except ConnectionClosed:
+        return False                 # server closed us before we read a frame
+    finally:
+        try:
+            await ws.close()
+        except Exception:
+            pass
 
 
 async def test_rate_limit():
     print("\nTest 3: rate limiting (default RATE_LIMIT_MAX=5 / 60s per IP)")
-    await flush_rate_keys()  # isolate from connections opened by tests 1 and 2
-    accepted, limited = 0, 0
-    for _ in range(7):
-        try:
-            ws = await connect(URL_A)
-        except Exception:
-            limited += 1
-            continue
-        try:
-            msg = await recv(ws, timeout=1.5)
-            if msg.get("name") == "RATE_LIMITED":
-                limited += 1
-            else:
-                accepted += 1
-        except asyncio.TimeoutError:
-            accepted += 1            # idle accepted connection (no frame sent)
-        except ConnectionClosed:
-            limited += 1             # server closed us before we read a frame
-        finally:
-            try:
-                await ws.close()
-            except Exception:
-                pass
+    new_client_ip()  # isolate from connections opened by tests 1 and 2
+    results = [await attempt(URL_A) for _ in range(7)]
+    accepted, limited = results.count(True), results.count(False)
     check("first 5 connections accepted", accepted == 5, f"accepted={accepted}")
     check("connections beyond the limit rejected", limited == 2, f"limited={limited}")
 
+    # The decision is local, so the limit holds across instances only once they
+    # have synced (RATE_LIMIT_SYNC_MS, default 1s).
+    new_client_ip()
+    first = [await attempt(URL_A) for _ in range(3)]
+    await asyncio.sleep(1.5)
+    second = [await attempt(URL_B) for _ in range(2)]
+    await asyncio.sleep(1.5)
+    after = [await attempt(URL_A), await attempt(URL_B)]
+    check("3 on A then 2 on B are all accepted", all(first + second), str(first + second))
+    check("the 6th, on either instance, is rejected once synced", not any(after), str(after))
+
 
 async def test_message_rate_limit():
     print("\nTest 4: per-socket message limiting (defaults MSG_BURST=40, MSG_RATE=20/s)")
-    await flush_rate_keys()  # test 3 just consumed this IP's connection budget
+    new_client_ip()  # test 3 just consumed this IP's connection budget
     # An unroutable name: the server ignores it without touching Redis, so this
     # measures the limiter and nothing else.
     noop = json.dumps({"name": "NOOP"})
@@ -169,11 +202,86 @@ async def test_message_rate_limit():
             check("a sustained flood gets the socket closed", closed)
 
 
+async def test_relay_cost():
+    print("\nTest 5: relaying a call setup costs no Redis reads")
+    new_client_ip()  # tests 3 and 4 used up this IP's connection budget
+    r = aioredis.from_url(REDIS_URL, decode_responses=True)
+    ice = 8
+    frames = 2 + 2 * ice
+    for label, url_b, max_publish in (("cross-instance", URL_B, frames),
+                                      ("same-instance", URL_A, 0)):
+        async with connect(URL_A) as a, connect(url_b) as b:
+            await a.send(json.dumps({"name": "PAIRING_START", "topics": []}))
+            await b.send(json.dumps({"name": "PAIRING_START", "topics": []}))
+            msg_a = await recv_until(a, "PARTNER_FOUND")
+            await recv_until(b, "PARTNER_FOUND")
+            offerer, answerer = (a, b) if msg_a.get("data") == "GO_FIRST" else (b, a)
+
+            # Pairing is done; from here on only the relay should touch Redis.
+            # The pause lets the other instance's matcher, woken by the same
+            # PAIRING_START, finish a pass whose script GETs would count here.
+            await asyncio.sleep(0.5)
+            await r.config_resetstat()
+            await offerer.send(json.dumps({"name": "SDP_OFFER", "data": "O"}))
+            await recv_until(answerer, "SDP_OFFER")
+            await answerer.send(json.dumps({"name": "SDP_ANSWER", "data": "A"}))
+            await recv_until(offerer, "SDP_ANSWER")
+            for sender, receiver in ((offerer, answerer), (answerer, offerer)):
+                for i in range(ice):
+                    await sender.send(json.dumps({"name": "SDP_ICE_CANDIDATE", "data": i}))
+                got = [(await recv_until(receiver, "SDP_ICE_CANDIDATE"))["data"]
+                       for _ in range(ice)]
+                check(f"{label}: ICE candidates arrive in order", got == list(range(ice)))
+            info = await r.info("commandstats")
+
+        def calls(cmd):
+            return info.get(f"cmdstat_{cmd}", {}).get("calls", 0)
+
+        # Each relayed frame used to cost a GET of the partner key first.
+        check(f"{label}: {frames} relayed frames, no GETs", calls("get") == 0,
+              f"get={calls('get')}")
+        check(f"{label}: at most one PUBLISH per frame (max {max_publish})",
+              calls("publish") <= max_publish, f"publish={calls('publish')}")
+    await r.aclose()
+
+
+def scrape(url):
+    """An instance's /metrics as {series: value}, from its WebSocket URL."""
+    http = url.replace("ws", "http", 1).rsplit("/api/", 1)[0] + "/metrics"
+    with urllib.request.urlopen(http, timeout=5) as resp:
+        text = resp.read().decode()
+    return dict(line.rsplit(" ", 1) for line in text.splitlines() if not line.startswith("#"))
+
+
+async def test_metrics():
+    print("\nTest 6: /metrics reflects the traffic of the tests above")
+    a = await asyncio.to_thread(scrape, URL_A)
+    b = await asyncio.to_thread(scrape, URL_B)
+
+    def total(series):
+        return float(a.get(series, 0)) + float(b.get(series, 0))
+
+    check("every PARTNER_FOUND had its wait timed",
+          total("yawnfox_time_to_match_seconds_count") >= 8,
+          f"count={total('yawnfox_time_to_match_seconds_count')}")
+    check("both relay paths were timed",
+          total('yawnfox_relay_seconds_count{path="local"}') > 0
+          and total('yawnfox_relay_seconds_count{path="remote"}') > 0)
+    check("envelopes were heard, and the listener lag recorded",
+          total("yawnfox_pubsub_lag_seconds_count") > 0)
+    check("the match script was timed",
+          total('yawnfox_redis_script_seconds_count{script="match"}') > 0)
+    check("the flood of test 4 shows as token-bucket drops",
+          float(a.get("yawnfox_message_drops_total", 0)) > 0)
+
+
 async def main():
     await test_cross_instance_match_and_relay()
     await test_same_instance_match()
     await test_rate_limit()
     await test_message_rate_limit()
+    await test_relay_cost()
+    await test_metrics()
     print(f"\n==== {len(passed)} passed, {len(failed)} failed ====")
     if failed:
         print("FAILED:", ", ".join(failed))
@@ -0,0 +1,158 @@
+# app/tracelog.py
+"""
+Signaling traces: what clients did and when, with nothing that identifies them.
+
+Synthetic load (bench/bench_ws_load.py, bench/bench_matcher_sim.py) has the
+shape we guessed. A trace has the shape production actually has: how long
+people wait before pressing Next, how often they leave mid-setup, how large the
+SDPs are, how the day's peak builds. bench/bench_replay.py plays a trace back
+against local instances at 1x, 10x or 100x, so a matcher, relay or cleanup
+change can be measured under that traffic before it ships.
+
+Off unless TRACE_FILE is set. Each recorded connection gets a number, local to
+this process; a topic is kept only as a keyed hash (equal topics hash equal
+under one TRACE_SALT); a relayed frame only as its kind and size. Nothing else
+is written: no ids, addresses, topic text or payloads.
+
+The file is text, one event per line, appended to:
+
+    #yawnfox-trace v1 start=<epoch ms> instance=<id>
+    <ms since start> <client> <event>[ <arg>]
+
+  C  connected
+  P  PAIRING_START; arg: its topics' hashes, comma-separated (none: no arg)
+  F  PARTNER_FOUND delivered
+  R  signaling relayed to the partner; arg: O/A/I (offer, answer, candidate)
+     and the frame's length, e.g. O2841
+  L  LEAVE     A  PAIRING_ABORT     X  PARTNER_LEFT delivered     D  disconnected
+
+Every start (or restart) appends a new header, and client numbers restart
+with it. The overhead is bounded: record() appends a short string to a list,
+a task writes the list out from a thread every TRACE_FLUSH_MS, at most
+TRACE_BUFFER events are held (the rest are counted in
+yawnfox_trace_dropped_total), and recording stops for good once the file
+reaches TRACE_MAX_MB.
+"""
+import os
+import time
+import random
+import asyncio
+import hashlib
+import logging
+from typing import Dict, List, Optional
+
+import metrics
+
+logger = logging.getLogger("yawnfox.trace")
+
+# One file per process: "{instance}" in the path becomes the instance id, for
+# instances that share a disk (their flushes would interleave in one file).
+TRACE_FILE = os.environ.get("TRACE_FILE", "").strip()
+# Fraction of connections recorded. A sampled client's partner may not be.
+TRACE_SAMPLE = float(os.environ.get("TRACE_SAMPLE", "1"))
+# Set the same salt on every instance to merge their traces with topics intact.
+# Unset: a random one per process, so topics only compare within one file.
+TRACE_SALT = os.environ.get("TRACE_SALT", "").encode() or os.urandom(16)
+TRACE_MAX_MB = float(os.environ.get("TRACE_MAX_MB", "512"))
+TRACE_FLUSH_MS = int(os.environ.get("TRACE_FLUSH_MS", "1000"))
+TRACE_BUFFER = int(os.environ.get("TRACE_BUFFER", "100000"))
+
+# Checked inline on the relay path, so an untraced server pays one attribute read.
+ENABLED = bool(TRACE_FILE)
+
+# The three relayable names, as the letter a trace keeps of them.
+RELAY_KINDS = {"SDP_OFFER": "O", "SDP_ANSWER": "A", "SDP_ICE_CANDIDATE": "I"}
+
+TRACE_EVENTS = metrics.counter("yawnfox_trace_events_total", "Events written to TRACE_FILE.")
+TRACE_DROPPED = metrics.counter("yawnfox_trace_dropped_total",
+                                "Trace events dropped: buffer full or TRACE_MAX_MB reached.")
+
+_clients: Dict[str, int] = {}   # recorded ws_id -> its number in this trace
+_next_client = 0
+_buffer: List[str] = []
+_start = time.monotonic()
+_written = 0                    # bytes in the file, as of the last flush
+_path = TRACE_FILE
+
+
+def topic_hash(topic: str) -> str:
+    return hashlib.blake2b(topic.encode(), key=TRACE_SALT[:64], digest_size=6).hexdigest()
+
+
+def connected(ws_id: str) -> None:
+    """Start recording ws_id, if it is sampled."""
+    global _next_client
+    if not ENABLED or random.random() >= TRACE_SAMPLE:
+        return
+    _clients[ws_id] = _next_client
+    _next_client += 1
+    record(ws_id, "C")
+
+
+def record(ws_id: str, event: str, arg: str = "") -> None:
+    n = _clients.get(ws_id)
+    if n is None:
+        return
+    if len(_buffer) >= TRACE_BUFFER:
+        TRACE_DROPPED.inc()
+        return
+    ms = int((time.monotonic() - _start) * 1000)
+    _buffer.append(f"{ms} {n} {event} {arg}\n" if arg else f"{ms} {n} {event}\n")
+
+
+def pairing(ws_id: str, topics: list) -> None:
+    if ws_id in _clients:
+        record(ws_id, "P", ",".join(map(topic_hash, topics)))
+
+
+def relayed(ws_id: str, name: str, size: int) -> None:
+    record(ws_id, "R", f"{RELAY_KINDS[name]}{size}")
+
+
+def disconnected(ws_id: str) -> None:
+    record(ws_id, "D")
+    _clients.pop(ws_id, None)
+
+
+def _append(lines: str) -> int:
+    with open(_path, "a", encoding="ascii") as f:
+        f.write(lines)
+        return f.tell()
+
+
+async def flush() -> None:
+    """Write out what is buffered; past TRACE_MAX_MB, stop recording."""
+    global ENABLED, _written
+    if not _buffer:
+        return
+    lines = _buffer[:]
+    _buffer.clear()
+    try:
+        _written = await asyncio.to_thread(_append, "".join(lines))
+        TRACE_EVENTS.inc(len(lines))
+    except OSError as e:
+        TRACE_DROPPED.inc(len(lines))
+        logger.warning(f"Could not write {_path}: {e}")
+    if ENABLED and _written >= TRACE_MAX_MB * 1024 * 1024:
+        ENABLED = False
+        _clients.clear()
+        logger.warning(f"{_path} reached TRACE_MAX_MB ({TRACE_MAX_MB:g}); trace stopped.")
+
+
+async def writer(instance: Optional[str] = None) -> None:
+    """Background task: head the file with this run's start, then flush every
+    TRACE_FLUSH_MS; flushes what is left when cancelled."""
+    global _start, _path
+    if not ENABLED:
+        return
+    _path = TRACE_FILE.replace("{instance}", instance or "-")
+    _start = time.monotonic()
+    _buffer.insert(0, f"#yawnfox-trace v1 start={int(time.time() * 1000)}"
+                      f" instance={instance or '-'}\n")
+    logger.info(f"Recording a signaling trace to {_path} (sample {TRACE_SAMPLE:g}).")
+    try:
+        while True:
+            await asyncio.sleep(TRACE_FLUSH_MS / 1000)
+            await flush()
+    finally:
+        await flush()